@@ -0,0 +1,128 @@
+"""
+TorchScript versions of the time loops of the recurrent cores, shifters, and modulators.
+
+The loops are scripted lazily on first use. If scripting is not available or fails, `available` returns False
+and the modules keep running in eager mode.
+"""
+from warnings import warn
+
+import torch
+from torch.nn import functional as F
+
+
+def script(fn):
+    """
+    Returns: scripted version of fn or None if fn cannot be scripted
+    """
+    if not hasattr(torch, 'jit') or not hasattr(torch.jit, 'script'):
+        return None
+    try:
+        return torch.jit.script(fn)
+    except Exception as e:
+        warn('Could not script {}: {}. Falling back to eager mode.'.format(fn.__name__, e))
+        return None
+
+
+def gru_loop(input_gates, hidden, weight_hh, bias_hh):
+    # type: (Tensor, Tensor, Tensor, Tensor) -> Tensor
+    """
+    Loop of nn.GRUCell over precomputed input projections of shape (time, batch, 3 * hidden).
+    """
+    states = []
+    for t in range(input_gates.size(0)):
+        reset_input, update_input, out_input = input_gates[t].chunk(3, 1)
+        reset_hidden, update_hidden, out_hidden = torch.addmm(bias_hh, hidden, weight_hh.t()).chunk(3, 1)
+        reset = torch.sigmoid(reset_input + reset_hidden)
+        update = torch.sigmoid(update_input + update_hidden)
+        out = torch.tanh(out_input + reset * out_hidden)
+        hidden = out + update * (hidden - out)
+        states.append(hidden)
+    return torch.stack(states, 0)
+
+
+def conv_gru_loop(input_gates, hidden, weight_hidden, bias_hidden, weight_out, bias_out, padding):
+    # type: (Tensor, Tensor, Tensor, Tensor, Tensor, Tensor, int) -> Tensor
+    """
+    Loop of ConvGRUCell over precomputed input gates of shape (time, batch, 3 * channels, width, height).
+    """
+    states = []
+    for t in range(input_gates.size(0)):
+        reset_input, update_input, out_input = input_gates[t].chunk(3, 1)
+        reset_hidden, update_hidden = torch.conv2d(hidden, weight_hidden, bias_hidden,
+                                                   [1, 1], [padding, padding]).chunk(2, 1)
+        update = torch.sigmoid(update_input + update_hidden)
+        reset = torch.sigmoid(reset_input + reset_hidden)
+        out = torch.tanh(out_input + torch.conv2d(hidden * reset, weight_out, bias_out,
+                                                  [1, 1], [padding, padding]))
+        hidden = hidden * (1 - update) + out * update
+        states.append(hidden)
+    return torch.stack(states, 0)
+
+
+_scripted = {}
+
+
+def scripted(fn):
+    if fn.__name__ not in _scripted:
+        _scripted[fn.__name__] = script(fn)
+    return _scripted[fn.__name__]
+
+
+def available():
+    """
+    Returns: True if all loops in this module can be scripted
+    """
+    return all(scripted(fn) is not None for fn in (gru_loop, conv_gru_loop))
+
+
+def set_compiled(module, compiled=True):
+    """
+    Switches all submodules of module with a `compiled` flag between the scripted and the eager version of
+    their time loop. If scripting is not available, they run in eager mode.
+
+    Returns: True if the submodules run scripted
+    """
+    compiled = compiled and available()
+    for m in module.modules():
+        if hasattr(m, 'compiled'):
+            m.compiled = compiled
+    return compiled
+
+
+def gru_sequence(cell, x, hidden):
+    """
+    Runs an nn.GRUCell over a time-major sequence with the scripted loop.
+
+    Args:
+        cell:   nn.GRUCell
+        x:      input of shape (time, batch, features)
+        hidden: initial hidden state of shape (batch, hidden)
+
+    Returns: hidden states of shape (time, batch, hidden)
+
+    """
+    input_gates = F.linear(x, cell.weight_ih, cell.bias_ih)
+    bias_hh = cell.bias_hh if cell.bias_hh is not None else cell.weight_hh.new_zeros(cell.weight_hh.size(0))
+    return scripted(gru_loop)(input_gates, hidden, cell.weight_hh, bias_hh)
+
+
+def conv_gru_sequence(cell, x, hidden=None):
+    """
+    Runs a ConvGRUCell or FusedConvGRUCell over a time-major sequence with the scripted loop.
+
+    Args:
+        cell:   ConvGRUCell
+        x:      input of shape (time, batch, channels, width, height)
+        hidden: initial hidden state (default: learned initial state of the cell)
+
+    Returns: hidden states of shape (time, batch, channels, width, height)
+
+    """
+    T, N = x.size()[:2]
+    weight_input, bias_input, weight_hidden, bias_hidden = cell.fused_weights()
+    gates = F.conv2d(x.contiguous().view(T * N, *x.size()[2:]), weight_input, bias_input,
+                     padding=cell.input_padding)
+    if hidden is None:
+        hidden = cell.init_state(x[0])
+    return scripted(conv_gru_loop)(gates.view(T, N, *gates.size()[1:]), hidden, weight_hidden, bias_hidden,
+                                   cell.out_gate_hidden.weight, cell.out_gate_hidden.bias, cell.rec_padding)
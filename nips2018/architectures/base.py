@@ -1,14 +1,44 @@
-import numpy as np
+from collections import deque, OrderedDict
+
 import torch
 from torch.nn.parallel import data_parallel
 
 from attorch.layers import log1exp, Elu1
 from attorch.module import ModuleDict
 from torch import nn as nn
-from torch.autograd import Variable
 from torch.nn import functional as F
 
+from ..utils.inference import no_grad
 from ..utils.logging import Messager
+from . import _scripted
+
+
+def run_stateful(module, *args, state=None, **kwargs):
+    """
+    Calls module and returns its output and its state after the last frame. Modules that are not
+    recurrent have no state, which is returned as None.
+    """
+    if getattr(module, 'recurrent', False):
+        return module(*args, state=state, return_state=True, **kwargs)
+    return module(*args, **kwargs), None
+
+
+def frames_of(x):
+    """
+    Returns: number of frames of a core output (or of the first element of a tuple of outputs)
+    """
+    return (x[0] if isinstance(x, tuple) else x).size(2)
+
+
+def detach_state(state):
+    """
+    Detaches all tensors in a (nested) hidden state from the graph.
+    """
+    if state is None:
+        return None
+    if isinstance(state, dict):
+        return {k: detach_state(v) for k, v in state.items()}
+    return state.detach()
 
 
 class _CorePlusReadoutBase(nn.Module, Messager):
@@ -43,40 +73,136 @@ class _CorePlusReadoutBase(nn.Module, Messager):
 
     @staticmethod
     def get_readout_in_shape(core, in_shape):
-        mov_shape = in_shape[1:]
-        core.eval()
-        tmp = Variable(torch.from_numpy(np.random.randn(1, *mov_shape).astype(np.float32)))
-        nout = core(tmp).size()[1:]
-        core.train(True)
-        return nout
+        return core.output_shape(in_shape[1:])
 
 
 
 
 class CorePlusReadout3d(_CorePlusReadoutBase):
-    def __init__(self, core, readout, modulator=None, nonlinearity=None, shifter=None, burn_in=15):
+    """
+    Args:
+        compile:    run the time loops of recurrent cores, shifters, and modulators as TorchScript
+                    (see set_compiled)
+    """
+
+    def __init__(self, core, readout, modulator=None, nonlinearity=None, shifter=None, burn_in=15, compile=False):
         super().__init__(core, readout, modulator=modulator, nonlinearity=nonlinearity, shifter=shifter)
         self.burn_in = burn_in
+        if compile:
+            self.set_compiled(True)
+
+    def set_compiled(self, compiled=True):
+        """
+        Switches all submodules with a TorchScript version of their time loop between the scripted and the
+        eager version. If scripting is not available, the model stays in eager mode.
+        """
+        if not _scripted.set_compiled(self, compiled) and compiled:
+            self.msg('TorchScript is not available. Using eager mode.')
+        return self
 
     @property
     def state(self):
         return dict(shift=self.shift, modulate=self.modulate, burn_in=self.burn_in)
 
-    def forward(self, x, readout_key, behavior=None, eye_pos=None, subs_idx=None):
-        timesteps = x.size(2)
-        x = self.core(x)
-
-        if eye_pos is not None and self.shifter is not None and self.shift:
-            shift = self.shifter[readout_key](eye_pos)
-            if isinstance(x, tuple):
-                lag = shift.size(1) - x[0].size(2)
-            else:
-                lag = shift.size(1) - x.size(2)
-
-            shift = shift[:, lag:, ...]
-        else:
-            shift = None
+    def forward(self, x, readout_key, behavior=None, eye_pos=None, subs_idx=None, hidden=None,
+                return_hidden=False):
+        """
+        Args:
+            x:              input movie of shape (batch, channels, time, width, height)
+            readout_key:    readout to use. If a list of readout keys is given, the core runs once and an
+                            OrderedDict with the prediction of every readout is returned (see forward_multi).
+            behavior:       behavior for the modulator
+            eye_pos:        eye position for the shifter
+            subs_idx:       indices of neurons to predict
+            hidden:         hidden states of core, shifter, and modulator at the end of the previous chunk of
+                            the same trials (see return_hidden). If given, the chunk continues the previous one
+                            and no burn in frames are dropped. This needs a recurrent core: stateless cores
+                            would see no frames of the previous chunk.
+            return_hidden:  also return the hidden states after the last frame
+
+        Returns: predicted responses and, if requested, the hidden states
+
+        """
+        if isinstance(readout_key, (list, tuple)):
+            assert subs_idx is None and hidden is None and not return_hidden, \
+                'subs_idx and hidden states are not supported for several readouts'
+            return self.forward_multi(x, readout_key, behavior=behavior, eye_pos=eye_pos)
 
+        timesteps = x.size(2)
+        state = hidden or {}
+        new_state = {}
+        x, new_state['core'] = self.core_stage(x, state=state.get('core'))
+        if hidden is None:
+            x = self.drop_burn_in(x, timesteps)
+        # shifter and modulator only run their readout of the recurrent state on the kept frames, and
+        # modulation and readout are only computed for the neurons in subs_idx
+        shift, new_state['shifter'] = self.shift_stage(x, readout_key, eye_pos, state=state.get('shifter'))
+        modulation, new_state['modulator'] = self.modulation_stage(readout_key, behavior,
+                                                                   state=state.get('modulator'), subs_idx=subs_idx,
+                                                                   frames=frames_of(x))
+        x = self.readout_stage(x, readout_key, shift=shift, subs_idx=subs_idx)
+        x = self.output_stage(x, readout_key, timesteps, modulation=modulation, burn_in=False)
+        return (x, new_state) if return_hidden else x
+
+    # --- stages of forward. Everything up to the readout does not depend on the neurons and can be shared
+    #     between subsets of neurons (see forward_chunks).
+
+    def core_stage(self, x, state=None):
+        """
+        Returns: core output and its hidden state after the last frame (None if the core is not recurrent)
+        """
+        return run_stateful(self.core, x, state=state)
+
+    def drop_burn_in(self, x, timesteps):
+        """
+        Drops the burn in frames from the core output x, so that the later stages only process the frames that
+        are returned. Frames the core already dropped (its lag) count towards the burn in.
+
+        Args:
+            x:          core output
+            timesteps:  number of frames of the input movie
+        """
+        frames = frames_of(x)
+        if self.burn_in < timesteps - frames:
+            self.msg('WARNING: burn in is smaller than induced lag')
+        burn_in = max(0, self.burn_in - timesteps + frames)
+        if isinstance(x, tuple):
+            return tuple(xx[:, :, burn_in:] for xx in x)
+        return x[:, :, burn_in:]
+
+    def shift_stage(self, x, readout_key, eye_pos, state=None):
+        """
+        Computes the shift of the readout positions aligned with the core output x.
+
+        Returns: shift or None if the model does not shift and the hidden state of the shifter
+        """
+        if eye_pos is None or self.shifter is None or not self.shift:
+            return None, None
+        shifter = self.shifter[readout_key]
+        if not getattr(shifter, 'recurrent', False):
+            # frame-wise shifters only need the frames of x
+            eye_pos = eye_pos[:, eye_pos.size(1) - frames_of(x):]
+        shift, state = run_stateful(shifter, eye_pos, state=state)
+        lag = shift.size(1) - frames_of(x)
+        return shift[:, lag:, ...], state
+
+    def modulation_stage(self, readout_key, behavior, state=None, subs_idx=None, frames=None):
+        """
+        Computes the modulation of the neurons subs_idx (default: all) of the readout for the last frames
+        (default: all) frames. Recurrent modulators still run over all frames of the behavior.
+
+        Returns: modulation or None if the model does not modulate and the hidden state of the modulator
+        """
+        if behavior is None or self.modulator is None or not self.modulate:
+            return None, None
+        modulator = self.modulator[readout_key]
+        if getattr(modulator, 'recurrent', False):
+            return modulator.modulation(behavior, state=state, return_state=True, subs_idx=subs_idx, frames=frames)
+        if frames is not None:
+            behavior = behavior[:, behavior.size(1) - frames:]
+        return modulator.modulation(behavior, subs_idx=subs_idx), None
+
+    def readout_stage(self, x, readout_key, shift=None, subs_idx=None):
         if self.readout_gpu is not None:
             module_kwargs = dict(shift=shift.cuda(1) if shift is not None else None, subs_idx=subs_idx)
             n_gpu = torch.cuda.device_count()
@@ -87,20 +213,107 @@ class CorePlusReadout3d(_CorePlusReadoutBase):
                               module_kwargs=module_kwargs, device_ids=device_ids).cuda(0)
             else:
                 x = self.readout[readout_key](x.cuda(1), **module_kwargs).cuda(0)
+        elif torch.is_tensor(subs_idx) and hasattr(self.readout, 'subset_forward'):
+            x = self.readout.subset_forward(readout_key, x, subs_idx, shift=shift)
         else:
             x = self.readout[readout_key](x, shift=shift, subs_idx=subs_idx)
-
+        return x
+
+    def output_stage(self, x, readout_key, timesteps, modulation=None, subs_idx=None, burn_in=True):
+        """
+        Applies the nonlinearity and the modulation to the readout output x and drops the burn in frames.
+
+        Args:
+            x:              readout output
+            readout_key:    readout key
+            timesteps:      number of frames of the input movie
+            modulation:     output of modulation_stage
+            subs_idx:       indices of the neurons in x
+            burn_in:        drop burn in frames
+        """
         x = self.nonlinearity(x)
 
-        if behavior is not None and self.modulator is not None and self.modulate:
-            x = self.modulator[readout_key](behavior, x, subs_idx=subs_idx)
+        if modulation is not None:
+            x = self.modulator[readout_key].apply_modulation(modulation, x, subs_idx=subs_idx)
 
-        if self.burn_in < timesteps - x.size(1):
-            self.msg('WARNING: burn in is smaller than induced lag')
+        if burn_in:
+            if self.burn_in < timesteps - x.size(1):
+                self.msg('WARNING: burn in is smaller than induced lag')
+
+            burn_in = max(0, self.burn_in - timesteps + x.size(1))
+            x = x[:, burn_in:, :]
+        return x
+
+    def forward_multi(self, x, readout_keys, behavior=None, eye_pos=None):
+        """
+        Predicts the responses of several readouts to the same input. The core runs once, shifts are computed
+        once per shifter module, and readouts that support it (see PooledReadout.multi_forward) sample the core
+        output in one operation for all readouts with the same shift.
+
+        Args:
+            x:              input movie
+            readout_keys:   list of readout keys
+            behavior:       behavior for the modulators
+            eye_pos:        eye position for the shifters
+
+        Returns: OrderedDict with the predictions of every readout
+
+        """
+        timesteps = x.size(2)
+        x, _ = self.core_stage(x)
+        x = self.drop_burn_in(x, timesteps)
+
+        shifts, computed = OrderedDict(), {}
+        for k in readout_keys:
+            shifter = id(self.shifter[k]) if self.shifter is not None else None
+            if shifter not in computed:
+                computed[shifter], _ = self.shift_stage(x, k, eye_pos)
+            shifts[k] = computed[shifter]
+
+        if self.readout_gpu is None and hasattr(self.readout, 'multi_forward'):
+            outputs = self.readout.multi_forward(x, readout_keys, shifts)
+        else:
+            outputs = OrderedDict((k, self.readout_stage(x, k, shift=shifts[k])) for k in readout_keys)
+
+        ret = OrderedDict()
+        for k in readout_keys:
+            modulation, _ = self.modulation_stage(k, behavior, frames=frames_of(x))
+            ret[k] = self.output_stage(outputs[k], k, timesteps, modulation=modulation, burn_in=False)
+        return ret
 
-        burn_in = max(0, self.burn_in - timesteps + x.size(1))
+    def forward_chunks(self, x, readout_key, subs_idxs, behavior=None, eye_pos=None):
+        """
+        Predicts the responses for several subsets of neurons while computing core, shifter, and modulator
+        only once.
 
-        return x[:, burn_in:, :]
+        Args:
+            x:              input movie
+            readout_key:    readout to use
+            subs_idxs:      iterable of neuron indices (e.g. slices)
+            behavior:       behavior for the modulator
+            eye_pos:        eye position for the shifter
+
+        Returns: generator with the predictions for every element of subs_idxs
+
+        """
+        timesteps = x.size(2)
+        x, _ = self.core_stage(x)
+        x = self.drop_burn_in(x, timesteps)
+        shift, _ = self.shift_stage(x, readout_key, eye_pos)
+        modulation, _ = self.modulation_stage(readout_key, behavior, frames=frames_of(x))
+        for subs_idx in subs_idxs:
+            y = self.readout_stage(x, readout_key, shift=shift, subs_idx=subs_idx)
+            yield self.output_stage(y, readout_key, timesteps, modulation=modulation, subs_idx=subs_idx,
+                                    burn_in=False)
+
+    def to_device(self, device):
+        """
+        Moves the model to device. On the GPU, the readouts are placed on a second GPU if there is one (see cuda).
+        """
+        device = torch.device(device)
+        if device.type == 'cuda' and device.index in (None, 0):
+            return self.cuda()
+        return self.to(device)
 
     def cuda(self):
         n_gpu = torch.cuda.device_count()
@@ -119,6 +332,155 @@ class CorePlusReadout3d(_CorePlusReadoutBase):
         return s + '|'.join(ret) + ']\n'
 
 
+def temporal_context(core):
+    """
+    Computes the temporal receptive field of a core made of stacked 3d convolutions.
+
+    Args:
+        core:   core module
+
+    Returns: number of input frames R that one output frame depends on and the number of frames P the output
+             lags behind its newest input frame due to temporal padding
+
+    """
+    context, delay = 1, 0
+    for m in core.modules():
+        if isinstance(m, nn.Conv3d):
+            context += m.dilation[0] * (m.kernel_size[0] - 1)
+            delay += m.padding[0]
+    return context, delay
+
+
+class StreamingPredictor(Messager):
+    """
+    Predicts responses of a CorePlusReadout3d frame by frame.
+
+    Recurrent cores, shifters, and modulators carry their hidden state from one frame to the next. Cores made
+    of 3d convolutions keep a ring buffer of the last `window` input frames (at least their temporal receptive
+    field R, see temporal_context) and are evaluated on that buffer only, so every frame takes constant time.
+    Temporal padding makes such cores look P frames into the future; the prediction returned for a frame
+    therefore belongs to the frame P steps earlier, and the behavior and eye position are delayed accordingly.
+    Before R frames have been seen, step returns None.
+
+    Predictions equal those of the model on the whole clip (up to the burn in, which is not dropped here).
+    The model should be in eval mode. The exception are cores with instance normalization (e.g. Stacked3dCore
+    with normalize=True): they normalize over the buffered frames instead of the whole clip, which only
+    approximates the clip predictions. Larger windows give better approximations at a higher cost per frame.
+
+    Args:
+        model:          CorePlusReadout3d
+        readout_key:    readout to predict
+        subs_idx:       indices of neurons to predict (default: all)
+        window:         number of buffered frames of 3d convolution cores (default: R)
+
+    Example:
+
+        >>> predictor = StreamingPredictor(model.eval(), readout_key)
+        >>> for frame, beh, eye in recording:
+        ...     y = predictor.step(frame, behavior=beh, eye_pos=eye)
+
+    """
+
+    def __init__(self, model, readout_key, subs_idx=None, window=None):
+        if model.training:
+            self.msg('WARNING: model is in training mode. Batch norm will use the statistics of single frames.')
+        self.model = model
+        self.readout_key = readout_key
+        self.subs_idx = subs_idx
+        self.recurrent_core = getattr(model.core, 'recurrent', False)
+        self.context, self.delay = (1, 0) if self.recurrent_core else temporal_context(model.core)
+        self.window = self.context if window is None or self.recurrent_core else max(window, self.context)
+        if any(isinstance(m, nn.modules.instancenorm._InstanceNorm) for m in model.core.modules()):
+            self.msg('WARNING: instance normalization of the core uses the statistics of the last', self.window,
+                     'frames instead of the whole clip')
+        self.reset()
+
+    def reset(self):
+        """
+        Forgets all previous frames, e.g. at the beginning of a new recording.
+        """
+        self.hidden = {}
+        self.frames = deque(maxlen=self.window)
+        self.behavior = deque(maxlen=self.delay + 1)
+        self.eye_pos = deque(maxlen=self.delay + 1)
+        self.frames_seen = 0
+
+    @property
+    def ready(self):
+        return len(self.frames) >= self.context
+
+    def _core_step(self, frame):
+        core = self.model.core
+        self.frames.append(frame)
+        if self.recurrent_core:
+            x, self.hidden['core'] = core(frame.unsqueeze(2), state=self.hidden.get('core'), return_state=True)
+            return x
+        if not self.ready:
+            return None
+        x = core(torch.stack(list(self.frames), 2))
+        # the newest output frame whose receptive field contains no temporal padding
+        end = x.size(2) - self.delay
+        return x[:, :, end - 1:end]
+
+    def _stateful_step(self, name, module, *args, **kwargs):
+        out, self.hidden[name] = run_stateful(module, *args, state=self.hidden.get(name), **kwargs)
+        return out
+
+    def step(self, frame, behavior=None, eye_pos=None):
+        """
+        Feeds the next frame.
+
+        Args:
+            frame:      movie frame of shape (batch, channels, width, height)
+            behavior:   behavior of shape (batch, features) for the modulator
+            eye_pos:    eye position of shape (batch, 2) for the shifter
+
+        Returns: predicted responses of shape (batch, neurons) for the frame `delay` steps ago
+                 or None if not enough frames have been seen
+
+        """
+        with no_grad():
+            ret = self._step(frame, behavior, eye_pos)
+        self.hidden = detach_state(self.hidden)
+        return ret
+
+    def _step(self, frame, behavior, eye_pos):
+        model, readout_key = self.model, self.readout_key
+        self.frames_seen += 1
+        self.behavior.append(behavior)
+        self.eye_pos.append(eye_pos)
+        x = self._core_step(frame)
+        if len(self.eye_pos) <= self.delay:  # no frame `delay` steps ago yet
+            return None
+        behavior, eye_pos = self.behavior[0], self.eye_pos[0]
+        modulate = behavior is not None and model.modulator is not None and model.modulate
+
+        shift = None
+        if eye_pos is not None and model.shifter is not None and model.shift:
+            shift = self._stateful_step('shifter', model.shifter[readout_key], eye_pos.unsqueeze(1))
+
+        if x is None:
+            # the core window is not full yet, but shifter and modulator already see this frame in the full clip
+            if modulate:
+                ones = behavior[:, :1].unsqueeze(1) * 0 + 1
+                self._stateful_step('modulator', model.modulator[readout_key], behavior.unsqueeze(1), ones,
+                                    subs_idx=self.subs_idx)
+            return None
+
+        if model.readout_gpu is not None:
+            x = model.readout[readout_key](x.cuda(model.readout_gpu),
+                                           shift=shift.cuda(model.readout_gpu) if shift is not None else None,
+                                           subs_idx=self.subs_idx).cuda(0)
+        else:
+            x = model.readout[readout_key](x, shift=shift, subs_idx=self.subs_idx)
+        x = model.nonlinearity(x)
+
+        if modulate:
+            x = self._stateful_step('modulator', model.modulator[readout_key], behavior.unsqueeze(1), x,
+                                    subs_idx=self.subs_idx)
+        return x[:, 0]
+
+
 class CorePlusReadout2d(_CorePlusReadoutBase):
 
     @property
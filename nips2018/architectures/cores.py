@@ -1,4 +1,6 @@
 from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from functools import partial
 from itertools import count
 from warnings import warn
 
@@ -8,22 +10,176 @@ import torch
 from torch.nn import functional as F, Parameter
 import torch.nn.init as init
 from attorch.regularizers import LaplaceL23d, LaplaceL2
-from torch.autograd import Variable
 from attorch.layers import ExtendedConv2d
+from ..utils.inference import no_grad
 from ..utils.logging import Messager
+from . import _scripted
 
 try:
     from netgard.flat_cajal import CajalUnit
 except:
     warn("Could not import CajalUnit. You won't be able to use the NetGardCore")
+try:
+    from torch.utils.checkpoint import checkpoint
+except ImportError:
+    checkpoint = None
+    warn("Could not import torch.utils.checkpoint. Activation checkpointing will be disabled")
 from attorch.layers import BiasBatchNorm2d, Elu1
 from attorch.module import ModuleDict
 
 
+def conv_output_shape(conv, in_shape):
+    """
+    Computes the output shape of a convolution without running it.
+
+    Args:
+        conv:       nn.Conv2d or nn.Conv3d module
+        in_shape:   input shape without batch dimension, i.e. (channels, *spatial)
+
+    Returns: output shape (channels, *spatial)
+
+    """
+    spatial = tuple((s + 2 * p - d * (k - 1) - 1) // st + 1
+                    for s, k, p, d, st in zip(in_shape[1:], conv.kernel_size, conv.padding,
+                                              conv.dilation, conv.stride))
+    return (conv.out_channels,) + spatial
+
+
+def fold_time(x):
+    """
+    Folds the time dimension of a (batch, channels, time, width, height) tensor into the batch dimension.
+    The result is time-major, i.e. of shape (time * batch, channels, width, height) with all samples of the
+    first frame first.
+    """
+    N, c, t, w, h = x.size()
+    return x.transpose(1, 2).transpose(0, 1).contiguous().view(t * N, c, w, h)
+
+
+def unfold_time(x, frames):
+    """
+    Inverse of fold_time: converts a time-major (time * batch, channels, width, height) tensor
+    back to (batch, channels, time, width, height).
+    """
+    NT, *rest = x.size()
+    return x.view(frames, NT // frames, *rest).transpose(0, 1).transpose(1, 2).contiguous()
+
+
+def framewise_batch_norm(norm, x, frames):
+    """
+    Applies the batch norm layer norm to a time-major batch x that contains `frames` frames folded into the
+    batch dimension (see fold_time). In training mode, every frame is normalized with its own batch statistics
+    and the running statistics are updated as after `frames` consecutive calls, i.e. the result is the same as
+    calling norm on each frame separately.
+
+    Args:
+        norm:   batch norm module
+        x:      time-major input of shape (frames * batch, channels, width, height)
+        frames: number of frames folded into the batch dimension
+
+    Returns: normalized x
+
+    """
+    track_running_stats = getattr(norm, 'track_running_stats', True)
+    if frames == 1 or (not norm.training and track_running_stats):
+        return norm(x)
+    if not isinstance(norm, nn.BatchNorm2d) or not track_running_stats:
+        return torch.cat([norm(chunk) for chunk in x.chunk(frames, dim=0)], dim=0)
+
+    NT, c, w, h = x.size()
+    n = NT // frames
+    y = x.view(frames, n, c, w * h)
+    mean = y.mean(3, keepdim=True).mean(1, keepdim=True)
+    centered = y - mean
+    var = centered.pow(2).mean(3, keepdim=True).mean(1, keepdim=True)
+    out = centered / (var + norm.eps).sqrt()
+    if norm.affine:
+        out = out * norm.weight.view(1, 1, c, 1) + norm.bias.view(1, 1, c, 1)
+
+    # --- update running statistics in closed form
+    num_batches = getattr(norm, 'num_batches_tracked', None)
+    if norm.momentum is None:  # cumulative moving average
+        seen = float(num_batches)
+        decay, weights = seen / (seen + frames), [1 / (seen + frames)] * frames
+    else:
+        m = norm.momentum
+        decay, weights = (1 - m) ** frames, [m * (1 - m) ** (frames - 1 - k) for k in range(frames)]
+    weights = x.data.new(weights).view(frames, 1)
+    n_elem = n * w * h
+    batch_mean = mean.data.view(frames, c)
+    batch_var = var.data.view(frames, c) * n_elem / max(n_elem - 1, 1)
+    norm.running_mean.mul_(decay).add_((weights * batch_mean).sum(0))
+    norm.running_var.mul_(decay).add_((weights * batch_var).sum(0))
+    if num_batches is not None:
+        num_batches += frames
+
+    return out.view(NT, c, w, h)
+
+
+def framewise(layer, x, frames):
+    """
+    Applies a sequential layer to a time-major batch with `frames` frames folded into the batch dimension,
+    using framewise_batch_norm for its batch norm modules.
+    """
+    for module in layer.children():
+        x = framewise_batch_norm(module, x, frames) if isinstance(module, nn.modules.batchnorm._BatchNorm) \
+            else module(x)
+    return x
+
+
+@contextmanager
+def frozen_batch_norm_stats(module):
+    """
+    Restores the running statistics of all batch norm layers in module on exit. Used when checkpointed
+    segments are recomputed in the backward pass, so that their statistics are only updated once.
+    """
+    norms = [m for m in module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm)]
+    saved = [{k: b.clone() for k, b in m._buffers.items() if b is not None} for m in norms]
+    yield
+    for m, buffers in zip(norms, saved):
+        for k, b in buffers.items():
+            m._buffers[k].copy_(b)
+
+
+def checkpointing(module):
+    """
+    Returns: True if activations of module should be checkpointed in the current forward pass
+    """
+    return checkpoint is not None and module.training and torch.is_grad_enabled()
+
+
+def run_checkpointed(module, function, *args):
+    """
+    Runs function(*args) with activation checkpointing: its intermediate activations are not stored but
+    recomputed in the backward pass, with the batch norm statistics of module frozen.
+    """
+
+    def run(dummy, *args):
+        if torch.is_grad_enabled():  # recomputation during the backward pass
+            with frozen_batch_norm_stats(module):
+                return function(*args)
+        return function(*args)
+
+    # checkpoint only propagates gradients to the parameters if one of its inputs requires a gradient
+    dummy = torch.ones(1, requires_grad=True)
+    return checkpoint(run, dummy, *args)
+
+
 class Core(Messager):
     def initialize(self):
         self.msg('Not initializing anything')
 
+    def output_shape(self, in_shape):
+        """
+        Infers the output shape of the core for inputs of shape in_shape (without batch dimension).
+        This generic version runs a random input through the core. Subclasses compute it analytically.
+        """
+        training = self.training
+        self.eval()
+        with no_grad():
+            out = self(torch.randn(1, *in_shape)).size()[1:]
+        self.train(training)
+        return tuple(out)
+
     def __repr__(self):
         s = super().__repr__()
         s += ' [{} regularizers: '.format(self.__class__.__name__)
@@ -70,6 +226,9 @@ class IdentityCore(nn.Module, Core2d):
     def forward(self, x):
         return x
 
+    def output_shape(self, in_shape):
+        return tuple(in_shape)
+
     def regularizer(self):
         return 0.0
 
@@ -147,9 +306,9 @@ class NetGardCore(nn.Module, Messager):
         return out_shapes
 
     def get_state_shapes(self, img_shape):
-        tmp = Variable(torch.zeros(1, *img_shape[-3:]), volatile=True)
         self.unit.eval()
-        _, state = self.unit(tmp)
+        with no_grad():
+            _, state = self.unit(torch.zeros(1, *img_shape[-3:]))
         self.unit.train()
         shapes = {k: v.size()[1:] for k, v in state.items()}
         return shapes
@@ -235,14 +394,28 @@ class Stacked2dCore(Core2d, nn.Module):
 
         self.apply(self.init_conv)
 
-    def forward(self, input_):
+    def forward(self, input_, frames=None):
+        """
+        Args:
+            input_: input batch
+            frames: if not None, input_ contains that many time-major frames folded into the batch dimension
+                    (see fold_time). Batch norm then uses separate statistics for every frame, such that the
+                    output equals applying the core to each frame separately.
+        """
         ret = []
         for l, feat in enumerate(self.features):
             do_skip = l >= 1 and self.skip > 1
-            input_ = feat(input_ if not do_skip else torch.cat(ret[-min(self.skip, l):], dim=1))
+            x = input_ if not do_skip else torch.cat(ret[-min(self.skip, l):], dim=1)
+            input_ = feat(x) if frames is None else framewise(feat, x, frames)
             ret.append(input_)
         return torch.cat(ret, dim=1)
 
+    def output_shape(self, in_shape):
+        shape = tuple(in_shape)
+        for feat in self.features:
+            shape = conv_output_shape(feat.conv, shape)
+        return (self.outchannels,) + shape[1:]
+
     def laplace(self):
         return self._input_weights_regularizer(self.features[0].conv.weight)
 
@@ -281,7 +454,7 @@ class Conv3dLinearCore(nn.Sequential, Core3d):
         self.norm = nn.BatchNorm3d(hidden_channels, momentum=momentum)
 
     def laplace_l2(self):
-        return self._input_weight_regularizer.cuda()(self.conv.weight)
+        return self._input_weight_regularizer(self.conv.weight)
 
     def regularizer(self):
         return self.laplace_l2() * self.gamma_input
@@ -289,6 +462,9 @@ class Conv3dLinearCore(nn.Sequential, Core3d):
     def forward(self, input):
         return self.norm(self.conv(input))
 
+    def output_shape(self, in_shape):
+        return conv_output_shape(self.conv, in_shape)
+
 
 class Conv3dCore(nn.Sequential, Core3d):
     def __init__(self, input_channels=1, input_kern=5, hidden_kern=3, channels=32, dilation=1,
@@ -323,13 +499,17 @@ class Conv3dCore(nn.Sequential, Core3d):
                             )
             dilation += progress
 
+    def layer(self, l):
+        # indexing the Sequential would count laplace_reg as a layer
+        return getattr(self, 'layer{}'.format(l))
+
     def laplace_l2(self):
-        return self.laplace_reg.cuda()(self.mod0[0].weight)
+        return self.laplace_reg(self.layer(0)[0].weight)
 
     def group_sparsity(self):
         ret = 0
         for l in range(1, self.layers):
-            ret = ret + self[l][0].weight.pow(2).sum(3, keepdim=True).sum(2, keepdim=True).sqrt().mean()
+            ret = ret + self.layer(l)[0].weight.pow(2).sum(3, keepdim=True).sum(2, keepdim=True).sqrt().mean()
         return ret
 
     def regularizer(self):
@@ -338,18 +518,25 @@ class Conv3dCore(nn.Sequential, Core3d):
     def forward(self, input):
         ret = []
         for l in range(self.layers):
-            input = self[l](input)
+            input = self.layer(l)(input)
             ret.append(input)
         return torch.cat(ret, dim=1)
 
+    def output_shape(self, in_shape):
+        shape = tuple(in_shape)
+        for l in range(self.layers):
+            shape = conv_output_shape(self.layer(l)[0], shape)
+        return (self.layers * shape[0],) + shape[1:]
+
 
 class Stacked3dCore(Core3d, nn.Module):
     def __init__(self, input_channels, hidden_channels, input_kern, hidden_kern, layers=3,
                  gamma_hidden=0, gamma_input=0., skip=0, final_nonlinearity=True, bias=False,
-                 momentum=0.1, pad_input=False, dilation=1, normalize=True, **kwargs):
+                 momentum=0.1, pad_input=False, dilation=1, normalize=True, checkpoint_layers=None, **kwargs):
         self.msg('Ignoring input', kwargs, 'when creating', self.__class__.__name__)
         super().__init__()
         self._input_weights_regularizer = LaplaceL23d()
+        self.checkpoint_layers = checkpoint_layers
 
         self.layers = layers
         self.gamma_input = gamma_input
@@ -405,13 +592,37 @@ class Stacked3dCore(Core3d, nn.Module):
         self.apply(self.init_conv)
 
     def forward(self, input_):
+        if self.checkpoint_layers is None or not checkpointing(self):
+            return torch.cat(self._run_layers(0, len(self.features), input_), dim=1)
+
+        # run groups of checkpoint_layers layers with activation checkpointing; every group gets the
+        # outputs of the previous layers it needs for the skip connections
         ret = []
-        for l, feat in enumerate(self.features):
-            do_skip = l >= 1 and self.skip > 1
-            input_ = feat(input_ if not do_skip else torch.cat(ret[-min(self.skip, l):], dim=1))
-            ret.append(input_)
+        for start in range(0, len(self.features), self.checkpoint_layers):
+            stop = min(start + self.checkpoint_layers, len(self.features))
+            prev = (input_,) if start == 0 else tuple(ret[-max(self.skip, 1):])
+            # bind start and stop now, the group is recomputed in the backward pass after the loop finished
+            ret.extend(run_checkpointed(self, partial(self._run_layers, start, stop), *prev))
         return torch.cat(ret, dim=1)
 
+    def _run_layers(self, start, stop, *prev):
+        """
+        Runs layers start to stop-1 given the outputs of the preceding layers (or the input if start is 0).
+
+        Returns: tuple with the outputs of the layers
+        """
+        ret = list(prev)
+        for l in range(start, stop):
+            do_skip = l >= 1 and self.skip > 1
+            ret.append(self.features[l](ret[-1] if not do_skip else torch.cat(ret[-min(self.skip, l):], dim=1)))
+        return tuple(ret[len(prev):])
+
+    def output_shape(self, in_shape):
+        shape = tuple(in_shape)
+        for feat in self.features:
+            shape = conv_output_shape(feat.conv, shape)
+        return (self.outchannels,) + shape[1:]
+
     def laplace(self):
         return self._input_weights_regularizer(self.features[0].conv.weight)
 
@@ -460,10 +671,18 @@ class ConvGRUCell(RNNCore, nn.Module, Messager):
 
         rec_padding = rec_kern // 2
         input_padding = input_kern // 2 if pad_input else 0
+        self.rec_padding = rec_padding
+        self.input_padding = input_padding
         self.rec_channels = rec_channels
         self._shrinkage = 0 if pad_input else input_kern - 1
 
         self.gamma_rec = gamma_rec
+        self._build_gates(input_channels, rec_channels, input_kern, rec_kern, input_padding, rec_padding)
+
+        self.apply(self.init_conv)
+        self.register_parameter('_prev_state', None)
+
+    def _build_gates(self, input_channels, rec_channels, input_kern, rec_kern, input_padding, rec_padding):
         self.reset_gate_input = nn.Conv2d(input_channels, rec_channels, input_kern, padding=input_padding)
         self.reset_gate_hidden = nn.Conv2d(rec_channels, rec_channels, rec_kern, padding=rec_padding)
 
@@ -473,20 +692,25 @@ class ConvGRUCell(RNNCore, nn.Module, Messager):
         self.out_gate_input = nn.Conv2d(input_channels, rec_channels, input_kern, padding=input_padding)
         self.out_gate_hidden = nn.Conv2d(rec_channels, rec_channels, rec_kern, padding=rec_padding)
 
-        self.apply(self.init_conv)
-        self.register_parameter('_prev_state', None)
+    def output_shape(self, in_shape):
+        _, *spatial_size = in_shape
+        return (self.rec_channels,) + tuple(s - self._shrinkage for s in spatial_size)
 
-    def init_state(self, input_):
+    def build_state(self, batch_size, spatial_size, device=None):
+        """
+        Creates the learned initial hidden state for inputs of the given batch and spatial size.
+        Does nothing if the state already exists.
+        """
         if self._prev_state is None:
             self.msg('Initializing first hidden state', depth=1)
-            batch_size, _, *spatial_size = input_.data.size()
             state_size = [batch_size, self.rec_channels] + [s - self._shrinkage for s in spatial_size]
-            prev_state = torch.zeros(*state_size)
-            if input_.is_cuda:
-                prev_state = prev_state.cuda()
-            self._prev_state = Parameter(prev_state)
+            self._prev_state = Parameter(torch.zeros(*state_size, device=device))
         return self._prev_state
 
+    def init_state(self, input_):
+        batch_size, _, *spatial_size = input_.data.size()
+        return self.build_state(batch_size, spatial_size, device=input_.device)
+
     def forward(self, input_, prev_state):
         # get batch and spatial sizes
 
@@ -506,6 +730,26 @@ class ConvGRUCell(RNNCore, nn.Module, Messager):
 
         return new_state
 
+    def precompute(self, input_):
+        """
+        Computes everything that depends on the input only. The result can be computed for all frames at once
+        and is passed to step.
+        """
+        return input_
+
+    def step(self, precomputed, prev_state):
+        return self(precomputed, prev_state)
+
+    def fused_weights(self):
+        """
+        Returns: weight and bias of the input gates (reset, update, out) and of the hidden gates (reset, update),
+                 concatenated along the output channels as in FusedConvGRUCell.
+        """
+        inputs = [self.reset_gate_input, self.update_gate_input, self.out_gate_input]
+        hidden = [self.reset_gate_hidden, self.update_gate_hidden]
+        return torch.cat([g.weight for g in inputs], 0), torch.cat([g.bias for g in inputs], 0), \
+               torch.cat([g.weight for g in hidden], 0), torch.cat([g.bias for g in hidden], 0)
+
     def regularizer(self):
         return self.gamma_rec * self.bias_l1()
 
@@ -515,21 +759,122 @@ class ConvGRUCell(RNNCore, nn.Module, Messager):
                self.out_gate_hidden.bias.abs().mean() / 3
 
 
+class FusedConvGRUCell(ConvGRUCell):
+    """
+    ConvGRUCell that computes the reset, update, and output convolutions of the input as one convolution
+    with three times the output channels and the reset and update convolutions of the hidden state as
+    one convolution with twice the output channels.
+
+    The weights are stored in that order along the output channels. Use fuse_state_dict and
+    unfuse_state_dict to convert from and to the state dict of a ConvGRUCell.
+    """
+    _input_gates = ('reset_gate_input', 'update_gate_input', 'out_gate_input')
+    _hidden_gates = ('reset_gate_hidden', 'update_gate_hidden')
+
+    def _build_gates(self, input_channels, rec_channels, input_kern, rec_kern, input_padding, rec_padding):
+        self.input_gates = nn.Conv2d(input_channels, 3 * rec_channels, input_kern, padding=input_padding)
+        self.hidden_gates = nn.Conv2d(rec_channels, 2 * rec_channels, rec_kern, padding=rec_padding)
+        self.out_gate_hidden = nn.Conv2d(rec_channels, rec_channels, rec_kern, padding=rec_padding)
+
+    def init_conv(self, m):
+        # initialize every gate as if it was a separate convolution
+        if isinstance(m, nn.Conv2d):
+            for w in m.weight.data.split(self.rec_channels, dim=0):
+                xavier_normal(w)
+            if m.bias is not None:
+                init.constant(m.bias.data, 0.)
+
+    def precompute(self, input_):
+        return self.input_gates(input_)
+
+    def step(self, gates, prev_state):
+        """
+        Args:
+            gates:      output of precompute for the current frame
+            prev_state: previous hidden state or None
+
+        Returns: new hidden state
+
+        """
+        if prev_state is None:
+            batch_size, _, *spatial_size = gates.data.size()
+            prev_state = self.build_state(batch_size, [s + self._shrinkage for s in spatial_size],
+                                          device=gates.device)
+        reset_input, update_input, out_input = gates.chunk(3, dim=1)
+        reset_hidden, update_hidden = self.hidden_gates(prev_state).chunk(2, dim=1)
+
+        update = F.sigmoid(update_input + update_hidden)
+        reset = F.sigmoid(reset_input + reset_hidden)
+
+        h_t = F.tanh(out_input + self.out_gate_hidden(prev_state * reset))
+        return prev_state * (1 - update) + h_t * update
+
+    def forward(self, input_, prev_state):
+        return self.step(self.precompute(input_), prev_state)
+
+    def fused_weights(self):
+        return self.input_gates.weight, self.input_gates.bias, self.hidden_gates.weight, self.hidden_gates.bias
+
+    def bias_l1(self):
+        c = self.rec_channels
+        return self.hidden_gates.bias[:c].abs().mean() / 3 + \
+               self.hidden_gates.weight[c:].abs().mean() / 3 + \
+               self.out_gate_hidden.bias.abs().mean() / 3
+
+    @classmethod
+    def fuse_state_dict(cls, state_dict):
+        """
+        Converts the ConvGRUCell weights in a (model) state dict to the layout of FusedConvGRUCell.
+        Entries that do not belong to a ConvGRUCell are left unchanged.
+
+        Args:
+            state_dict: dictionary of tensors
+
+        Returns: converted state dict
+
+        """
+        state_dict = OrderedDict(state_dict)
+        for prefix in [k[:-len('reset_gate_input.weight')] for k in list(state_dict)
+                       if k.endswith('reset_gate_input.weight')]:
+            for fused, gates in [('input_gates', cls._input_gates), ('hidden_gates', cls._hidden_gates)]:
+                for param in ['weight', 'bias']:
+                    parts = [state_dict.pop('{}{}.{}'.format(prefix, g, param)) for g in gates]
+                    state_dict['{}{}.{}'.format(prefix, fused, param)] = torch.cat(parts, dim=0)
+        return state_dict
+
+    @classmethod
+    def unfuse_state_dict(cls, state_dict):
+        """
+        Inverse of fuse_state_dict.
+        """
+        state_dict = OrderedDict(state_dict)
+        for prefix in [k[:-len('input_gates.weight')] for k in list(state_dict)
+                       if k.endswith('input_gates.weight')]:
+            for fused, gates in [('input_gates', cls._input_gates), ('hidden_gates', cls._hidden_gates)]:
+                for param in ['weight', 'bias']:
+                    parts = state_dict.pop('{}{}.{}'.format(prefix, fused, param)).chunk(len(gates), 0)
+                    for g, part in zip(gates, parts):
+                        state_dict['{}{}.{}'.format(prefix, g, param)] = part.clone()
+        return state_dict
+
+
 class FeatureGRUCell(RNNCore, nn.Module):
     _BaseFeatures = None
 
     def __init__(self, input_channels, hidden_channels, rec_channels,
                  input_kern, hidden_kern, rec_kern, layers,
-                 gamma_input, gamma_hidden, gamma_rec, momentum, **kwargs):
+                 gamma_input, gamma_hidden, gamma_rec, momentum, fused=False, **kwargs):
         super().__init__()
+        self.fused = fused
         self.features = self._BaseFeatures(input_channels, hidden_channels, input_kern, hidden_kern,
                                            layers=layers, momentum=momentum,
                                            gamma_input=gamma_input, gamma_hidden=gamma_hidden, **kwargs)
-        self.gru = ConvGRUCell(self.features.outchannels,
-                               rec_channels=rec_channels,
-                               input_kern=rec_kern,
-                               rec_kern=rec_kern,
-                               gamma_rec=gamma_rec, **kwargs)
+        GRUCell = FusedConvGRUCell if fused else ConvGRUCell
+        self.gru = GRUCell(self.features.outchannels,
+                           rec_channels=rec_channels,
+                           input_kern=rec_kern,
+                           rec_kern=rec_kern,
+                           gamma_rec=gamma_rec, **kwargs)
 
     def forward(self, x, prev_state=None):
         return self.gru(self.features(x), prev_state)
@@ -539,31 +884,91 @@ class FeatureGRUCell(RNNCore, nn.Module):
 
 
 class FeatureGRUCore(Core3d, nn.Module):
+    """
+    Stack of 2d convolutions on every frame followed by a convolutional GRU.
+
+    Args:
+        fused:              use FusedConvGRUCell. Its state dict is converted with FusedConvGRUCell.fuse_state_dict.
+        checkpoint_frames:  if not None, training runs in segments of that many frames whose activations are
+                            recomputed in the backward pass instead of being stored (activation checkpointing)
+
+    If compiled is True, the time loop runs as TorchScript (see _scripted) if available.
+    """
     _cell = None
+    compiled = False
+    recurrent = True
 
     def __init__(self, input_channels, hidden_channels, rec_channels,
                  input_kern, hidden_kern, rec_kern, layers=2,
-                 gamma_hidden=0, gamma_input=0, gamma_rec=0, momentum=.1, bias=True, **kwargs):
+                 gamma_hidden=0, gamma_input=0, gamma_rec=0, momentum=.1, bias=True, fused=False,
+                 checkpoint_frames=None, **kwargs):
         super().__init__()
+        self.checkpoint_frames = checkpoint_frames
         self.cell = self._cell(input_channels, hidden_channels, rec_channels,
                                input_kern, hidden_kern, rec_kern, layers=layers,
                                gamma_input=gamma_input, gamma_hidden=gamma_hidden, gamma_rec=gamma_rec,
-                               momentum=momentum, bias=bias, **kwargs)
+                               momentum=momentum, bias=bias, fused=fused, **kwargs)
 
     def regularizer(self):
         return self.cell.regularizer()
 
-    def forward(self, input):
+    def output_shape(self, in_shape):
+        """
+        Computes the output shape for inputs of shape in_shape = (channels, time, *spatial). This also
+        creates the learned initial hidden state, so that it is registered before optimizers are built.
+        """
+        c, t, *spatial_size = in_shape
+        feature_shape = self.cell.features.output_shape((c,) + tuple(spatial_size))
+        self.cell.gru.build_state(1, feature_shape[1:])
+        rec_channels, *out_size = self.cell.gru.output_shape(feature_shape)
+        return (rec_channels, t) + tuple(out_size)
+
+    def forward(self, input, state=None, return_state=False):
+        """
+        Args:
+            input:          input movie of shape (batch, channels, time, width, height)
+            state:          hidden state to start from (default: learned initial state)
+            return_state:   also return the hidden state after the last frame
+
+        Returns: output of shape (batch, channels, time, width, height) and, if requested, the last hidden state
+
+        """
+        if self.checkpoint_frames is not None and checkpointing(self):
+            out, hidden = self._checkpointed_forward(input, state)
+        else:
+            out, hidden = self._forward(input, state)
+        return (out, hidden) if return_state else out
+
+    def _checkpointed_forward(self, input, state):
+        N, c, d, w, h = input.size()
+        if state is None:
+            spatial_size = self.cell.features.output_shape((c, w, h))[1:]
+            state = self.cell.gru.build_state(1, spatial_size, device=input.device).expand(N, -1, -1, -1)
+        outputs = []
+        for start in range(0, d, self.checkpoint_frames):
+            out, state = run_checkpointed(self, self._forward, input[:, :, start:start + self.checkpoint_frames],
+                                          state)
+            outputs.append(out)
+        return torch.cat(outputs, 2), state
+
+    def _forward(self, input, state):
         N, _, d, w, h = input.size()
         states = []
-        hidden = None
+        hidden = state
+
+        # the feedforward features do not depend on the hidden state and run on all frames at once
+        x = self.cell.features(fold_time(input), frames=d)
+        if self.compiled and _scripted.available():
+            states = _scripted.conv_gru_sequence(self.cell.gru, x.view(d, N, *x.size()[1:]), hidden)
+            return states.permute(1, 2, 0, 3, 4).contiguous(), states[-1]
 
-        x = input.transpose(1, 2).transpose(0, 1)
+        x = self.cell.gru.precompute(x)
+        x = x.view(d, N, *x.size()[1:])
 
-        for t in range(x.size(0)):
-            hidden = self.cell(x[t, ...], hidden)
+        for t in range(d):
+            hidden = self.cell.gru.step(x[t, ...], hidden)
             states.append(hidden)
-        return torch.stack(states, 2)
+        return torch.stack(states, 2), hidden
 
 
 class StackedGRUCell(FeatureGRUCell):
@@ -576,25 +981,36 @@ class StackedFeatureGRUCore(FeatureGRUCore):
 
 # ------------- Static Cores -----------------------------
 class StaticCore(Core3d, nn.Module):
+    """
+    Applies a 2d core to every frame of a movie.
+
+    Args:
+        micro_batch: maximal number of images (batch size times frames) the 2d core processes in one call.
+                     If None, all frames of the batch are processed at once. Smaller values bound the memory
+                     of the intermediate activations when no gradients are computed.
+    """
     _BaseFeatures = None
 
     def __init__(self, input_channels, hidden_channels, input_kern, hidden_kern, layers,
-                 gamma_input, gamma_hidden, momentum, **kwargs):
+                 gamma_input, gamma_hidden, momentum, micro_batch=None, **kwargs):
         super().__init__()
+        self.micro_batch = micro_batch
         self.features = self._BaseFeatures(input_channels, hidden_channels, input_kern, hidden_kern,
                                            layers=layers, momentum=momentum,
                                            gamma_input=gamma_input, gamma_hidden=gamma_hidden, **kwargs)
 
     def forward(self, input):
         N, _, d, w, h = input.size()
-        states = []
+        x = fold_time(input)
 
-        x = input.transpose(1, 2).transpose(0, 1)
+        frames = d if self.micro_batch is None else max(1, min(d, self.micro_batch // N))
+        outputs = [self.features(chunk, frames=chunk.size(0) // N) for chunk in x.split(frames * N, dim=0)]
+        return unfold_time(torch.cat(outputs, dim=0) if len(outputs) > 1 else outputs[0], d)
 
-        for t in range(x.size(0)):
-            output = self.features(x[t, ...])
-            states.append(output)
-        return torch.stack(states, 2)
+    def output_shape(self, in_shape):
+        c, t, *spatial_size = in_shape
+        channels, *out_size = self.features.output_shape((c,) + tuple(spatial_size))
+        return (channels, t) + tuple(out_size)
 
     def regularizer(self):
         return self.features.regularizer()
@@ -0,0 +1,35 @@
+import torch
+from torch import nn
+
+
+class SubsetPoissonLoss3d(nn.Module):
+    """
+    Poisson loss as attorch.losses.PoissonLoss3d between the predictions for a subset of neurons and the
+    responses of these neurons. The responses are gathered after dropping the lag frames, so that no tensor
+    over all neurons is built next to the targets.
+
+    Args:
+        bias:       added to the predictions inside the logarithm
+        per_neuron: return the loss of every neuron instead of the mean
+    """
+
+    def __init__(self, bias=1e-16, per_neuron=False):
+        super().__init__()
+        self.bias = bias
+        self.per_neuron = per_neuron
+
+    def forward(self, output, target, subs_idx=None):
+        """
+        Args:
+            output:     predictions of shape (batch, time, neurons in subs_idx)
+            target:     responses of shape (batch, time + lag, all neurons)
+            subs_idx:   indices of the predicted neurons (default: all)
+        """
+        lag = target.size(1) - output.size(1)
+        target = target[:, lag:, :]
+        if torch.is_tensor(subs_idx):
+            target = target.index_select(2, subs_idx)
+        elif subs_idx is not None:
+            target = target[..., subs_idx]
+        loss = output - target * torch.log(output + self.bias)
+        return loss.mean() if not self.per_neuron else loss.view(-1, loss.size(-1)).mean(dim=0)
@@ -6,12 +6,27 @@ import torch
 from torch.nn import functional as F
 import torch.nn.init as init
 from attorch.regularizers import LaplaceL23d, LaplaceL2
-from torch.autograd import Variable
 from attorch.module import ModuleDict
 from ..utils.logging import Messager
+from . import _scripted
+
+
+def subset_linear(linear, x, subs_idx=None):
+    """
+    Applies linear to x and returns the outputs subs_idx (default: all). A float nn.Linear only uses the rows
+    subs_idx of its weight. Quantized modules, whose weight is packed, compute all outputs and select.
+    """
+    if subs_idx is None or callable(linear.weight):
+        out = linear(x)
+        return out if subs_idx is None else out[..., subs_idx]
+    bias = linear.bias[subs_idx] if linear.bias is not None else None
+    return F.linear(x, linear.weight[subs_idx], bias)
 
 
 class GateGRU(nn.Module, Messager):
+    compiled = False
+    recurrent = True
+
     def __init__(self, neurons, input_channels=3, hidden_channels=5, bias=True, offset=0, **kwargs):
         super().__init__()
         self.msg('Ignoring input', kwargs, 'when creating', self.__class__.__name__, depth=1)
@@ -24,31 +39,67 @@ class GateGRU(nn.Module, Messager):
         subs_idx = subs_idx if subs_idx is not None else slice(None)
         return self.linear.weight[subs_idx, :].abs().mean()
 
-    def initialize_state(self, batch_size, hidden_size, cuda):
-        state_size = [batch_size, hidden_size]
-        state = Variable(torch.zeros(*state_size))
-        if cuda:
-            state = state.cuda()
-        return state
+    def initialize_state(self, batch_size, hidden_size, device=None):
+        return torch.zeros(batch_size, hidden_size, device=device)
 
-    def forward(self, input, readoutput=None, subs_idx=None):
+    def project(self, hidden, subs_idx=None):
+        """
+        Linear map of the hidden states to the neurons subs_idx (default: all)
+        """
+        return subset_linear(self.linear, hidden, subs_idx)
+
+    def modulation(self, input, state=None, return_state=False, subs_idx=None, frames=None):
+        """
+        Computes the multiplicative modulation of the neurons subs_idx (default: all) from the behavior.
+
+        Args:
+            input:          behavior of shape (batch, time, features)
+            state:          hidden state to start from (default: zeros)
+            return_state:   also return the hidden state after the last frame
+            subs_idx:       neurons to modulate
+            frames:         only compute the modulation of the last frames (default: all). The GRU still runs
+                            over all frames.
+
+        Returns: modulation of shape (batch, frames, neurons) and, if requested, the last hidden state
+
+        """
         N, T, f = input.size()
         states = []
 
-        hidden = self.initialize_state(N, self.hidden_states, input.is_cuda)
+        hidden = self.initialize_state(N, self.hidden_states, input.device) if state is None else state
         x = input.transpose(0, 1)
-        for t in range(T):
-            hidden = self.gru(x[t, ...], hidden)
-            states.append(self.linear(hidden))
+        frames = T if frames is None else frames
+        if self.compiled and _scripted.available():
+            hiddens = _scripted.gru_sequence(self.gru, x, hidden)
+            hidden = hiddens[-1]
+            states = self.project(hiddens[T - frames:].transpose(0, 1), subs_idx)
+        else:
+            for t in range(T):
+                hidden = self.gru(x[t, ...], hidden)
+                if t >= T - frames:
+                    states.append(self.project(hidden, subs_idx))
+            states = torch.stack(states, 1)
+        states = torch.exp(states)
+        return (states, hidden) if return_state else states
+
+    def apply_modulation(self, modulation, readoutput, subs_idx=None):
+        """
+        Modulates the readout output with a modulation computed by self.modulation.
+        """
+        lag = modulation.size(1) - readoutput.size(1)
+        modulation = modulation[:, lag:, :]
+        if subs_idx is not None:
+            modulation = modulation[..., subs_idx]
+        return readoutput * (modulation + self.offset)
+
+    def forward(self, input, readoutput=None, subs_idx=None, state=None, return_state=False):
+        modulation, hidden = self.modulation(input, state=state, return_state=True)
         if readoutput is None:
             self.msg('Nothing to modulate. Returning modulation only')
-            return torch.exp(torch.stack(states, 1))
+            ret = modulation
         else:
-            lag = T - readoutput.size(1)
-        states = torch.exp(torch.stack(states, 1)[:, lag:, :])
-        if subs_idx is not None:
-            states = states[..., subs_idx]
-        return readoutput * (states + self.offset)
+            ret = self.apply_modulation(modulation, readoutput, subs_idx=subs_idx)
+        return (ret, hidden) if return_state else ret
 
 
 class MLP(nn.Module, Messager):
@@ -68,14 +119,24 @@ class MLP(nn.Module, Messager):
         for linear_layer in [p for p in self.parameters() if isinstance(p, nn.Linear)]:
             xavier_normal(linear_layer.weight)
 
-    def forward(self, input, readoutput=None):
-        mod = torch.exp(self.linear(self.mlp(input)))
+    def modulation(self, input, subs_idx=None):
+        return torch.exp(subset_linear(self.linear, self.mlp(input), subs_idx))
+
+    def apply_modulation(self, modulation, readoutput, subs_idx=None):
+        lag = modulation.size(1) - readoutput.size(1)
+        modulation = modulation[:, lag:, :]
+        if subs_idx is not None:
+            modulation = modulation[..., subs_idx]
+        return readoutput * modulation
+
+    def forward(self, input, readoutput=None, subs_idx=None):
+        mod = self.modulation(input)
 
         if readoutput is None:
             self.msg('Nothing to modulate. Returning modulation only')
             return mod
         else:
-            return readoutput * mod
+            return self.apply_modulation(mod, readoutput, subs_idx=subs_idx)
 
 
 class GRUModulator(ModuleDict, Messager):
@@ -0,0 +1,140 @@
+"""
+Post-training int8 quantization of trained models for inference on the CPU.
+
+- The convolutions of Stacked2dCore and of the ConvGRUCells are quantized statically (eager mode): every
+  convolution is wrapped into QuantizedConv, which quantizes its input, runs torch's int8 convolution kernel
+  with int8 weights (per output channel), and dequantizes the output. The activation ranges are calibrated
+  on a few batches before the conversion, so a calibration function is needed. Without one, the convolutions
+  stay in float.
+- The readout features are stored as int8 with one scale per neuron and dequantized when they are used (see
+  QuantizedSpatialTransformerPooled3d). The readouts compute a per-neuron weighted sum of their samples
+  rather than a matrix product, for which torch has no int8 kernel.
+- nn.Linear and nn.GRUCell (modulators, shifters) are quantized dynamically, i.e. their activations are
+  quantized on the fly.
+"""
+from warnings import warn
+
+import torch
+from torch import nn
+
+from .cores import Stacked2dCore, ConvGRUCell
+from ..utils.logging import Messager
+
+try:
+    from torch.ao import quantization as tq
+except ImportError:
+    try:
+        from torch import quantization as tq
+    except ImportError:
+        tq = None
+        warn('Could not import torch.quantization. Only the readouts will be quantized.')
+
+
+class _Log(Messager):
+    pass
+
+
+class QuantizedConv(nn.Module):
+    """
+    Wraps a convolution for static quantization. The input is quantized before and the output is dequantized
+    after the convolution, so the surrounding layers keep computing in float.
+    """
+
+    def __init__(self, conv):
+        super().__init__()
+        self.quant = tq.QuantStub()
+        self.conv = conv
+        self.dequant = tq.DeQuantStub()
+
+    def forward(self, x):
+        return self.dequant(self.conv(self.quant(x)))
+
+
+def quantized_engine():
+    """
+    Returns: quantized backend supported by this torch build or None
+    """
+    for engine in ('x86', 'fbgemm', 'qnnpack'):
+        if engine in torch.backends.quantized.supported_engines:
+            return engine
+    return None
+
+
+def quantizable_convs(model):
+    """
+    Yields: parent module and attribute name of every convolution of a Stacked2dCore or ConvGRUCell in model
+    """
+    for m in model.modules():
+        if isinstance(m, Stacked2dCore):
+            for feat in m.features:
+                if isinstance(feat.conv, nn.Conv2d):
+                    yield feat, 'conv'
+        elif isinstance(m, ConvGRUCell):
+            for name, child in m.named_children():
+                if isinstance(child, nn.Conv2d):
+                    yield m, name
+
+
+def quantize_convolutions(model, calibrate):
+    """
+    Statically quantizes the convolutions of model in place (see module documentation).
+
+    Args:
+        model:      model in eval mode on the CPU
+        calibrate:  function that runs model on a few representative batches
+
+    Returns: number of quantized convolutions
+    """
+    engine = quantized_engine() if tq is not None else None
+    if engine is None:
+        _Log.msg('No quantized backend available. Convolutions stay in float')
+        return 0
+    torch.backends.quantized.engine = engine
+    qconfig = tq.get_default_qconfig(engine)
+
+    convs = list(quantizable_convs(model))
+    for parent, name in convs:
+        wrapped = QuantizedConv(getattr(parent, name))
+        wrapped.qconfig = qconfig
+        setattr(parent, name, wrapped)
+    if not convs:
+        return 0
+    tq.prepare(model, inplace=True)
+    with torch.no_grad():
+        calibrate(model)
+    tq.convert(model, inplace=True)
+    return len(convs)
+
+
+def quantize_model(model, calibrate=None, dtype=torch.qint8):
+    """
+    Quantizes a trained model for CPU inference (see module documentation). The model is moved to the CPU,
+    switched to eval mode, and TorchScript time loops are disabled, because they use the float weights of the
+    GRU cells.
+
+    Args:
+        model:      CorePlusReadout3d
+        calibrate:  function that runs model on a few representative batches to calibrate the activation
+                    ranges of the convolutions. If None, the convolutions are not quantized.
+        dtype:      dtype of the dynamically quantized layers
+
+    Returns: quantized model
+
+    """
+    model = model.cpu().eval()
+    for m in model.modules():
+        if hasattr(m, 'compiled'):
+            m.compiled = False
+    if hasattr(model.readout, 'quantize'):
+        model.readout.quantize()
+        _Log.msg('Stored readout features as int8')
+    if calibrate is None:
+        _Log.msg('No calibration data. Convolutions stay in float')
+    else:
+        n = quantize_convolutions(model, calibrate)
+        _Log.msg('Statically quantized', n, 'convolutions to int8 with the', torch.backends.quantized.engine,
+                 'backend')
+    if tq is not None:
+        model = tq.quantize_dynamic(model, {nn.Linear, nn.GRUCell}, dtype=dtype, inplace=True)
+        _Log.msg('Dynamically quantized linear and GRU layers to', dtype)
+    return model
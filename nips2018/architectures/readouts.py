@@ -1,4 +1,7 @@
+from collections import OrderedDict
+
 import torch
+from attorch.constraints import positive
 from attorch.layers import (SpatialXFeatureLinear, SpatialXFeatureLinear3d,
                             elu1, FullLinear,
                             SpatialTransformerPooled3d, SpatialTransformerPooled2d,
@@ -9,6 +12,7 @@ import numpy as np
 from ..utils.measures import corr
 from sklearn.linear_model import LinearRegression
 from torch import nn
+from torch.nn import functional as F
 from torch.nn.init import xavier_normal
 from tqdm import tqdm
 import warnings
@@ -31,6 +35,11 @@ class Readout(Messager):
 
 
 class FullyConnectedReadout(Readout, ModuleDict):
+    """
+    Linear readout from the full core output (attorch FullLinear). There is no low-rank version of it; see
+    LowRankSpatialTransformerPooled3d for the factorized spatial transformer readout.
+    """
+
     def __init__(self, in_shape, neurons, gamma_readout, **kwargs):
         self.msg('Ignoring input', kwargs, 'when creating', self.__class__.__name__)
         super().__init__()
@@ -158,7 +167,464 @@ class SpatialTransformerPooled2dReadout(Readout, ModuleDict):
             self[k].poolsteps = value
 
 
+def frame_grid(grid, batch_size, timesteps, shift=None):
+    """
+    Returns: readout positions grid of shape (1, neurons, 1, 2), shifted per frame, for every one of the
+             batch_size * timesteps frames
+    """
+    outdims = grid.size(1)
+    if shift is None:
+        return grid.expand(batch_size * timesteps, outdims, 1, 2)
+    grid = grid.expand(batch_size, outdims, 1, 2)
+    grid = torch.stack([grid + shift[:, i, :][:, None, None, :] for i in range(timesteps)], 1)
+    return grid.contiguous().view(-1, outdims, 1, 2)
+
+
+def pooled_samples(readout, x, grid, shift=None):
+    """
+    Samples the pooled feature maps of a SpatialTransformerPooled3d readout at the given grid positions, as
+    in the forward pass of the readout.
+
+    Args:
+        readout:    SpatialTransformerPooled3d (determines pooling steps, pooling, and gradient stopping)
+        x:          core output of shape (batch, channels, time, width, height)
+        grid:       grid positions of shape (1, neurons, 1, 2)
+        shift:      shift of the grid of shape (batch, time, 2) or None
+
+    Returns: samples of shape (batch * time, channels * (pool steps + 1), neurons)
+
+    """
+    if readout.stop_grad:
+        x = x.detach()
+    N, c, t, w, h = x.size()
+    grid = frame_grid(grid, N, t, shift=shift)
+    z = x.contiguous().transpose(2, 1).contiguous().view(-1, c, w, h)
+    pools = [F.grid_sample(z, grid)]
+    levels = readout.pool_levels if hasattr(readout, 'pool_levels') else readout.features.size(1) // c
+    for _ in range(levels - 1):
+        z = readout.avg(z)
+        pools.append(F.grid_sample(z, grid))
+    return torch.cat(pools, dim=1).squeeze(-1)
+
+
+def weight_samples(samples, features, batch_size, bias=None):
+    """
+    Computes the readout output from pooled samples.
+
+    Args:
+        samples:    output of pooled_samples
+        features:   features of shape (1, channels * (pool steps + 1), 1, neurons)
+        batch_size: batch size of the core output
+        bias:       bias of shape (neurons,) or None
+
+    Returns: output of shape (batch, time, neurons)
+
+    """
+    outdims = features.size(-1)
+    y = (samples * features.view(1, -1, outdims)).sum(1).view(batch_size, -1, outdims)
+    return y + bias if bias is not None else y
+
+
+def bilinear_samples(z, grid, channels, neurons):
+    """
+    Samples z as F.grid_sample (bilinear, zero padding, align_corners=False), but only channel channels[p] at
+    the grid position of neuron neurons[p] for every pair p.
+
+    Args:
+        z:          tensor of shape (batch, channels, height, width)
+        grid:       grid positions of shape (batch or 1, neurons, 1, 2) with (x, y) in [-1, 1]
+        channels:   channel of every pair
+        neurons:    neuron of every pair
+
+    Returns: samples of shape (batch, pairs)
+
+    """
+    B, _, H, W = z.size()
+    g = grid[:, :, 0, :].index_select(1, neurons)
+    x, y = ((g[..., 0] + 1) * W - 1) / 2, ((g[..., 1] + 1) * H - 1) / 2
+    x0, y0 = x.floor(), y.floor()
+    flat, offset = z.contiguous().view(B, -1), channels * H * W
+    ret = 0
+    for xi, yi in [(x0, y0), (x0 + 1, y0), (x0, y0 + 1), (x0 + 1, y0 + 1)]:
+        weight = (1 - (x - xi).abs()) * (1 - (y - yi).abs())
+        inside = (xi >= 0) & (xi <= W - 1) & (yi >= 0) & (yi <= H - 1)
+        idx = offset + (yi.clamp(0, H - 1) * W + xi.clamp(0, W - 1)).long()
+        ret = ret + flat.gather(1, idx.expand(B, -1)) * (weight * inside.type_as(weight))
+    return ret
+
+
+class SparseSpatialTransformerPooled3d(nn.Module):
+    """
+    Inference version of a trained SpatialTransformerPooled3d with pruned feature weights.
+
+    Feature weights with absolute value below threshold are dropped and the remaining ones are stored in CSR form
+    (row pointers per neuron, feature indices, values). Channels that no neuron uses anymore are removed from the
+    core output before pooling. Every neuron only samples the pooled channels it keeps a weight for (see
+    bilinear_samples), so sampling and weighting scale with the number of remaining weights. If all weights are
+    pruned, the readout returns its bias.
+
+    Args:
+        readout:    trained SpatialTransformerPooled3d
+        threshold:  absolute threshold on the feature weights
+    """
+
+    def __init__(self, readout, threshold=1e-3):
+        super().__init__()
+        features = readout.features.data.clone()
+        if readout.positive:
+            features.clamp_(min=0)
+        c, outdims = readout.in_shape[0], readout.outdims
+        levels = features.size(1) // c
+        features = features.view(levels, c, outdims)
+        keep = features.abs() > threshold
+
+        channels = keep.sum(2).sum(0).nonzero().view(-1)
+        features = (features * keep.type_as(features))[:, channels, :].contiguous().view(-1, outdims)
+
+        # CSR with neurons as rows; every column is a (pooling level, kept channel) pair
+        feature_idx, neuron_idx = features.t().nonzero().t()[[1, 0]]
+        counts = torch.bincount(neuron_idx, minlength=outdims)
+        self.register_buffer('channels', channels)
+        self.register_buffer('indptr', torch.cat([counts.new_zeros(1), counts.cumsum(0)]))
+        self.register_buffer('levels', feature_idx // max(len(channels), 1))
+        self.register_buffer('indices', feature_idx % max(len(channels), 1))
+        self.register_buffer('values', features[feature_idx, neuron_idx])
+        self.grid = nn.Parameter(readout.grid.data.clamp(-1, 1))
+        self.bias = nn.Parameter(readout.bias.data.clone()) if readout.bias is not None else None
+        self.avg = readout.avg
+        self.stop_grad = readout.stop_grad
+        self.positive = False  # already applied to the stored weights
+        self.pool_levels = levels
+        self.in_shape = readout.in_shape
+        self.outdims = outdims
+        self.density = float(len(feature_idx)) / (levels * c * outdims)
+
+    def neuron_index(self):
+        """
+        Returns: neuron of every stored weight (expanded from the CSR row pointers)
+        """
+        counts = self.indptr[1:] - self.indptr[:-1]
+        return torch.arange(self.outdims, device=counts.device).repeat_interleave(counts)
+
+    def forward(self, x, shift=None, subs_idx=None):
+        N, _, t, w, h = x.size()
+        y = x.new_zeros(N * t, self.outdims)
+        if len(self.values) > 0:
+            if self.stop_grad:
+                x = x.detach()
+            x = x.index_select(1, self.channels)
+            z = x.transpose(2, 1).contiguous().view(N * t, -1, w, h)
+            grid = self.grid if shift is None else frame_grid(self.grid, N, t, shift=shift)
+            neurons = self.neuron_index()
+            weighted = z.new_zeros(N * t, len(self.values))
+            for level in range(self.pool_levels):
+                if level > 0:
+                    z = self.avg(z)
+                pairs = (self.levels == level).nonzero().view(-1)
+                if len(pairs) > 0:
+                    weighted[:, pairs] = bilinear_samples(z, grid, self.indices[pairs], neurons[pairs])
+            y = y.index_add_(1, neurons, weighted * self.values)
+        y = y.view(N, t, self.outdims)
+        if self.bias is not None:
+            y = y + self.bias
+        return y[..., subs_idx] if subs_idx is not None else y
+
+    def __repr__(self):
+        return '{}({} -> {}, channels {}/{}, density {:.3f})'.format(
+            self.__class__.__name__, tuple(self.in_shape), self.outdims, len(self.channels), self.in_shape[0],
+            self.density)
+
+
+class QuantizedSpatialTransformerPooled3d(nn.Module):
+    """
+    Inference version of a trained SpatialTransformerPooled3d whose feature weights are stored as int8 with one
+    scale per neuron (symmetric quantization). The features are dequantized when they are used, so the readout
+    stores a quarter of the feature memory and computes as before.
+
+    Args:
+        readout:    trained SpatialTransformerPooled3d
+    """
+    levels = 127
+
+    def __init__(self, readout):
+        super().__init__()
+        features = readout.features.data.clone()
+        if readout.positive:
+            features.clamp_(min=0)
+        outdims = readout.outdims
+        scale = features.view(-1, outdims).abs().max(0)[0].clamp(min=1e-12) / self.levels
+        self.register_buffer('int_features', (features / scale).round().clamp(-self.levels, self.levels).char())
+        self.register_buffer('scale', scale)
+        self.grid = nn.Parameter(readout.grid.data.clamp(-1, 1))
+        self.bias = nn.Parameter(readout.bias.data.clone()) if readout.bias is not None else None
+        self.avg = readout.avg
+        self.stop_grad = readout.stop_grad
+        self.positive = False  # already applied to the stored weights
+        self.pool_levels = features.size(1) // readout.in_shape[0]
+        self.in_shape = readout.in_shape
+        self.outdims = outdims
+
+    @property
+    def features(self):
+        """
+        Returns: dequantized features of shape (1, channels * (pool steps + 1), 1, neurons)
+        """
+        return self.int_features.float() * self.scale
+
+    def forward(self, x, shift=None, subs_idx=None):
+        grid, int_features, scale, bias = self.grid, self.int_features, self.scale, self.bias
+        if torch.is_tensor(subs_idx):
+            grid, int_features = grid.index_select(1, subs_idx), int_features.index_select(3, subs_idx)
+            scale = scale.index_select(0, subs_idx)
+            bias = bias.index_select(0, subs_idx) if bias is not None else None
+        elif subs_idx is not None:
+            grid, int_features, scale = grid[:, subs_idx], int_features[..., subs_idx], scale[subs_idx]
+            bias = bias[subs_idx] if bias is not None else None
+        samples = pooled_samples(self, x, grid, shift=shift)
+        return weight_samples(samples, int_features.float() * scale, x.size(0), bias=bias)
+
+    def __repr__(self):
+        return '{}({} -> {}, int8)'.format(self.__class__.__name__, tuple(self.in_shape), self.outdims)
+
+
+class LowRankSpatialTransformerPooled3d(nn.Module):
+    """
+    SpatialTransformerPooled3d whose feature matrix (channels * (pool steps + 1) x neurons) is the product of a
+    shared basis and per-neuron coefficients of the given rank.
+
+    Since pooling and sampling are linear in the channels, the core output is projected onto the basis before
+    sampling, so only rank instead of channels maps are sampled per pooling level and neuron.
+
+    Args:
+        in_shape:       shape of the core output (channels, time, width, height)
+        outdims:        number of neurons
+        rank:           rank of the feature matrix
+        pool_steps:     number of pooling steps
+        kernel_size:    kernel size of the average pooling
+        stride:         stride of the average pooling
+        bias:           use a bias per neuron
+        init_range:     range of the initial grid positions
+        stop_grad:      do not propagate gradients into the core
+        grid:           grid parameter to share with another readout
+    """
+
+    def __init__(self, in_shape, outdims, rank, pool_steps=0, kernel_size=4, stride=4, bias=True, init_range=.05,
+                 stop_grad=False, grid=None):
+        super().__init__()
+        self.in_shape = in_shape
+        self.outdims = outdims
+        self.rank = rank
+        self.pool_steps = pool_steps
+        self.init_range = init_range
+        self.stop_grad = stop_grad
+        self.positive = False
+        c = in_shape[0]
+        self.grid = grid if grid is not None else nn.Parameter(torch.Tensor(1, outdims, 1, 2))
+        self.basis = nn.Parameter(torch.Tensor(pool_steps + 1, c, rank))
+        self.coefficients = nn.Parameter(torch.Tensor(rank, outdims))
+        self.bias = nn.Parameter(torch.Tensor(outdims)) if bias else None
+        self.avg = nn.AvgPool2d((kernel_size, kernel_size), stride=stride, count_include_pad=False)
+        self.initialize()
+
+    def initialize(self):
+        self.grid.data.uniform_(-self.init_range, self.init_range)
+        self.basis.data.normal_(0, 1 / np.sqrt(self.basis.size(1)))
+        self.coefficients.data.fill_(1 / self.basis.size(1))
+        if self.bias is not None:
+            self.bias.data.fill_(0)
+
+    @property
+    def features(self):
+        """
+        Returns: dense features of shape (1, channels * (pool steps + 1), 1, neurons) as in SpatialTransformerPooled3d
+        """
+        return self.dense_features().view(1, -1, 1, self.outdims)
+
+    def dense_features(self, subs_idx=None):
+        coefficients = self.coefficients if subs_idx is None else self.coefficients[:, subs_idx]
+        return self.basis.view(-1, self.rank).mm(coefficients)
+
+    def feature_l1(self, average=True, subs_idx=None):
+        """
+        Upper bound on the L1 norm of the features computed from the factors,
+        sum_r (sum_f |basis_fr|) (sum_n |coefficients_rn|), so the dense feature matrix is never built. The bound
+        is tight if no two rank components cancel.
+        """
+        coefficients = self.coefficients if subs_idx is None else self.coefficients[:, subs_idx]
+        basis = self.basis.view(-1, self.rank)
+        l1 = (basis.abs().sum(0) * coefficients.abs().sum(1)).sum()
+        return l1 / (basis.size(0) * coefficients.size(1)) if average else l1
+
+    @classmethod
+    def from_dense(cls, readout, rank):
+        """
+        Converts a trained SpatialTransformerPooled3d by truncated SVD of its feature matrix. The grid is copied.
+        """
+        features = readout.features.data.clone()
+        if readout.positive:
+            features.clamp_(min=0)
+        features = features.view(-1, readout.outdims)
+        rank = min(rank, *features.size())
+        c = readout.in_shape[0]
+        ro = cls(readout.in_shape, readout.outdims, rank, pool_steps=features.size(0) // c - 1,
+                 bias=readout.bias is not None, stop_grad=readout.stop_grad)
+        ro.avg = readout.avg
+        u, s, v = torch.svd(features)
+        scale = s[:rank].sqrt()
+        ro.basis.data = (u[:, :rank] * scale).contiguous().view(-1, c, rank)
+        ro.coefficients.data = (scale[:, None] * v[:, :rank].t()).contiguous()
+        ro.grid.data = readout.grid.data.clone()
+        if readout.bias is not None:
+            ro.bias.data = readout.bias.data.clone()
+        return ro
+
+    def forward(self, x, shift=None, subs_idx=None):
+        if self.stop_grad:
+            x = x.detach()
+        self.grid.data = torch.clamp(self.grid.data, -1, 1)
+        grid, coefficients, bias = self.grid, self.coefficients, self.bias
+        if subs_idx is not None:
+            grid, coefficients = grid[:, subs_idx], coefficients[:, subs_idx]
+            bias = bias[subs_idx] if bias is not None else None
+
+        N, c, t, w, h = x.size()
+        grid = frame_grid(grid, N, t, shift=shift)
+        z = x.contiguous().transpose(2, 1).contiguous().view(-1, c, w, h)
+        samples = 0
+        for l in range(self.pool_steps + 1):
+            if l > 0:
+                z = self.avg(z)
+            projected = F.conv2d(z, self.basis[l].t()[:, :, None, None])
+            samples = samples + F.grid_sample(projected, grid)
+        y = (samples.squeeze(-1) * coefficients[None]).sum(1).view(N, t, -1)
+        return y + bias if bias is not None else y
+
+    def __repr__(self):
+        return '{}({} -> {}, rank {}, pool steps {})'.format(self.__class__.__name__, tuple(self.in_shape),
+                                                             self.outdims, self.rank, self.pool_steps)
+
+
 class PooledReadout(Readout):
+    def subset_forward(self, readout_key, x, subs_idx, shift=None):
+        """
+        Output of readout readout_key for the neurons subs_idx only. Grid positions, features, and bias of these
+        neurons are gathered before sampling, so no tensor over all neurons is built.
+
+        Args:
+            readout_key:    readout to use
+            x:              core output of shape (batch, channels, time, width, height)
+            subs_idx:       tensor with neuron indices
+            shift:          shift of the grid of shape (batch, time, 2) or None
+
+        Returns: output of shape (batch, time, len(subs_idx))
+
+        """
+        ro = self[readout_key]
+        if not isinstance(ro, SpatialTransformerPooled3d):
+            return ro(x, shift=shift, subs_idx=subs_idx)
+        if ro.positive:
+            positive(ro.features)
+        ro.grid.data = torch.clamp(ro.grid.data, -1, 1)
+        samples = pooled_samples(ro, x, ro.grid.index_select(1, subs_idx), shift=shift)
+        bias = ro.bias.index_select(0, subs_idx) if ro.bias is not None else None
+        return weight_samples(samples, ro.features.index_select(3, subs_idx), x.size(0), bias=bias)
+
+    def factorize(self, rank, readout_keys=None):
+        """
+        Replaces dense SpatialTransformerPooled3d readouts by LowRankSpatialTransformerPooled3d of the given rank,
+        initialized by truncated SVD of the trained features.
+
+        Returns: self
+        """
+        for k in (readout_keys or list(self)):
+            if not isinstance(self[k], SpatialTransformerPooled3d):
+                continue
+            ro = LowRankSpatialTransformerPooled3d.from_dense(self[k], rank)
+            err = (ro.features.data - self[k].features.data).norm() / self[k].features.data.norm()
+            self.msg('Factorized', k, 'to rank', rank, 'with relative error {:.4f}'.format(float(err)), depth=1)
+            self.add_module(k, ro)
+        return self
+
+    def prune(self, threshold=1e-3, readout_keys=None):
+        """
+        Replaces the readouts by SparseSpatialTransformerPooled3d with the feature weights below threshold
+        removed. The pruned readouts are for inference only.
+
+        Args:
+            threshold:      absolute threshold on the feature weights
+            readout_keys:   readouts to prune (default: all)
+
+        Returns: self
+        """
+        for k in (readout_keys or list(self)):
+            if not isinstance(self[k], SpatialTransformerPooled3d):
+                continue
+            ro = SparseSpatialTransformerPooled3d(self[k], threshold=threshold)
+            self.msg('Pruned', k, 'to {:.1f}% of the feature weights and {}/{} channels'.format(
+                100 * ro.density, len(ro.channels), ro.in_shape[0]), depth=1)
+            self.add_module(k, ro)
+        return self
+
+    def quantize(self, readout_keys=None):
+        """
+        Replaces the readouts by QuantizedSpatialTransformerPooled3d with int8 feature weights. The quantized
+        readouts are for inference only.
+
+        Args:
+            readout_keys:   readouts to quantize (default: all)
+
+        Returns: self
+        """
+        for k in (readout_keys or list(self)):
+            if not isinstance(self[k], SpatialTransformerPooled3d):
+                continue
+            self.add_module(k, QuantizedSpatialTransformerPooled3d(self[k]))
+        return self
+
+    def multi_forward(self, x, readout_keys, shifts=None):
+        """
+        Computes the outputs of several readouts on the same core output. Readouts that use the same shift and
+        pooling are evaluated with one sampling operation for all their grid points; readouts that share a grid
+        share the samples.
+
+        Args:
+            x:              core output of shape (batch, channels, time, width, height)
+            readout_keys:   readouts to evaluate
+            shifts:         dictionary with the shift for every readout key (default: no shift)
+
+        Returns: OrderedDict with the output of every readout
+
+        """
+        shifts = shifts or {}
+        ret = OrderedDict()
+        groups = OrderedDict()
+        for k in readout_keys:
+            ro, shift = self[k], shifts.get(k)
+            if not isinstance(ro, SpatialTransformerPooled3d):
+                ret[k] = ro(x, shift=shift)
+                continue
+            if ro.positive:
+                positive(ro.features)
+            ro.grid.data = torch.clamp(ro.grid.data, -1, 1)
+            group = (id(shift), bool(ro.stop_grad), ro.features.size(1), ro.avg.kernel_size, ro.avg.stride)
+            groups.setdefault(group, []).append(k)
+
+        for keys in groups.values():
+            grids = OrderedDict()
+            for k in keys:
+                grids.setdefault(id(self[k].grid), self[k].grid)
+            offsets = np.cumsum([0] + [g.size(1) for g in grids.values()])
+            offsets = dict(zip(grids, offsets[:-1]))
+            ro0 = self[keys[0]]
+            samples = pooled_samples(ro0, x, torch.cat(list(grids.values()), 1) if len(grids) > 1
+                                     else next(iter(grids.values())), shift=shifts.get(keys[0]))
+            for k in keys:
+                ro = self[k]
+                start = int(offsets[id(ro.grid)])
+                s = samples if len(grids) == 1 else samples[..., start:start + ro.outdims]
+                ret[k] = weight_samples(s, ro.features, x.size(0), bias=ro.bias)
+        return OrderedDict((k, ret[k]) for k in readout_keys)
+
     @property
     def positive(self):
         return self._positive
@@ -206,6 +672,25 @@ class SpatialTransformerPooled3dReadout(PooledReadout, ModuleDict):
             self.add_module(k, SpatialTransformerPooled3d(in_shape, neur, positive=positive, pool_steps=pool_steps))
 
 
+class LowRankSpatialTransformerPooled3dReadout(PooledReadout, ModuleDict):
+    def __init__(self, in_shape, neurons, rank=16, gamma_features=0, pool_steps=0, kernel_size=4, stride=4,
+                 **kwargs):
+        self.msg('Ignoring input', kwargs, 'when creating', self.__class__.__name__)
+        super().__init__()
+
+        self.in_shape = in_shape
+        self.neurons = neurons
+        self._positive = False
+        self.gamma_features = gamma_features
+        self._pool_steps = pool_steps
+        self.rank = rank
+        for k, neur in neurons.items():
+            if isinstance(self.in_shape, dict):
+                in_shape = self.in_shape[k]
+            self.add_module(k, LowRankSpatialTransformerPooled3d(in_shape, neur, rank, pool_steps=pool_steps,
+                                                                  kernel_size=kernel_size, stride=stride))
+
+
 class SpatialTransformer3dSharedGridReadout(PooledReadout, ModuleDict):
     def __init__(self, in_shape, neurons, positive=False, gamma_features=0, pool_steps=0, **kwargs):
         self.msg('Ignoring input', kwargs, 'when creating', self.__class__.__name__)
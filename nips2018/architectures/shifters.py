@@ -6,9 +6,9 @@ import torch
 from torch.nn import functional as F
 import torch.nn.init as init
 from attorch.regularizers import LaplaceL23d, LaplaceL2
-from torch.autograd import Variable
 from attorch.module import ModuleDict
 from ..utils.logging import Messager
+from . import _scripted
 
 
 class Shifter(Messager):
@@ -22,6 +22,9 @@ class Shifter(Messager):
 
 
 class GRU(nn.Module, Messager):
+    compiled = False
+    recurrent = True
+
     def __init__(self, input_features=2, hidden_channels=2, bias=True, **kwargs):
         super().__init__()
         self.msg('Ignoring input', kwargs, 'when creating', self.__class__.__name__, depth=1)
@@ -41,26 +44,24 @@ class GRU(nn.Module, Messager):
             # xavier_normal(weight.data, gain=gain)
             weight.data.uniform_(-stdv, stdv)
 
-    def initialize_state(self, batch_size, hidden_size, cuda):
-        state_size = [batch_size, hidden_size]
-        state = Variable(torch.zeros(*state_size))
-        if cuda:
-            state = state.cuda()
-        return state
+    def initialize_state(self, batch_size, hidden_size, device=None):
+        return torch.zeros(batch_size, hidden_size, device=device)
 
-    def forward(self, input):
+    def forward(self, input, state=None, return_state=False):
         N, T, f = input.size()
         states = []
 
-        hidden = self.initialize_state(N, self.hidden_states, input.is_cuda)
+        hidden = self.initialize_state(N, self.hidden_states, input.device) if state is None else state
 
         x = input.transpose(0, 1)
-
-        for t in range(T):
-            hidden = self.gru(x[t, ...], hidden)
-            states.append(hidden)
-        states = torch.stack(states).transpose(0, 1)
-        return states
+        if self.compiled and _scripted.available():
+            states = _scripted.gru_sequence(self.gru, x, hidden).transpose(0, 1)
+        else:
+            for t in range(T):
+                hidden = self.gru(x[t, ...], hidden)
+                states.append(hidden)
+            states = torch.stack(states).transpose(0, 1)
+        return (states, states[:, -1]) if return_state else states
 
 
 class MLP(nn.Module, Messager):
@@ -2,28 +2,47 @@ import os
 from _operator import attrgetter
 from collections import OrderedDict, namedtuple
 from contextlib import redirect_stdout
-from itertools import chain
+from functools import partial
+from itertools import chain, islice
 from pprint import pformat
 
 import numpy as np
 import torch
-from attorch.dataset import to_variable
 from attorch.layers import Elu1
-from attorch.train import early_stopping, cycle_datasets
-from scipy.stats import stats
+from attorch.train import cycle_datasets
+from scipy.stats import stats, norm
+from torch.utils.data import DataLoader
 from tqdm import tqdm
 
 import datajoint as dj
 from .data import MovieMultiDataset
 from .parameters import CoreConfig, ReadoutConfig, Seed, ShifterConfig, ModulatorConfig, \
-    DataConfig
-from ..architectures.base import CorePlusReadout3d
+    DataConfig, CachedLoader, SubsetSequentialSampler, CACHE_MEMORY_ENV
+from ..architectures.base import CorePlusReadout3d, detach_state
+from ..architectures.cores import FusedConvGRUCell
+from ..architectures.quantization import quantize_model
+from ..utils.checkpoint import set_rng_state
+from ..utils.device import get_device, move_batch, move_batches
+from ..utils.inference import InferenceConfig, inference_mode, tune_inference
 from ..utils.logging import Messager
+from ..utils.precision import autocast, grad_scaler
+from ..utils.validation import early_stopping, async_early_stopping
 from ..utils.measures import corr
 
 PerformanceScores = namedtuple('PerformanceScores', ['pearson'])
 
 
+def cycle_batches(loaders, device=None):
+    """
+    Alternates between the batches of loaders as attorch.train.cycle_datasets and moves them to device, which
+    may be any device (e.g. cuda:1), not only the current GPU.
+
+    Yields: readout key and the tensors of the batch
+    """
+    for readout_key, data in cycle_datasets(loaders, requires_grad=False, cuda=False):
+        yield (readout_key,) + move_batch(data, device)
+
+
 def spearm(pair):
     return stats.spearmanr(*pair)[0]
 
@@ -58,6 +77,16 @@ def compute_scores(y, y_hat, axis=0):
     return PerformanceScores(pearson=pearson)
 
 
+def time_chunks(data, chunk_size):
+    """
+    Splits a batch into consecutive chunks of chunk_size frames. Movies (5d tensors) are split along
+    dimension 2, everything else along dimension 1.
+    """
+    T = data[0].size(2)
+    for start in range(0, T, chunk_size):
+        yield [d[:, :, start:start + chunk_size] if d.dim() == 5 else d[:, start:start + chunk_size] for d in data]
+
+
 class Learner(Messager):
 
     def update_key_with_validation_scores(self, key, corrs):
@@ -68,21 +97,30 @@ class Learner(Messager):
         return key
 
     @staticmethod
-    def compute_predictions(loader, model, readout_key, reshape=True, stack=True, subsamp_size=None, return_lag=False):
+    def compute_predictions(loader, model, readout_key, reshape=True, stack=True, subsamp_size=None, return_lag=False,
+                            device=None, precision=None, no_grad=True, subs_idx=None):
+        """
+        Computes the predictions of model for all batches of loader. If no_grad is True, the model runs in
+        inference mode and no autograd state is kept. If subs_idx (tensor on device) is given, only the
+        neurons subs_idx are predicted and returned.
+        """
         y, y_hat = [], []
-        for x_val, beh_val, eye_val, y_val in tqdm(to_variable(loader, filter=(True, True, True, False),
-                                                               cuda=True, volatile=True), desc='predictions'):
+        for x_val, beh_val, eye_val, y_val in tqdm(move_batches(loader, device, filter=(True, True, True, False)),
+                                                   desc='predictions'):
+            if subs_idx is not None:
+                y_val = y_val[..., subs_idx.cpu()]
             neurons = y_val.size(-1)
-            if subsamp_size is None:
-                y_mod = model(x_val, readout_key, eye_pos=eye_val, behavior=beh_val).data.cpu().numpy()
-            else:
-                y_mod = []
-                neurons = y_val.size(-1)
-                for subs_idx in slice_iter(neurons, subsamp_size):
-                    y_mod.append(
-                        model(x_val, readout_key, eye_pos=eye_val,
-                              behavior=beh_val, subs_idx=subs_idx).data.cpu().numpy())
-                y_mod = np.concatenate(y_mod, axis=-1)
+            with inference_mode(no_grad), autocast(precision, device):
+                if subs_idx is not None:
+                    y_mod = model(x_val, readout_key, eye_pos=eye_val, behavior=beh_val,
+                                  subs_idx=subs_idx).data.float().cpu().numpy()
+                elif subsamp_size is None:
+                    y_mod = model(x_val, readout_key, eye_pos=eye_val, behavior=beh_val).data.float().cpu().numpy()
+                else:
+                    # core, shifter, and modulator are computed once; only the readout runs per chunk of neurons
+                    chunks = model.forward_chunks(x_val, readout_key, slice_iter(neurons, subsamp_size),
+                                                  eye_pos=eye_val, behavior=beh_val)
+                    y_mod = np.concatenate([y.data.float().cpu().numpy() for y in chunks], axis=-1)
 
             lag = y_val.shape[1] - y_mod.shape[1]
             if reshape:
@@ -98,18 +136,35 @@ class Learner(Messager):
         else:
             return y, y_hat, lag
 
-    def compute_test_scores(self, testloaders, model, readout_key):
+    @staticmethod
+    def inference_config(model, loaders, device=None, tune=True):
+        """
+        Prepares model for evaluation. On the CPU, the thread count and memory layout are tuned on the first
+        batch of the first loader (see nips2018.utils.inference.tune_inference).
+
+        Returns: InferenceConfig whose context() disables autograd
+        """
+        if not tune or get_device(device).type != 'cpu':
+            config = InferenceConfig()
+            config.apply(model)
+            return config
+        readout_key, loader = next(iter(loaders.items()))
+        x, beh, eye, _ = next(iter(loader))
+        return tune_inference(model, readout_key, x, behavior=beh, eye_pos=eye)
+
+    def compute_test_scores(self, testloaders, model, readout_key, device=None):
         loader = testloaders[readout_key]
 
-        y, y_hat = self.compute_predictions(loader, model, readout_key, reshape=True, stack=True, subsamp_size=None)
+        y, y_hat = self.compute_predictions(loader, model, readout_key, reshape=True, stack=True, subsamp_size=None,
+                                            device=device)
         return compute_scores(y, y_hat)  # scores is a named tuple
 
-    def compute_test_score_tuples(self, key, testloaders, model):
+    def compute_test_score_tuples(self, key, testloaders, model, device=None):
         self.msg('Computing scores')
         scores, unit_scores = [], []
         for readout_key, testloader in testloaders.items():
             self.msg('for', readout_key, depth=1, flush=True)
-            perf_scores = self.compute_test_scores(testloaders, model, readout_key)
+            perf_scores = self.compute_test_scores(testloaders, model, readout_key, device=device)
 
             member_key = (MovieMultiDataset.Member() & key & dict(name=readout_key)).fetch1(dj.key)  # get other fields
             member_key.update(key)
@@ -121,7 +176,16 @@ class Learner(Messager):
             unit_scores.extend([dict(member_key, unit_id=u, pearson=c) for u, c in zip(unit_ids, perf_scores.pearson)])
         return scores, unit_scores
 
-    def get_stop_closure(self, valloaders, subsamp_size=None):
+    def get_stop_closure(self, valloaders, subsamp_size=None, device=None, precision=None, no_grad=True,
+                         estimate=None):
+        """
+        Returns: function that computes the validation correlation of a model. If estimate is not None, it is
+                 an EstimatedStopClosure with this fraction of validation trials and neurons.
+        """
+        device = get_device(device)
+        if estimate is not None:
+            return EstimatedStopClosure(self, valloaders, fraction=estimate, subsamp_size=subsamp_size,
+                                        device=device, precision=precision)
 
         def stop(mod, avg=True):
             ret = []
@@ -129,7 +193,8 @@ class Learner(Messager):
             mod.eval()
             for readout_key, loader in valloaders.items():
                 y, y_hat = self.compute_predictions(loader, mod, readout_key,
-                                                    reshape=True, stack=True, subsamp_size=subsamp_size)
+                                                    reshape=True, stack=True, subsamp_size=subsamp_size,
+                                                    device=device, precision=precision, no_grad=no_grad)
                 co = corr(y, y_hat, axis=0)
                 self.msg(readout_key, 'correlation', co.mean(), depth=1)
                 ret.append(co)
@@ -143,12 +208,33 @@ class Learner(Messager):
             mod.train(train)
             return ret
 
+        stop.valloaders = valloaders
         return stop
 
     def train(self, model, objective, optimizer, stop_closure, trainloaders, epoch=0, post_epoch_hook=None,
-              interval=1, patience=10, max_iter=10, maximize=True, tolerance=1e-6, cuda=True,
-              restore_best=True, accumulate_gradient=1
-              ):
+              interval=1, patience=10, max_iter=10, maximize=True, tolerance=1e-6, device=None,
+              restore_best=True, accumulate_gradient=1, chunk_size=None, precision=None, async_threads=None,
+              stopping_state=None, checkpoint=None):
+        """
+        Trains the model with early stopping.
+
+        If chunk_size is not None, every batch is processed in consecutive chunks of chunk_size frames
+        (truncated backpropagation through time). The objective is then called with the keyword argument
+        hidden, holding the hidden states at the end of the previous chunk (None for the first chunk),
+        and must return the objective and the new hidden states. The hidden states are detached between
+        chunks and every chunk counts as one iteration for gradient accumulation.
+
+        The batches are moved to device (see nips2018.utils.device.get_device), which must be the device of
+        the model. If precision is 'bf16' or 'fp16', the objective is computed under autocast with float32
+        parameters; float16 losses are scaled (see nips2018.utils.precision).
+
+        If async_threads is not None, the stop closure runs on snapshots of the model in a background process
+        with async_threads CPU threads while training continues (see nips2018.utils.validation). The stop
+        closure must then compute on the CPU.
+
+        The bookkeeping of early stopping is kept in the dictionary stopping_state; a filled one resumes early
+        stopping. If checkpoint is not None, it is called with the epoch after every epoch.
+        """
         self.msg('Training models with', optimizer.__class__.__name__,
                  'gradient accumulation', accumulate_gradient,
                  'and state\n', pformat(model.state, indent=5))
@@ -156,41 +242,313 @@ class Learner(Messager):
         optimizer.zero_grad()
         iteration = 0
         assert accumulate_gradient > 0, 'accumulate_gradient needs to be > 0'
-
-        for epoch, val_obj in early_stopping(model, stop_closure,
-                                             interval=interval, patience=patience,
-                                             start=epoch, max_iter=max_iter, maximize=maximize,
-                                             tolerance=tolerance, restore_best=restore_best):
+        scaler = grad_scaler(precision, device)
+        if hasattr(stop_closure, 'start'):
+            stop_closure.start(patience=patience, tolerance=tolerance, maximize=maximize)
+
+        if async_threads is not None:
+            loaders = getattr(stop_closure, 'valloaders', None)
+            assert loaders is not None and all(isinstance(l, CachedLoader) for l in loaders.values()), \
+                'asynchronous validation forks the validation loaders and needs them cached (see cache_loaders). ' \
+                'Increase {} if they do not fit.'.format(CACHE_MEMORY_ENV)
+        stopper = early_stopping if async_threads is None else partial(async_early_stopping, threads=async_threads)
+        for epoch, val_obj in stopper(model, stop_closure,
+                                      interval=interval, patience=patience,
+                                      start=epoch, max_iter=max_iter, maximize=maximize,
+                                      tolerance=tolerance, restore_best=restore_best, state=stopping_state):
             for batch_no, (readout_key, *data) in \
-                    tqdm(enumerate(cycle_datasets(trainloaders, requires_grad=False, cuda=cuda)),
+                    tqdm(enumerate(cycle_batches(trainloaders, device)),
                          desc=self.__class__.__name__.ljust(25) + '  | Epoch {}'.format(epoch)):
-                obj = objective(model, readout_key, *data)
-                obj.backward()
-                if iteration % accumulate_gradient == accumulate_gradient - 1:
-                    optimizer.step()
-                    optimizer.zero_grad()
-                iteration += 1
+                hidden = None
+                for chunk in ([data] if chunk_size is None else time_chunks(data, chunk_size)):
+                    with autocast(precision, device):
+                        if chunk_size is None:
+                            obj = objective(model, readout_key, *chunk)
+                        else:
+                            obj, hidden = objective(model, readout_key, *chunk, hidden=hidden)
+                            hidden = detach_state(hidden)
+                    scaler.scale(obj.float()).backward()
+                    if iteration % accumulate_gradient == accumulate_gradient - 1:
+                        scaler.step(optimizer)
+                        scaler.update()
+                        optimizer.zero_grad()
+                    iteration += 1
 
             if post_epoch_hook is not None:
                 model = post_epoch_hook(model, epoch)
+            if checkpoint is not None:
+                checkpoint(epoch)
         return model, epoch
 
+    def train_schedule(self, model, objective, stop_closure, trainloaders, schedule, optimizer=torch.optim.Adam,
+                       checkpointer=None, **kwargs):
+        """
+        Trains model with early stopping for every learning rate in schedule, each with a new optimizer.
+
+        If checkpointer is not None (see nips2018.utils.checkpoint.Checkpointer), the model and optimizer state,
+        the early stopping bookkeeping, the random number generator states, and the position in the schedule
+        are saved during training, and training resumes from the last saved checkpoint.
+
+        Args:
+            schedule:       learning rates
+            optimizer:      optimizer class
+            checkpointer:   Checkpointer of the model
+            **kwargs:       passed to train
+
+        Returns: trained model and the last epoch
+
+        """
+        schedule = np.atleast_1d(schedule)
+        resume = checkpointer.load() if checkpointer is not None else None
+        epoch, start_stage = 0, 0
+        if resume is not None:
+            model.load_state_dict(resume['model'])
+            set_rng_state(resume['rng'])
+            epoch, start_stage = resume['epoch'], resume['stage']
+            self.msg('Resuming from checkpoint at epoch', epoch, 'and learning rate step', start_stage)
+
+        for stage, lr in enumerate(schedule):
+            if stage < start_stage:
+                continue
+            self.msg('Training with learning rate', lr, depth=1)
+            opt = optimizer(model.parameters(), lr=lr)
+            stopping = {}
+            if resume is not None and stage == start_stage and resume['optimizer'] is not None:
+                opt.load_state_dict(resume['optimizer'])
+                stopping = resume['stopping']
+
+            def checkpoint(epoch, stage=stage, opt=opt, stopping=stopping):
+                checkpointer.save(epoch, model=model.state_dict(), optimizer=opt.state_dict(), stopping=stopping,
+                                  stage=stage)
+
+            model, epoch = self.train(model, objective, opt, stop_closure, trainloaders, epoch=epoch,
+                                      stopping_state=stopping,
+                                      checkpoint=checkpoint if checkpointer is not None else None, **kwargs)
+            if checkpointer is not None:
+                checkpointer.save(epoch, force=True, model=model.state_dict(), optimizer=None, stopping={},
+                                  stage=stage + 1)
+        return model, epoch
+
+
+def stratified_subset(labels, fraction, rng):
+    """
+    Draws fraction (at least one) of the elements with every label.
+
+    Returns: sorted positions into labels
+    """
+    ret = []
+    for label in np.unique(labels):
+        idx = np.where(labels == label)[0]
+        ret.append(rng.choice(idx, max(1, int(round(fraction * len(idx)))), replace=False))
+    return np.sort(np.hstack(ret))
+
+
+def trial_subset(loader, fraction, rng):
+    """
+    Returns: loader over fraction of the trials of loader, stratified by stimulus type
+    """
+    indices = getattr(loader, 'indices', None)
+    if indices is None:
+        indices = loader.sampler.indices
+    indices = np.asarray(indices)
+    positions = stratified_subset(loader.dataset.trial_index.type_codes[indices], fraction, rng)
+    if isinstance(loader, CachedLoader):
+        return loader.subset(positions)
+    return DataLoader(loader.dataset, sampler=SubsetSequentialSampler(indices[positions]),
+                      batch_size=loader.batch_size)
+
+
+class EstimatedStopClosure(Messager):
+    """
+    Stop closure that scores a fixed subset of the validation trials (stratified by stimulus type) and neurons
+    (stratified by quantiles of their validation correlation at the first check). The full validation only
+    runs when the upper confidence bound of the estimate could be a new best, or when another check without
+    improvement would stop training. Checks that are confidently worse than the best return the estimate,
+    capped at the best value, so early_stopping selects the same epochs as with full checks.
+
+    The estimate is the best validation correlation plus the mean difference of the per-neuron subset
+    correlations between the model and the best model. Learner.train calls start() before early stopping,
+    which makes the next check a full one, because early_stopping takes its first value as the best.
+
+    Args:
+        learner:        Learner used for the predictions
+        valloaders:     dictionary of validation loaders
+        fraction:       fraction of the trials and neurons per stratum in the subset
+        confidence:     confidence level of the interval of the estimate
+        neuron_strata:  number of correlation quantiles the neurons are stratified by
+        seed:           seed for drawing the subset
+        subsamp_size:   neuron chunk size of the full validation
+        device:         device of the model
+        precision:      precision of the predictions (see nips2018.utils.precision)
+    """
+
+    def __init__(self, learner, valloaders, fraction=.25, confidence=.95, neuron_strata=4, seed=0,
+                 subsamp_size=None, device=None, precision=None):
+        self.learner = learner
+        self.valloaders = valloaders
+        self.fraction = fraction
+        self.z = norm.ppf(.5 + confidence / 2)
+        self.neuron_strata = neuron_strata
+        self.rng = np.random.RandomState(seed)
+        self.device = get_device(device)
+        self.precision = precision
+        self.full = learner.get_stop_closure(valloaders, subsamp_size=subsamp_size, device=device,
+                                             precision=precision)
+        self.trial_loaders, self.neurons = None, None
+        self.start()
+
+    def start(self, patience=10, tolerance=1e-6, maximize=True):
+        assert maximize, 'EstimatedStopClosure only works for correlations'
+        self.patience, self.tolerance = patience, tolerance
+        self.best, self.best_subset, self.since_best = None, None, 0
+
+    def draw_subset(self, corrs):
+        """
+        Draws the trial and neuron subsets given the per-neuron validation correlations of all readouts.
+        """
+        self.trial_loaders, self.neurons = OrderedDict(), OrderedDict()
+        splits = np.cumsum([loader.dataset.n_neurons for loader in self.valloaders.values()])[:-1]
+        for (readout_key, loader), co in zip(self.valloaders.items(), np.split(corrs, splits)):
+            self.trial_loaders[readout_key] = trial_subset(loader, self.fraction, self.rng)
+            edges = np.percentile(co, np.linspace(0, 100, self.neuron_strata + 1)[1:-1])
+            idx = stratified_subset(np.digitize(co, edges), self.fraction, self.rng)
+            self.neurons[readout_key] = torch.from_numpy(idx).to(self.device)
+            self.msg(readout_key, 'estimate on {} trials and {} neurons'.format(
+                len(self.trial_loaders[readout_key]), len(idx)), depth=1)
+
+    def subset_scores(self, mod):
+        train = mod.training
+        mod.eval()
+        ret = []
+        for readout_key, loader in self.trial_loaders.items():
+            y, y_hat = self.learner.compute_predictions(loader, mod, readout_key, device=self.device,
+                                                        precision=self.precision, subs_idx=self.neurons[readout_key])
+            ret.append(corr(y, y_hat, axis=0))
+        mod.train(train)
+        ret = np.hstack(ret)
+        ret[np.isnan(ret)] = 0
+        return ret
+
+    def full_check(self, mod, scores=None):
+        corrs = self.full(mod, avg=False)
+        if self.neurons is None:
+            self.draw_subset(corrs)
+        value = corrs.mean()
+        if self.best is None or value > self.best + self.tolerance:
+            self.best, self.since_best = value, 0
+            self.best_subset = self.subset_scores(mod) if scores is None else scores
+        else:
+            self.since_best += 1
+        return value
+
+    def __call__(self, mod, avg=True):
+        if not avg:
+            return self.full(mod, avg=False)
+        if self.best is None:
+            return self.full_check(mod)
+        scores = self.subset_scores(mod)
+        diff = scores - self.best_subset
+        mean, half = diff.mean(), self.z * diff.std(ddof=1) / np.sqrt(len(diff))
+        self.msg('estimated correlation {:.4f} [{:.4f}, {:.4f}], best {:.4f}'.format(
+            self.best + mean, self.best + mean - half, self.best + mean + half, self.best), depth=1)
+        if mean + half > self.tolerance or self.since_best + 1 >= self.patience:
+            return self.full_check(mod, scores)
+        self.since_best += 1
+        return min(self.best + mean, self.best)
+
 
 class Model:
+    # entries of the stored model blob that hold the shapes of the model instead of parameters
+    _shape_fields = ('_img_shape', '_n_neurons')
+
     def best_modulo(self):
         raise NotImplementedError('This function needs to be implemented by the subclasses')
 
-    def load_model(self, key=None, img_shape=None, n_neurons=None):
+    @staticmethod
+    def pack_model(model):
+        """
+        Converts the model into a dictionary of numpy arrays for storage. Next to the state dict, it contains
+        the input shape and readout sizes the model was built with, so that it can be rebuilt without loading
+        the data. Fused GRU weights are stored in the layout of ConvGRUCell.
+        """
+        state_dict = FusedConvGRUCell.unfuse_state_dict(model.state_dict())
+        ret = {k: v.cpu().numpy() for k, v in state_dict.items()}
+        ret['_img_shape'] = np.array(model.img_shape, dtype=np.int64)
+        ret['_n_neurons'] = np.array(list(model.n_neurons.values()), dtype=np.int64)
+        return ret
+
+    def stored_shapes(self, key, state_dict):
+        """
+        Recovers the input shape and readout sizes from a stored model blob.
+
+        Args:
+            key:        key of the model
+            state_dict: stored model blob as dictionary of numpy arrays
+
+        Returns: img_shape and n_neurons or None, None if the blob does not contain them
+
+        """
+        if not all(k in state_dict for k in self._shape_fields):
+            return None, None
+        img_shape = tuple(int(s) for s in state_dict['_img_shape'].ravel())
+        names = MovieMultiDataset().member_names(key)
+        n_neurons = OrderedDict(zip(names, (int(n) for n in state_dict['_n_neurons'].ravel())))
+        return img_shape, n_neurons
+
+    @staticmethod
+    def calibration(key, batches=4):
+        """
+        Returns: function that runs a model on the first batches of every validation loader of key, to calibrate
+                 the activation ranges of a quantized model (see architectures.quantization)
+        """
+        _, loaders = DataConfig().load_data(key, tier='validation', batch_size=1)
+
+        def calibrate(model):
+            for readout_key, loader in loaders.items():
+                for x, beh, eye, _ in islice(loader, batches):
+                    model(x, readout_key, eye_pos=eye, behavior=beh)
+
+        return calibrate
+
+    def load_model(self, key=None, img_shape=None, n_neurons=None, fused_gates=False, quantize=False, prune=None):
+        """
+        Loads a stored model.
+
+        Args:
+            key:            key of the model. If None, self must contain exactly one model.
+            img_shape:      input shape (inferred from the stored model or the data if None)
+            n_neurons:      dictionary with readout sizes (inferred from the stored model or the data if None)
+            fused_gates:    build recurrent cores with FusedConvGRUCell and convert the stored weights
+            quantize:       quantize the model to int8 for CPU inference (see architectures.quantization),
+                            calibrated on the validation set. The model is returned on the CPU. Check the
+                            accuracy with validate_quantization.
+            prune:          if not None, prune the readout feature weights below this absolute value and store
+                            the readouts in sparse form for inference (see PooledReadout.prune)
+
+        Returns: model with the stored weights
+
+        """
         if key is None:
             key = self.fetch1(dj.key)
-        model = self.build_model(key, img_shape=img_shape, n_neurons=n_neurons)
         state_dict = (self & key).fetch1('model')
-        state_dict = {k: torch.from_numpy(state_dict[k][0]) for k in state_dict.dtype.names}
+        state_dict = {k: state_dict[k][0] for k in state_dict.dtype.names}
+        if img_shape is None and n_neurons is None:
+            img_shape, n_neurons = self.stored_shapes(key, state_dict)
+        core_kwargs = dict(fused=True) if fused_gates else None
+        model = self.build_model(key, img_shape=img_shape, n_neurons=n_neurons, core_kwargs=core_kwargs)
+        state_dict = {k: torch.from_numpy(v) for k, v in state_dict.items() if k not in self._shape_fields}
+        if fused_gates:
+            state_dict = FusedConvGRUCell.fuse_state_dict(state_dict)
         mod_state_dict = model.state_dict()
         for k in set(mod_state_dict) - set(state_dict):
             self.msg('Could not find paramater', k, 'setting to initialization value', depth=1)
             state_dict[k] = mod_state_dict[k]
         model.load_state_dict(state_dict)
+        if prune is not None:
+            assert hasattr(model.readout, 'prune'), 'readout does not support pruning'
+            model.readout.prune(threshold=prune)
+        if quantize:
+            model = quantize_model(model, calibrate=self.calibration(key))
         return model
 
     @property
@@ -211,7 +569,7 @@ class CorePlusReadoutModel(Model):
                 h.remove(e)
         return self * dj.U(*h).aggr(self.proj('val_corr'), max_val='max(val_corr)') & 'val_corr = max_val'
 
-    def build_model(self, key=None, img_shape=None, n_neurons=None, burn_in=15):
+    def build_model(self, key=None, img_shape=None, n_neurons=None, burn_in=15, core_kwargs=None):
         """
         Builds a specified model
         Args:
@@ -219,6 +577,10 @@ class CorePlusReadoutModel(Model):
                     be non-empty so that key can be inferred.
             img_shape: image shape to figure out the size of the readouts
             n_neurons: dictionary with readout sizes (number of neurons)
+            core_kwargs: additional keyword arguments for the core constructor (e.g. fused=True)
+
+        If img_shape and n_neurons are both None, they are inferred by loading the training data. Stored
+        models carry both (see pack_model), so load_model does not need the data.
 
         Returns:
             an uninitialized MultiCNN
@@ -233,7 +595,7 @@ class CorePlusReadoutModel(Model):
             n_neurons = OrderedDict([(k, v.n_neurons) for k, v in trainsets.items()])
             img_shape = list(trainsets.values())[0].img_shape
 
-        core = CoreConfig().build(img_shape[1], key)
+        core = CoreConfig().build(img_shape[1], key, **(core_kwargs or {}))
 
         ro_in_shape = CorePlusReadout3d.get_readout_in_shape(core, img_shape)
         readout = ReadoutConfig().build(ro_in_shape, n_neurons, key)
@@ -243,5 +605,8 @@ class CorePlusReadoutModel(Model):
         modulator = ModulatorConfig().build(n_neurons, input_channels=3, key=key)
 
         # --- initialize
-        return CorePlusReadout3d(core, readout, nonlinearity=Elu1(), shifter=shifter,
-                                 modulator=modulator, burn_in=burn_in)
+        model = CorePlusReadout3d(core, readout, nonlinearity=Elu1(), shifter=shifter,
+                                  modulator=modulator, burn_in=burn_in)
+        model.img_shape = tuple(img_shape)
+        model.n_neurons = OrderedDict(n_neurons)
+        return model
@@ -1,15 +1,18 @@
 from itertools import product
 
 import numpy as np
-import torch
-from attorch.dataloaders import RepeatsBatchSampler
+from attorch.layers import SpatialTransformerPooled3d
+from tqdm import tqdm
 
 import datajoint as dj
 from .._utils import Learner
 from ..data import MovieMultiDataset
 from ..models import Encoder
-from ..parameters import DataConfig
+from ..parameters import DataConfig, RepeatsBatchSampler
 from ..transforms import Subsequence
+from ...architectures.readouts import pooled_samples, weight_samples
+from ...utils.device import get_device, move_batches
+from ...utils.inference import inference_mode
 from ...utils.git import gitlog
 from ...utils.measures import corr
 
@@ -40,19 +43,45 @@ def poisson(y, y_hat, bias=1e-16):
     return (y_hat - y * np.log(y_hat + bias)).mean(axis=0)
 
 
+class StreamingScores:
+    """
+    Accumulates per-neuron sums over batches of responses and predictions of shape (samples, neurons), from
+    which pearson and poisson are computed as on the stacked arrays, without keeping the batches.
+    """
+
+    def __init__(self):
+        self.n, self.sums = 0, None
+
+    def update(self, y, y_hat, bias=1e-16):
+        y, y_hat = y.double(), y_hat.double()
+        sums = [y.sum(0), y_hat.sum(0), (y * y).sum(0), (y_hat * y_hat).sum(0), (y * y_hat).sum(0),
+                (y_hat - y * (y_hat + bias).log()).sum(0)]
+        self.sums = sums if self.sums is None else [a + b for a, b in zip(self.sums, sums)]
+        self.n += y.size(0)
+
+    def pearson(self, eps=1e-8):
+        # same as corr(y, y_hat, axis=0)
+        n = self.n
+        sy, sh, syy, shh, syh, _ = [s.cpu().numpy() for s in self.sums]
+        std_y = np.sqrt(np.maximum(syy - sy ** 2 / n, 0) / (n - 1))
+        std_h = np.sqrt(np.maximum(shh - sh ** 2 / n, 0) / (n - 1))
+        return (syh / n - sy * sh / n ** 2) / ((std_y + eps) * (std_h + eps))
+
+    def poisson(self):
+        return self.sums[5].cpu().numpy() / self.n
+
+
 def make_loaders_repeated(loaders):
     for k, loader in loaders.items():
         ix = loader.sampler.indices
-        dataset = loader.dataset
-        condition_hashes = dataset.condition_hashes
         loader.sampler = None
-        loader.batch_sampler = RepeatsBatchSampler(condition_hashes, subset_index=ix)
+        loader.batch_sampler = RepeatsBatchSampler(loader.dataset.trial_index, subset_index=ix)
     return loaders
 
 
 class PerformanceMeasurer(Learner):
     def compute_test_score_tuples(self, key, testloaders, model, scorers, reshape=False, stack=True, subsamp_size=250,
-                                  readout_keys=None):
+                                  readout_keys=None, device=None):
         self.msg('Computing ', *scorers)
         scores, unit_scores = [], []
         if readout_keys is None:
@@ -64,28 +93,44 @@ class PerformanceMeasurer(Learner):
             loader = testloaders[readout_key]
 
             y, y_hat = self.compute_predictions(loader, model, readout_key,
-                                                reshape=reshape, stack=stack, subsamp_size=subsamp_size)
+                                                reshape=reshape, stack=stack, subsamp_size=subsamp_size,
+                                                device=device)
+            member_key, ukeys = self.score_tuples(key, readout_key, testloader, y, y_hat, scorers)
+            scores.append(member_key)
+            unit_scores.extend(ukeys)
+        return scores, unit_scores
+
+    @staticmethod
+    def score_tuples(key, readout_key, loader, y, y_hat, scorers):
+        """
+        Scores predictions y_hat of responses y of the dataset readout_key.
 
-            score_vals = {}
-            for score_name, score in scorers.items():
-                score_vals[score_name] = score(y, y_hat)
+        Returns: tuple for the dataset and list of tuples for every unit
+        """
+        score_vals = {score_name: score(y, y_hat) for score_name, score in scorers.items()}
+        return PerformanceMeasurer.tuples_from_scores(key, readout_key, loader, score_vals)
 
-            member_key = (MovieMultiDataset.Member() & key & dict(name=readout_key)).fetch1(dj.key)  # get other fields
-            member_key.update(key)
-            unit_ids = testloader.dataset.neurons.unit_ids
-            member_key['neurons'] = len(unit_ids)
+    @staticmethod
+    def tuples_from_scores(key, readout_key, loader, score_vals):
+        """
+        Returns: tuple for the dataset and list of tuples for every unit from a dictionary of per-unit scores
+        """
+        member_key = (MovieMultiDataset.Member() & key & dict(name=readout_key)).fetch1(dj.key)  # get other fields
+        member_key.update(key)
+        unit_ids = loader.dataset.neurons.unit_ids
+        member_key['neurons'] = len(unit_ids)
 
-            for score_name, val in score_vals.items():
-                member_key[score_name] = val.mean()
-            scores.append(member_key)
+        for score_name, val in score_vals.items():
+            member_key[score_name] = val.mean()
 
-            for i, u in enumerate(unit_ids):
-                ukey = dict(member_key, unit_id=u)
+        unit_scores = []
+        for i, u in enumerate(unit_ids):
+            ukey = dict(member_key, unit_id=u)
 
-                for score_name, val in score_vals.items():
-                    ukey[score_name] = val[i]
-                unit_scores.append(ukey)
-        return scores, unit_scores
+            for score_name, val in score_vals.items():
+                ukey[score_name] = val[i]
+            unit_scores.append(ukey)
+        return member_key, unit_scores
 
 
 @schema
@@ -144,13 +189,17 @@ class XPearson(dj.Computed, PerformanceMeasurer):
         self.msg('Testing model trained on', orig_data, 'on', test_data)
 
         testsets, testloaders = DataConfig().load_data(data_key, tier='test')
-        model = Encoder().load_model(key).cuda()
+        device = get_device()
+        model = Encoder().load_model(key).to_device(device)
         model.eval()
+        config = self.inference_config(model, testloaders, device=device)
 
         self.insert1(key)
         self.log_git(key)
-        scores, unit_scores = self.compute_test_score_tuples(key, testloaders, model, {'pearson': pearson},
-                                                             reshape=False, stack=True, subsamp_size=None)
+        with config.context():
+            scores, unit_scores = self.compute_test_score_tuples(key, testloaders, model, {'pearson': pearson},
+                                                                 reshape=False, stack=True, subsamp_size=None,
+                                                                 device=device)
         self.Scores().insert(scores, ignore_extra_fields=True)
         self.UnitScores().insert(unit_scores, ignore_extra_fields=True)
 
@@ -204,28 +253,77 @@ class ReadoutConvexComination(dj.Computed, PerformanceMeasurer):
         testsets, testloaders = DataConfig().load_data(data_key, tier='train')  # we check the loss on the training set
         for rok, testset in testsets.items():
             testset.transforms = [tr for tr in testset.transforms if not isinstance(tr, Subsequence)]
-        model = Encoder().load_model(key).cuda()
+        device = get_device()
+        model = Encoder().load_model(key).to_device(device)
         model.eval()
 
         assert len(model.readout) == 3, 'only test on triple models'
 
         movie, noise, all = model.readout.keys()
-        all0 = torch.cuda.FloatTensor(model.readout[all].features.data)
-        dma = torch.cuda.FloatTensor(model.readout[movie].features.data - all0)
-        dna = torch.cuda.FloatTensor(model.readout[noise].features.data - all0)
-
         self.insert1(key)
         self.log_git(key)
-        for lmov, lnoi in map(lambda t: tuple(float(tt) for tt in t),
-                              zip(*Grid().fetch('lambda_movies', 'lambda_noise'))):
+        grid = list(map(lambda t: tuple(float(tt) for tt in t), zip(*Grid().fetch('lambda_movies', 'lambda_noise'))))
+
+        if isinstance(model.readout[all], SpatialTransformerPooled3d) and not model.readout[all].positive:
+            # the readout is linear in the features: compute the core and the three readouts once per batch and
+            # score their combinations for all grid points
+            accumulators = self.combination_scores(testloaders[all], model, [movie, noise, all], all, grid,
+                                                   device=device)
+            for (lmov, lnoi), acc in zip(grid, accumulators):
+                keyins = dict(key, lambda_movies=lmov, lambda_noise=lnoi)
+                scores, _ = self.tuples_from_scores(keyins, all, testloaders[all],
+                                                    {'poisson': acc.poisson(), 'pearson': acc.pearson()})
+                self.msg('Testing @ movie={} and noise={}: pearson={pearson} and poisson={poisson}'.format(
+                    lmov, lnoi, **scores))
+                self.Scores().insert1(scores, ignore_extra_fields=True)
+            return
+
+        all0 = model.readout[all].features.data.clone()
+        dma = model.readout[movie].features.data - all0
+        dna = model.readout[noise].features.data - all0
+        for lmov, lnoi in grid:
             model.readout[all].features.data = all0 + lmov * dma + lnoi * dna
             keyins = dict(key, lambda_movies=lmov, lambda_noise=lnoi)
             scores, unit_scores = self.compute_test_score_tuples(keyins, testloaders, model,
                                                                  {'poisson': poisson, 'pearson': pearson},
                                                                  reshape=False, stack=True,
                                                                  subsamp_size=None,
-                                                                 readout_keys=[all])
+                                                                 readout_keys=[all], device=device)
             assert len(scores) == 1, 'Returned more than one scores dict'
             self.msg('Testing @ movie={} and noise={}: pearson={pearson} and poisson={poisson}'.format(
                 lmov, lnoi, **scores[0]))
             self.Scores().insert(scores, ignore_extra_fields=True)
+
+    @staticmethod
+    def combination_scores(loader, model, readout_keys, readout_key, grid, device=None):
+        """
+        Scores the predictions of readout_key with features all + lambda_movies * (movie - all)
+        + lambda_noise * (noise - all) for every (lambda_movies, lambda_noise) in grid, where movie, noise, all
+        are the features of readout_keys. Every batch runs the core and samples at the grid positions of
+        readout_key once; the outputs of the three feature sets are combined for all grid points and scored
+        batch by batch.
+
+        Returns: list with a StreamingScores per grid point
+        """
+        ro = model.readout[readout_key]
+        accumulators = [StreamingScores() for _ in grid]
+        for x_val, beh_val, eye_val, y_val in tqdm(move_batches(loader, device, filter=(True, True, True, False)),
+                                                   desc='readouts'):
+            timesteps = x_val.size(2)
+            with inference_mode():
+                x, _ = model.core_stage(x_val)
+                x = model.drop_burn_in(x, timesteps)
+                shift, _ = model.shift_stage(x, readout_key, eye_val)
+                modulation, _ = model.modulation_stage(readout_key, beh_val, frames=x.size(2))
+                samples = pooled_samples(ro, x, ro.grid, shift=shift)
+                movie, noise, all = [weight_samples(samples, model.readout[k].features, x.size(0))
+                                     for k in readout_keys]
+                y = None
+                for (lambda_movies, lambda_noise), acc in zip(grid, accumulators):
+                    out = all + lambda_movies * (movie - all) + lambda_noise * (noise - all) + ro.bias
+                    out = model.output_stage(out, readout_key, timesteps, modulation=modulation, burn_in=False)
+                    if y is None:
+                        lag = y_val.size(1) - out.size(1)
+                        y = y_val[:, lag:, :].contiguous().view(-1, out.size(-1)).to(out.device)
+                    acc.update(y, out.contiguous().view(-1, out.size(-1)))
+        return accumulators
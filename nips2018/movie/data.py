@@ -125,12 +125,19 @@ class MovieMultiDataset(dj.Manual, Messager):
         name                    : varchar(50) unique # string description to be used for training
         """
 
+    _member_order = 'animal_id ASC, session ASC, scan_idx ASC, preproc_id ASC'
+
+    def member_names(self, key):
+        """
+        Returns the names of the datasets in the group, in the order in which fetch_data returns them.
+        """
+        return list((self.Member() & key).fetch('name', order_by=self._member_order))
+
     def fetch_data(self, key, key_order=None):
         assert len(self & key) == 1, 'Key must refer to exactly one multi dataset'
         ret = OrderedDict()
         self.msg('Fetching data for\n', pformat(key, indent=10))
-        for mkey in (self.Member() & key).fetch(dj.key,
-                                                order_by='animal_id ASC, session ASC, scan_idx ASC, preproc_id ASC'):
+        for mkey in (self.Member() & key).fetch(dj.key, order_by=self._member_order):
             name = (self.Member() & mkey).fetch1('name')
             include_behavior = bool(Eye() * Treadmill() & mkey)
             data_names = ['inputs', 'responses'] if not include_behavior \
@@ -170,6 +177,98 @@ class AttributeTransformer:
             return ret
 
 
+class TrialIndex:
+    """
+    Categorical index over the trial metadata of a dataset. Stimulus types, tiers, and condition
+    hashes are stored as integer codes into the sorted unique values, so that constraints and
+    repeat groups can be computed with vectorized integer comparisons instead of string comparisons.
+
+    Constraints are expressed in the same language as the stimulus types of the data configurations:
+    a `|`-separated list of clauses, each of which is a stimulus type (e.g. `stimulus.Clip`) or a
+    negated stimulus type (e.g. `~stimulus.Clip`).
+
+    Args:
+        types:              stimulus type per trial
+        tiers:              tier per trial
+        condition_hashes:   condition hash per trial
+    """
+
+    def __init__(self, types, tiers, condition_hashes):
+        self.type_names, self.type_codes = np.unique(types, return_inverse=True)
+        self.tier_names, self.tier_codes = np.unique(tiers, return_inverse=True)
+        self.condition_names, self.condition_codes = np.unique(condition_hashes, return_inverse=True)
+        self._constraints = {}
+        self._repeat_groups = {}
+
+    def __len__(self):
+        return len(self.type_codes)
+
+    def __repr__(self):
+        return 'TrialIndex m={}: {} types, {} tiers, {} conditions'.format(
+            len(self), len(self.type_names), len(self.tier_names), len(self.condition_names))
+
+    @staticmethod
+    def _code(names, value):
+        """
+        Returns the code of value in the sorted array names or -1 if value does not occur.
+        """
+        i = np.searchsorted(names, value)
+        return int(i) if i < len(names) and names[i] == value else -1
+
+    def type_code(self, stimulus_type):
+        return self._code(self.type_names, stimulus_type)
+
+    def tier_code(self, tier):
+        return self._code(self.tier_names, tier)
+
+    def query(self, stimulus_type, tier=None):
+        """
+        Computes a boolean mask over trials that match a stimulus type constraint and an optional tier.
+
+        Args:
+            stimulus_type:  constraint like "stimulus.Clip", "~stimulus.Clip", or "stimulus.Clip|~stimulus.Clip"
+            tier:           tier (e.g. "train") or None for all tiers
+
+        Returns: boolean array with one entry per trial (a copy that can be modified by the caller)
+
+        """
+        query = (stimulus_type, tier)
+        if query not in self._constraints:
+            constraint = np.zeros(len(self), dtype=bool)
+            for const in map(lambda s: s.strip(), stimulus_type.split('|')):
+                if const.startswith('~'):
+                    constraint |= self.type_codes != self.type_code(const[1:])
+                else:
+                    constraint |= self.type_codes == self.type_code(const)
+            if tier is not None:
+                constraint &= self.tier_codes == self.tier_code(tier)
+            self._constraints[query] = constraint
+        return self._constraints[query].copy()
+
+    def repeat_groups(self, subset_index=None):
+        """
+        Groups trials with the same condition hash. Groups are ordered by condition hash and the trials
+        within a group keep the order of subset_index, which matches the batches of attorch's
+        RepeatsBatchSampler.
+
+        Args:
+            subset_index: indices of the trials to group (default: all trials)
+
+        Returns: list of lists of trial indices
+
+        """
+        subset_index = np.arange(len(self)) if subset_index is None else np.asarray(subset_index)
+        cache_key = subset_index.tobytes()
+        if len(subset_index) == 0:
+            return []
+        if cache_key not in self._repeat_groups:
+            codes = self.condition_codes[subset_index]
+            order = np.argsort(codes, kind='mergesort')
+            bounds = np.flatnonzero(np.diff(codes[order])) + 1
+            self._repeat_groups[cache_key] = [g.tolist() for g in np.split(subset_index[order], bounds)]
+        return self._repeat_groups[cache_key]
+
+
 class MovieSet(H5SequenceSet):
     def __init__(self, filename, *data_keys, transforms=None, cache_raw=False, stats_source=None):
         super().__init__(filename, *data_keys, transforms=transforms)
@@ -177,6 +276,32 @@ class MovieSet(H5SequenceSet):
         self.cache_raw = cache_raw
         self.last_raw = None
         self.stats_source = stats_source if stats_source is not None else 'all'
+        self._trial_index = None
+
+    @property
+    def trial_index(self):
+        if self._trial_index is None:
+            self._trial_index = TrialIndex(self.types, self.tiers, self.condition_hashes)
+        return self._trial_index
+
+    def view(self, transforms=None):
+        """
+        Returns a lightweight copy of the dataset that shares the file handle, the statistics, and the
+        trial index with this dataset but has its own list of transforms.
+
+        Args:
+            transforms: transforms of the view (default: no transforms)
+
+        Returns: MovieSet
+
+        """
+        self.trial_index  # build the index before copying so that all views share it
+        ret = self.__class__.__new__(self.__class__)
+        ret.__dict__.update(self.__dict__)
+        ret.transforms = list(transforms) if transforms is not None else []
+        ret.shuffle_dims = dict(self.shuffle_dims)
+        ret.last_raw = None
+        return ret
 
     @property
     def n_neurons(self):
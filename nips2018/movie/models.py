@@ -1,18 +1,25 @@
 from collections import OrderedDict
-from itertools import repeat
 from pprint import pformat
 
 import numpy as np
 import torch
 from attorch.losses import PoissonLoss3d
+from torch.utils.data import DataLoader
 
 import datajoint as dj
 from ._utils import Learner, CorePlusReadoutModel
-from .parameters import Seed, DataConfig, ConfigBase
+from .parameters import Seed, DataConfig, ConfigBase, cache_loaders
+from .transforms import Subsequence
 from .parameters import schema as parameter_schema
+from ..architectures.losses import SubsetPoissonLoss3d
 from ..utils import set_seed
+from ..utils.checkpoint import Checkpointer
+from ..utils.device import get_device
+from ..utils.inference import inference_mode
+from ..utils.measures import corr
 from ..utils.git import gitlog
 from ..utils.logging import Messager
+from ..utils.precision import check_precision
 
 schema = dj.schema('nips2018_models', locals())
 
@@ -44,7 +51,10 @@ class TrainConfig(ConfigBase, dj.Lookup, Messager):
             yield dict(batch_size=5, n_subsample_test=2000,
                        schedule=np.array([0.005, 0.001]), acc_gradient=1, max_epoch=500)
 
-        def train(self, key, trainloaders, valloaders, n_neurons):
+        def train(self, key, trainloaders, valloaders, n_neurons, core_kwargs=None, device=None, precision=None,
+                  estimate=None, async_threads=None, checkpointer=None, cache_memory=None):
+            device = get_device(device)
+            check_precision(precision, device)
             img_shape = list(trainloaders.values())[0].dataset.img_shape
 
             max_neurons = np.max(list(n_neurons.values()))
@@ -63,25 +73,30 @@ class TrainConfig(ConfigBase, dj.Lookup, Messager):
 
             # --- set some parameters
 
-            criterion = PoissonLoss3d()
+            criterion = SubsetPoissonLoss3d()
 
             def full_objective(model, readout_key, inputs, beh, eye_pos, targets):
                 if n_subsample is not None:
-                    subs_idx, _ = torch.randperm(n_neurons[readout_key])[:n_subsample].cuda().sort()
+                    subs_idx, _ = torch.randperm(n_neurons[readout_key])[:n_subsample].to(device).sort()
                 else:
                     subs_idx = slice(None)
 
                 outputs = model(inputs, readout_key, eye_pos=eye_pos, behavior=beh, subs_idx=subs_idx)
-                return criterion(outputs, targets[..., subs_idx]) \
+                return criterion(outputs.float(), targets, subs_idx) \
                        + model.core.regularizer() \
                        + model.readout.regularizer(readout_key, subs_idx=subs_idx) \
                        + (model.shifter.regularizer(readout_key) if model.shift else 0) \
                        + (model.modulator.regularizer(readout_key, subs_idx=subs_idx) if model.modulate else 0)
 
             # --- initialize
-            stop_closure = Encoder().get_stop_closure(valloaders, subsamp_size=n_subsample_test)
-
-            model = Encoder().build_model(key, img_shape=img_shape, n_neurons=n_neurons)
+            # the background validation process runs on the CPU and cannot share open data files
+            if cache_memory is not None or async_threads is not None:
+                valloaders = cache_loaders(valloaders, max_memory=cache_memory)
+            stop_closure = Encoder().get_stop_closure(valloaders, subsamp_size=n_subsample_test,
+                                                      device=device if async_threads is None else 'cpu',
+                                                      precision=precision, estimate=estimate)
+
+            model = Encoder().build_model(key, img_shape=img_shape, n_neurons=n_neurons, core_kwargs=core_kwargs)
             mu_dict = {k: dl.dataset.mean_trial().responses for k, dl in trainloaders.items()}
             model.readout.initialize(mu_dict)
             model.core.initialize()
@@ -90,24 +105,19 @@ class TrainConfig(ConfigBase, dj.Lookup, Messager):
                 model.shifter.initialize(bias=biases)
             if model.modulator is not None:
                 model.modulator.initialize()
-            self.msg('Shipping model to GPU')
-            model = model.cuda()
+            self.msg('Shipping model to', device)
+            model = model.to_device(device)
             print(model)
 
-            epoch = 0
             # --- train core, modulator, and readout but not shifter
-            schedule = key['schedule']
             self.msg('Full training'.ljust(30, '-'))
-            for opt, lr in zip(repeat(torch.optim.Adam), schedule):
-                self.msg('Training with learning rate', lr, depth=1)
-                optimizer = opt(model.parameters(), lr=lr)
-
-                model, epoch = Encoder().train(model, full_objective, optimizer,
-                                               stop_closure, trainloaders,
-                                               epoch=epoch, max_iter=key['max_epoch'],
-                                               interval=max_neurons // n_subsample * 20 if n_subsample is not None else 20,
-                                               patience=10, accumulate_gradient=key['acc_gradient']
-                                               )
+            model, epoch = Encoder().train_schedule(model, full_objective, stop_closure, trainloaders,
+                                                    key['schedule'], checkpointer=checkpointer, device=device,
+                                                    max_iter=key['max_epoch'],
+                                                    interval=max_neurons // n_subsample * 20 if n_subsample is not None else 20,
+                                                    patience=10, accumulate_gradient=key['acc_gradient'],
+                                                    precision=precision, async_threads=async_threads
+                                                    )
             model.eval()
             return model
 
@@ -141,7 +151,8 @@ class TrainConfig(ConfigBase, dj.Lookup, Messager):
             yield dict(batch_size=8, schedule=np.array([0.005]), acc_gradient=1, max_epoch=8)
             yield dict(batch_size=8, schedule=np.array([0.005]), acc_gradient=1, max_epoch=16)
 
-        def train(self, key, trainloaders, valloaders, n_neurons):
+        def train(self, key, trainloaders, valloaders, n_neurons, device=None, checkpointer=None):
+            device = get_device(device)
             img_shape = list(trainloaders.values())[0].dataset.img_shape
 
             # set some parameters
@@ -158,7 +169,7 @@ class TrainConfig(ConfigBase, dj.Lookup, Messager):
             n_subsample_test = key['n_subsample_test']
 
             # --- get model
-            stop_closure = Encoder().get_stop_closure(valloaders, subsamp_size=n_subsample_test)
+            stop_closure = Encoder().get_stop_closure(valloaders, subsamp_size=n_subsample_test, device=device)
 
             model = Encoder().build_model(key, img_shape=img_shape, n_neurons=n_neurons)
             mu_dict = OrderedDict([
@@ -176,7 +187,7 @@ class TrainConfig(ConfigBase, dj.Lookup, Messager):
                 outputs = model(inputs, readout_key, eye_pos=eye_pos, behavior=beh)
                 return (criterion(outputs, targets) / n_datasets \
                         + model.core.regularizer() / n_datasets \
-                        + model.readout.regularizer(readout_key).cuda(0) \
+                        + model.readout.regularizer(readout_key).to(device) \
                         + (model.shifter.regularizer(readout_key) if model.shift else 0) \
                         + (model.modulator.regularizer(readout_key) if model.modulate else 0)) / acc
 
@@ -189,28 +200,19 @@ class TrainConfig(ConfigBase, dj.Lookup, Messager):
             if model.modulator is not None:
                 model.modulator.initialize()
 
-            self.msg('Shipping model to GPU')
-            model = model.cuda()
+            self.msg('Shipping model to', device)
+            model = model.to_device(device)
             print(model)
 
-            epoch = 0
             # --- train core, modulator, and readout but not shifter
-            schedule = key['schedule']
-            if not isinstance(schedule, np.ndarray):
-                schedule = np.array([schedule])
             self.msg('Full training')
-            for opt, lr in zip(repeat(torch.optim.Adam), schedule):
-                self.msg('Training with learning rate', lr, depth=1)
-                optimizer = opt(model.parameters(), lr=lr)
-
-                model, epoch = Encoder().train(model, full_objective, optimizer,
-                                               stop_closure, trainloaders,
-                                               epoch=epoch,
-                                               max_iter=key['max_epoch'],
-                                               interval=min(key['max_epoch'], 4),
-                                               patience=4,
-                                               accumulate_gradient=acc * n_datasets
-                                               )
+            model, epoch = Encoder().train_schedule(model, full_objective, stop_closure, trainloaders,
+                                                    key['schedule'], checkpointer=checkpointer, device=device,
+                                                    max_iter=key['max_epoch'],
+                                                    interval=min(key['max_epoch'], 4),
+                                                    patience=4,
+                                                    accumulate_gradient=acc * n_datasets
+                                                    )
             model.eval()
             return model
 
@@ -234,7 +236,8 @@ class TrainConfig(ConfigBase, dj.Lookup, Messager):
             yield dict(batch_size=8, n_subsample_test=500,
                        schedule=np.array([0.005, 0.001]), acc_gradient=1, max_epoch=500)
 
-        def train(self, key, trainloaders, valloaders, n_neurons):
+        def train(self, key, trainloaders, valloaders, n_neurons, device=None, checkpointer=None):
+            device = get_device(device)
             img_shape = list(trainloaders.values())[0].dataset.img_shape
 
             # set some parameters
@@ -251,7 +254,7 @@ class TrainConfig(ConfigBase, dj.Lookup, Messager):
             n_subsample_test = key['n_subsample_test']
 
             # --- get model
-            stop_closure = Encoder().get_stop_closure(valloaders, subsamp_size=n_subsample_test)
+            stop_closure = Encoder().get_stop_closure(valloaders, subsamp_size=n_subsample_test, device=device)
 
             model = Encoder().build_model(key, img_shape=img_shape, n_neurons=n_neurons)
             mu_dict = OrderedDict([
@@ -275,7 +278,7 @@ class TrainConfig(ConfigBase, dj.Lookup, Messager):
                 outputs = model(inputs, readout_key, eye_pos=eye_pos, behavior=beh)
                 return (criterion(outputs, targets)
                         + (model.core.regularizer() / grad_passes if not model.readout[readout_key].stop_grad else 0)
-                        + model.readout.regularizer(readout_key).cuda(0)
+                        + model.readout.regularizer(readout_key).to(device)
                         + (model.shifter.regularizer(readout_key) if model.shift else 0)
                         + (model.modulator.regularizer(readout_key) if model.modulate else 0)) / acc
 
@@ -288,29 +291,266 @@ class TrainConfig(ConfigBase, dj.Lookup, Messager):
             if model.modulator is not None:
                 model.modulator.initialize()
 
-            self.msg('Shipping model to GPU')
-            model = model.cuda()
+            self.msg('Shipping model to', device)
+            model = model.to_device(device)
             print(model)
 
-            epoch = 0
             # --- train core, modulator, and readout but not shifter
-            schedule = key['schedule']
             self.msg('Full training')
-            for opt, lr in zip(repeat(torch.optim.Adam), schedule):
-                self.msg('Training with learning rate', lr, depth=1)
-                optimizer = opt(model.parameters(), lr=lr)
-
-                model, epoch = Encoder().train(model, full_objective, optimizer,
-                                               stop_closure, trainloaders,
-                                               epoch=epoch,
-                                               max_iter=key['max_epoch'],
-                                               interval=4,
-                                               patience=4,
-                                               accumulate_gradient=acc * n_datasets
-                                               )
+            model, epoch = Encoder().train_schedule(model, full_objective, stop_closure, trainloaders,
+                                                    key['schedule'], checkpointer=checkpointer, device=device,
+                                                    max_iter=key['max_epoch'],
+                                                    interval=4,
+                                                    patience=4,
+                                                    accumulate_gradient=acc * n_datasets
+                                                    )
+            model.eval()
+            return model
+
+    class Chunked(dj.Part, Messager):
+        definition = """
+        -> master
+        ---
+        batch_size             : int      # training and validation batchsize
+        n_subsample=null       : int      # neuron subsample size
+        n_subsample_test=null  : int      # neuron subsample size for test sets
+        schedule               : longblob # learning rate schedule
+        acc_gradient           : tinyint  # whether to accumulate gradient or not
+        max_epoch              : int      # maximum number of epochs
+        chunk_len              : smallint # frames per chunk of truncated backpropagation through time
+        """
+
+        @property
+        def content(self):
+            yield dict(batch_size=5, n_subsample_test=2000,
+                       schedule=np.array([0.005, 0.001]), acc_gradient=1, max_epoch=500, chunk_len=60)
+
+        def train(self, key, trainloaders, valloaders, n_neurons, device=None, checkpointer=None):
+            """
+            Trains on whole trials instead of random subsequences. Every trial is processed in consecutive
+            chunks of chunk_len frames and the detached hidden states of core, shifter, and modulator are
+            carried from one chunk to the next, so the burn in is only dropped once per trial.
+
+            Only works with recurrent cores, because a stateless core would see no frames of the previous
+            chunk. Stateless shifters and modulators compute frame by frame and need no state.
+
+            Whole trials differ in length and cannot be collated, so the trials are loaded one at a time and
+            the gradients of batch_size * acc_gradient chunks are accumulated per optimizer step.
+            """
+            device = get_device(device)
+            img_shape = list(trainloaders.values())[0].dataset.img_shape
+
+            max_neurons = np.max(list(n_neurons.values()))
+            # set some parameters
+            self.msg('Training sets')
+            for k, dl in list(trainloaders.items()):
+                dl.dataset.transforms = [tr for tr in dl.dataset.transforms if not isinstance(tr, Subsequence)]
+                trainloaders[k] = DataLoader(dl.dataset, sampler=dl.sampler, batch_size=1)
+                self.msg(dl.dataset, depth=1)
+
+            self.msg('Validation sets')
+            for dl in valloaders.values():
+                dl.batch_size = 1
+                self.msg(dl.dataset, depth=1)
+            n_subsample = key['n_subsample']
+            n_subsample_test = key['n_subsample_test']
+
+            # --- set some parameters
+
+            criterion = SubsetPoissonLoss3d()
+
+            def full_objective(model, readout_key, inputs, beh, eye_pos, targets, hidden=None):
+                if n_subsample is not None:
+                    subs_idx, _ = torch.randperm(n_neurons[readout_key])[:n_subsample].to(device).sort()
+                else:
+                    subs_idx = slice(None)
+
+                outputs, hidden = model(inputs, readout_key, eye_pos=eye_pos, behavior=beh, subs_idx=subs_idx,
+                                        hidden=hidden, return_hidden=True)
+                return criterion(outputs, targets, subs_idx) \
+                       + model.core.regularizer() \
+                       + model.readout.regularizer(readout_key, subs_idx=subs_idx) \
+                       + (model.shifter.regularizer(readout_key) if model.shift else 0) \
+                       + (model.modulator.regularizer(readout_key, subs_idx=subs_idx) if model.modulate else 0), \
+                       hidden
+
+            # --- initialize
+            stop_closure = Encoder().get_stop_closure(valloaders, subsamp_size=n_subsample_test, device=device)
+
+            model = Encoder().build_model(key, img_shape=img_shape, n_neurons=n_neurons)
+            assert key['chunk_len'] > model.burn_in, 'chunk_len must be larger than the burn in'
+            assert getattr(model.core, 'recurrent', False), \
+                'chunked training needs a recurrent core to carry the temporal context between chunks'
+            mu_dict = {k: dl.dataset.mean_trial().responses for k, dl in trainloaders.items()}
+            model.readout.initialize(mu_dict)
+            model.core.initialize()
+            if model.shifter is not None:
+                biases = {k: -dl.dataset.mean_trial().eye_position for k, dl in trainloaders.items()}
+                model.shifter.initialize(bias=biases)
+            if model.modulator is not None:
+                model.modulator.initialize()
+            self.msg('Shipping model to', device)
+            model = model.to_device(device)
+            print(model)
+
+            # --- train core, modulator, and readout but not shifter
+            self.msg('Chunked training'.ljust(30, '-'))
+            model, epoch = Encoder().train_schedule(model, full_objective, stop_closure, trainloaders,
+                                                    key['schedule'], checkpointer=checkpointer, device=device,
+                                                    max_iter=key['max_epoch'],
+                                                    interval=max_neurons // n_subsample * 20 if n_subsample is not None else 20,
+                                                    patience=10,
+                                                    accumulate_gradient=key['acc_gradient'] * key['batch_size'],
+                                                    chunk_size=key['chunk_len']
+                                                    )
             model.eval()
             return model
 
+    class Checkpointed(dj.Part, Messager):
+        definition = """
+        -> master
+        ---
+        batch_size             : int      # training and validation batchsize
+        n_subsample=null       : int      # neuron subsample size
+        n_subsample_test=null  : int      # neuron subsample size for test sets
+        schedule               : longblob # learning rate schedule
+        acc_gradient           : tinyint  # whether to accumulate gradient or not
+        max_epoch              : int      # maximum number of epochs
+        checkpoint_frames=null : smallint # frames per checkpointed segment of recurrent cores
+        checkpoint_layers=null : tinyint  # layers per checkpointed group of stacked 3d cores
+        """
+
+        @property
+        def content(self):
+            yield dict(batch_size=5, n_subsample_test=2000,
+                       schedule=np.array([0.005, 0.001]), acc_gradient=1, max_epoch=500, checkpoint_frames=30)
+            yield dict(batch_size=5, n_subsample_test=2000,
+                       schedule=np.array([0.005, 0.001]), acc_gradient=1, max_epoch=500, checkpoint_layers=1)
+
+        def train(self, key, trainloaders, valloaders, n_neurons, device=None, checkpointer=None):
+            """
+            Same as Default but with activation checkpointing in the core: the activations of segments of
+            checkpoint_frames frames (recurrent cores) or groups of checkpoint_layers layers (Stacked3dCore)
+            are recomputed in the backward pass, which trades compute for memory on long sequences.
+            The stored model does not depend on the checkpointing.
+            """
+            core_kwargs = {k: key[k] for k in ['checkpoint_frames', 'checkpoint_layers'] if key[k] is not None}
+            self.msg('Checkpointing core with', core_kwargs)
+            return TrainConfig.Default().train(key, trainloaders, valloaders, n_neurons, core_kwargs=core_kwargs,
+                                               device=device, checkpointer=checkpointer)
+
+    class MixedPrecision(dj.Part, Messager):
+        definition = """
+        -> master
+        ---
+        batch_size             : int        # training and validation batchsize
+        n_subsample=null       : int        # neuron subsample size
+        n_subsample_test=null  : int        # neuron subsample size for test sets
+        schedule               : longblob   # learning rate schedule
+        acc_gradient           : tinyint    # whether to accumulate gradient or not
+        max_epoch              : int        # maximum number of epochs
+        precision              : varchar(8) # autocast precision (bf16 or fp16)
+        """
+
+        @property
+        def content(self):
+            yield dict(batch_size=5, n_subsample_test=2000,
+                       schedule=np.array([0.005, 0.001]), acc_gradient=1, max_epoch=500, precision='bf16')
+            yield dict(batch_size=5, n_subsample_test=2000,
+                       schedule=np.array([0.005, 0.001]), acc_gradient=1, max_epoch=500, precision='fp16')
+
+        def train(self, key, trainloaders, valloaders, n_neurons, device=None, checkpointer=None):
+            """
+            Same as Default but the forward passes of core, readout, shifter, and modulator run under autocast in
+            bfloat16 (CPU and GPU) or float16 (GPU, with loss scaling). Parameters and optimizer stay in float32.
+            """
+            self.msg('Training with precision', key['precision'])
+            return TrainConfig.Default().train(key, trainloaders, valloaders, n_neurons, device=device,
+                                               precision=key['precision'], checkpointer=checkpointer)
+
+    class Estimated(dj.Part, Messager):
+        definition = """
+        -> master
+        ---
+        batch_size             : int      # training and validation batchsize
+        n_subsample=null       : int      # neuron subsample size
+        n_subsample_test=null  : int      # neuron subsample size for test sets
+        schedule               : longblob # learning rate schedule
+        acc_gradient           : tinyint  # whether to accumulate gradient or not
+        max_epoch              : int      # maximum number of epochs
+        estimate_fraction      : float    # fraction of validation trials and neurons for early-stopping estimates
+        """
+
+        @property
+        def content(self):
+            yield dict(batch_size=5, n_subsample_test=2000,
+                       schedule=np.array([0.005, 0.001]), acc_gradient=1, max_epoch=500, estimate_fraction=0.25)
+
+        def train(self, key, trainloaders, valloaders, n_neurons, device=None, checkpointer=None):
+            """
+            Same as Default but early stopping scores a stratified subset of the validation trials and neurons
+            and only runs the full validation when the estimate might be a new best or training might stop
+            (see nips2018.movie._utils.EstimatedStopClosure).
+            """
+            self.msg('Estimating validation correlation on', key['estimate_fraction'], 'of trials and neurons')
+            return TrainConfig.Default().train(key, trainloaders, valloaders, n_neurons, device=device,
+                                               estimate=key['estimate_fraction'], checkpointer=checkpointer)
+
+    class AsyncValidation(dj.Part, Messager):
+        definition = """
+        -> master
+        ---
+        batch_size             : int      # training and validation batchsize
+        n_subsample=null       : int      # neuron subsample size
+        n_subsample_test=null  : int      # neuron subsample size for test sets
+        schedule               : longblob # learning rate schedule
+        acc_gradient           : tinyint  # whether to accumulate gradient or not
+        max_epoch              : int      # maximum number of epochs
+        validation_threads     : tinyint  # CPU threads of the background validation process
+        """
+
+        @property
+        def content(self):
+            yield dict(batch_size=5, n_subsample_test=2000,
+                       schedule=np.array([0.005, 0.001]), acc_gradient=1, max_epoch=500, validation_threads=8)
+
+        def train(self, key, trainloaders, valloaders, n_neurons, device=None, checkpointer=None):
+            """
+            Same as Default but the validation runs on snapshots of the model in a background process on the CPU
+            while training continues. Patience and the best model are updated one interval late.
+            """
+            self.msg('Validating in the background with', key['validation_threads'], 'threads')
+            return TrainConfig.Default().train(key, trainloaders, valloaders, n_neurons, device=device,
+                                               async_threads=key['validation_threads'], checkpointer=checkpointer)
+
+    class CachedValidation(dj.Part, Messager):
+        definition = """
+        -> master
+        ---
+        batch_size             : int      # training and validation batchsize
+        n_subsample=null       : int      # neuron subsample size
+        n_subsample_test=null  : int      # neuron subsample size for test sets
+        schedule               : longblob # learning rate schedule
+        acc_gradient           : tinyint  # whether to accumulate gradient or not
+        max_epoch              : int      # maximum number of epochs
+        cache_memory           : int      # memory cap of the cached validation tier in MB
+        """
+
+        @property
+        def content(self):
+            yield dict(batch_size=5, n_subsample_test=2000,
+                       schedule=np.array([0.005, 0.001]), acc_gradient=1, max_epoch=500, cache_memory=4096)
+
+        def train(self, key, trainloaders, valloaders, n_neurons, device=None, checkpointer=None):
+            """
+            Same as Default but the validation loaders are read once and kept in memory as tensors, up to
+            cache_memory MB (see nips2018.movie.parameters.cache_loaders), so early stopping does not read and
+            transform the validation tier from disk at every evaluation.
+            """
+            self.msg('Caching the validation tier up to', key['cache_memory'], 'MB')
+            return TrainConfig.Default().train(key, trainloaders, valloaders, n_neurons, device=device,
+                                               cache_memory=key['cache_memory'], checkpointer=checkpointer)
+
     def train_key(self, key):
         return dict(key, **self.parameters(key))
 
@@ -354,45 +594,102 @@ class Encoder(dj.Computed, Learner, CorePlusReadoutModel, Messager):
         pearson                  : float       # test correlation on single trial responses
         """
 
-    def fill_test_scores(self, keys):
+    def fill_test_scores(self, keys, device=None, tune=True):
+        """
+        Computes the missing test scores of the models in keys.
+
+        Args:
+            keys:   restriction of Encoder
+            device: device to evaluate on (see nips2018.utils.device.get_device)
+            tune:   tune threads and memory layout for the CPU (see Learner.inference_config)
+        """
+        device = get_device(device)
         for key in ((self & keys.proj()) - (self.TestScores & keys)).fetch(dj.key):
             testsets, testloaders = DataConfig().load_data(key, tier='test', batch_size=2)
-            model = self.load_model(key).cuda()
+            model = self.load_model(key).to_device(device)
             model.eval()
-            scores, unit_scores = self.compute_test_score_tuples(key, testloaders, model)
+            config = self.inference_config(model, testloaders, device=device, tune=tune)
+            with config.context():
+                scores, unit_scores = self.compute_test_score_tuples(key, testloaders, model, device=device)
             with self.connection.transaction:
                 self.TestScores().insert(scores, ignore_extra_fields=True)
                 self.UnitTestScores().insert(unit_scores, ignore_extra_fields=True)
 
+    def validate_quantization(self, key=None, tolerance=0.005, unit_tolerance=0.05):
+        """
+        Compares the per-unit test correlations of the quantized model (see load_model) with the float model
+        on the CPU.
+
+        Args:
+            key:                key of the model. If None, self must contain exactly one model.
+            tolerance:          largest acceptable drop of the mean correlation in every dataset
+            unit_tolerance:     largest acceptable drop of the correlation of any single unit
+
+        Returns: True if the quantized model is accepted, and a dictionary with unit ids, float and quantized
+                 correlations, and their difference for every dataset
+
+        """
+        if key is None:
+            key = self.fetch1(dj.key)
+        device = get_device('cpu')
+        testsets, testloaders = DataConfig().load_data(key, tier='test', batch_size=1)
+        models = [self.load_model(key).to_device(device).eval(), self.load_model(key, quantize=True)]
+
+        ret, accept = OrderedDict(), True
+        self.msg('Correlation drop of quantized model')
+        with inference_mode():
+            for readout_key, loader in testloaders.items():
+                pearson = []
+                for model in models:
+                    y, y_hat = self.compute_predictions(loader, model, readout_key, device=device)
+                    pearson.append(np.nan_to_num(corr(y, y_hat, axis=0)))
+                drop = pearson[0] - pearson[1]
+                self.msg(readout_key, 'mean {:.4f}, 95th percentile {:.4f}, max {:.4f}'.format(
+                    drop.mean(), np.percentile(drop, 95), drop.max()), depth=1)
+                ret[readout_key] = dict(unit_ids=loader.dataset.neurons.unit_ids, pearson=pearson[0],
+                                        pearson_quantized=pearson[1], drop=drop)
+                exceeding = int((drop > unit_tolerance).sum())
+                if exceeding > 0:
+                    self.msg(exceeding, 'units drop by more than', unit_tolerance, depth=1)
+                accept = accept and drop.mean() <= tolerance and exceeding == 0
+        self.msg('Quantized model', 'accepted' if accept else 'rejected', 'at tolerance', tolerance,
+                 'and unit tolerance', unit_tolerance)
+        return accept, ret
+
     def _make_tuples(self, key):
         self.msg('Populating\n', pformat(key, indent=10), flush=True)
         # --- set seed
-        set_seed((Seed() & key).fetch1('seed'))
+        device = get_device()
+        set_seed((Seed() & key).fetch1('seed'), cuda=device.type == 'cuda')
         key0 = dict(key)
 
         # --- load data
         train_key = TrainConfig().train_key(key)
-        trainsets, trainloaders = DataConfig().load_data(key, tier='train', batch_size=train_key['batch_size'])
+        session = DataConfig().session(key)
+        trainsets, trainloaders = session.load_data(tier='train', batch_size=train_key['batch_size'])
 
         n_neurons = OrderedDict([(k, v.n_neurons) for k, v in trainsets.items()])
-        valsets, valloaders = DataConfig().load_data(key, tier='validation', batch_size=1, key_order=trainsets)
-
-        testsets, testloaders = DataConfig().load_data(key, tier='test', batch_size=1, key_order=trainsets)
+        valsets, valloaders = session.load_data(tier='validation', batch_size=1)
 
         self.msg('Trainingsets\n', pformat(dict(trainsets), indent=10))
+        # a killed job resumes from the last checkpoint when populate is run again
+        checkpointer = Checkpointer(key0)
+        self.msg('Checkpointing to', checkpointer.path)
         model = TrainConfig().train(key, trainloaders=trainloaders,
                                     valloaders=valloaders,
-                                    n_neurons=n_neurons)
+                                    n_neurons=n_neurons, device=device, checkpointer=checkpointer)
         # --- test
         train_key = TrainConfig().train_key(key)
         val_closure = Encoder().get_stop_closure(valloaders,
-                                                 subsamp_size=train_key['n_subsample_test'])
+                                                 subsamp_size=train_key['n_subsample_test'], device=device)
         key = self.update_key_with_validation_scores(key0, val_closure(model, avg=False))
-        row = dict(key, model={k: v.cpu().numpy() for k, v in model.state_dict().items()})
+        row = dict(key, model=self.pack_model(model))
         self.insert1(row)
         git_key = self.log_git(key)
         self.msg('Logging git key', pformat(git_key))
-        scores, unit_scores = self.compute_test_score_tuples(key0, testloaders, model)
+        testsets, testloaders = session.load_data(tier='test', batch_size=1)
+        scores, unit_scores = self.compute_test_score_tuples(key0, testloaders, model, device=device)
         self.TestScores().insert(scores, ignore_extra_fields=True)
         self.UnitTestScores().insert(unit_scores, ignore_extra_fields=True)
+        checkpointer.clear()
         print(80 * '=', flush=True)
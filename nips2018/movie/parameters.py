@@ -1,11 +1,12 @@
+import os
 from collections import OrderedDict, Counter
+from copy import copy
 from functools import reduce
 from itertools import product, count
 from operator import add
 
 import numpy as np
 import torch
-from attorch.dataloaders import RepeatsBatchSampler
 from torch.utils.data import DataLoader
 from torch.utils.data.sampler import SubsetRandomSampler, Sampler
 
@@ -18,6 +19,10 @@ from ..utils.logging import Messager
 
 schema = dj.schema('nips2018_parameters', locals())
 
+CACHE_MEMORY_ENV = 'NIPS2018_CACHE_MEMORY'
+DEFAULT_CACHE_MEMORY = 4096  # MB
+CACHE_DTYPE_ENV = 'NIPS2018_CACHE_DTYPE'
+
 
 @schema
 class Seed(dj.Lookup):
@@ -94,14 +99,37 @@ class CoreConfig(ConfigBase, dj.Lookup):
                 d = dict(zip(self.heading.dependent_attributes, p))
                 yield d
 
-    def build(self, input_channels, key):
+    class StackedFeatureStatic(dj.Part):
+        definition = """
+        -> master
+        ---
+        hidden_channels       : int      # hidden channels
+        input_kern            : int      # kernel size at input convolutional layers
+        hidden_kern           : int      # kernel size at hidden convolutional layers
+        layers                : int      # layers
+        gamma_hidden          : double   # regularization constant for hidden layers in CNN
+        gamma_input           : double   # regularization constant for input  convolutional layers
+        skip                  : tinyint  # use skip connection to previous `skip` layers
+        bias                  : bool     # use bias
+        pad_input             : bool     # use padding
+        momentum              : double   # momentum of batch norm
+        micro_batch=null      : int      # maximal number of frames times batch size per call of the 2d core
+        """
+
+        @property
+        def content(self):
+            for p in product([12], [7], [3], [3], [0.1], [50], [2], [False], [True], [.1], [None, 512]):
+                d = dict(zip(self.heading.dependent_attributes, p))
+                yield d
+
+    def build(self, input_channels, key, **kwargs):
         core_key = self.parameters(key)
         core_name = '{}Core'.format(core_key.pop('core_type'))
         assert hasattr(cores, core_name), '''Cannot find core for {core_name}. 
                                              Core needs to be names "{core_name}Core" 
                                              in architectures.cores'''.format(core_name=core_name)
         Core = getattr(cores, core_name)
-        return Core(input_channels=input_channels, **core_key)
+        return Core(input_channels=input_channels, **core_key, **kwargs)
 
 
 @schema
@@ -132,6 +160,21 @@ class ReadoutConfig(ConfigBase, dj.Lookup):
                 d = dict(zip(self.heading.dependent_attributes, p))
                 yield d
 
+    class LowRankSpatialTransformerPooled3d(dj.Part):
+        definition = """
+        -> master
+        ---
+        gamma_features         : float    # regularization constant for features
+        rank                   : smallint # rank of the feature matrix
+        pool_steps             : tinyint  # number of pooling steps in the readout
+        """
+
+        @property
+        def content(self):
+            for p in product([.1, 1.], [8, 16, 32], [4]):
+                d = dict(zip(self.heading.dependent_attributes, p))
+                yield d
+
     class SpatialTransformer3dSharedGrid(dj.Part):
         definition = """
         -> master
@@ -273,29 +316,26 @@ class ShifterConfig(ConfigBase, dj.Lookup):
 class StimulusTypeMixin(Messager):
     _stimulus_type = None
 
-    def add_transforms(self, key, datasets, tier, exclude=None):
+    def add_transforms(self, key, datasets, tier, exclude=None, session=None):
         if exclude is not None:
             self.msg('Excluding', ','.join(exclude), 'from normalization')
         for k, dataset in datasets.items():
             transforms = []
             if tier == 'train':
                 transforms.append(Subsequence(key['train_seq_len']))
-            transforms.extend([Normalizer(dataset, stats_source=key['stats_source'], exclude=exclude), ToTensor()])
+            if session is None:
+                normalizer = Normalizer(dataset, stats_source=key['stats_source'], exclude=exclude)
+            else:
+                normalizer = session.cached(('normalizer', k, key['stats_source'], tuple(exclude or ())),
+                                            lambda: Normalizer(dataset, stats_source=key['stats_source'],
+                                                               exclude=exclude))
+            transforms.extend([normalizer, ToTensor()])
             dataset.transforms = transforms
 
         return datasets
 
     def get_constraint(self, dataset, stimulus_type, tier=None):
-        constraint = np.zeros(len(dataset.types), dtype=bool)
-        for const in map(lambda s: s.strip(), stimulus_type.split('|')):
-            if const.startswith('~'):
-                tmp = (dataset.types != const[1:])
-            else:
-                tmp = (dataset.types == const)
-            constraint = constraint | tmp
-        if tier is not None:
-            constraint = constraint & (dataset.tiers == tier)
-        return constraint
+        return dataset.trial_index.query(stimulus_type, tier=tier)
 
     def get_loaders(self, datasets, tier, batch_size, stimulus_types=None, balanced=False,
                     merge_noise_types=True, shrink_to_same_size=False):
@@ -339,7 +379,8 @@ class StimulusTypeMixin(Messager):
                     self.msg("Configuring balanced random subset sampler for", k)
                     if merge_noise_types:
                         self.msg("Balancing Clip vs. Rest", depth=1)
-                        types = np.array([('Clip' if t == 'stimulus.Clip' else 'Noise') for t in dataset.types])
+                        index = dataset.trial_index
+                        types = np.where(index.type_codes == index.type_code('stimulus.Clip'), 'Clip', 'Noise')
                     loaders[k] = DataLoader(dataset, sampler=BalancedSubsetSampler(ix, types), batch_size=batch_size)
                     self.msg('Number of samples in the loader will be', len(loaders[k].sampler), depth=1)
             else:
@@ -353,16 +394,19 @@ class StimulusTypeMixin(Messager):
 
     def load_data(self, key, tier=None, batch_size=1, key_order=None,
                   exclude_from_normalization=None, stimulus_types=None,
-                  balanced=False, shrink_to_same_size=False):
+                  balanced=False, shrink_to_same_size=False, session=None):
         self.msg('Loading', self._stimulus_type, 'dataset with tier=', tier)
-        datasets = MovieMultiDataset().fetch_data(key, key_order=key_order)
+        if session is None:
+            datasets = MovieMultiDataset().fetch_data(key, key_order=key_order)
+        else:
+            datasets = session.views(key_order=key_order)
         for k, dat in datasets.items():
             if 'stats_source' in key:
                 self.msg('Adding stats_source "{stats_source}" to dataset   '.format(**key))
                 dat.stats_source = key['stats_source']
 
         self.msg('Using statistics source', key['stats_source'])
-        datasets = self.add_transforms(key, datasets, tier, exclude=exclude_from_normalization)
+        datasets = self.add_transforms(key, datasets, tier, exclude=exclude_from_normalization, session=session)
         loaders = self.get_loaders(datasets, tier, batch_size, stimulus_types=stimulus_types,
                                    balanced=balanced, shrink_to_same_size=shrink_to_same_size)
         return datasets, loaders
@@ -370,20 +414,29 @@ class StimulusTypeMixin(Messager):
 
 class AreaLayerRawMixin(StimulusTypeMixin):
     def load_data(self, key, tier=None, batch_size=1, key_order=None, stimulus_types=None,
-                  balanced=False, shrink_to_same_size=False):
+                  balanced=False, shrink_to_same_size=False, session=None):
         datasets, loaders = super().load_data(key, tier, batch_size, key_order,
                                               exclude_from_normalization=self._exclude_from_normalization,
                                               stimulus_types=stimulus_types,
-                                              balanced=balanced, shrink_to_same_size=shrink_to_same_size)
+                                              balanced=balanced, shrink_to_same_size=shrink_to_same_size,
+                                              session=session)
 
         self.msg('Subsampling to layer "{layer}" and area "{brain_area}"'.format(**key))
         for readout_key, dataset in datasets.items():
-            layers = dataset.neurons.layer
-            areas = dataset.neurons.area
-            idx = np.where((layers == key['layer']) & (areas == key['brain_area']))[0]
+            if session is None:
+                idx = self.get_subsample_index(key, dataset)
+            else:
+                idx = session.cached(('subsample', readout_key, key['layer'], key['brain_area']),
+                                     lambda: self.get_subsample_index(key, dataset))
             dataset.transforms.insert(-1, Subsample(idx))
         return datasets, loaders
 
+    @staticmethod
+    def get_subsample_index(key, dataset):
+        layers = dataset.neurons.layer
+        areas = dataset.neurons.area
+        return np.where((layers == key['layer']) & (areas == key['brain_area']))[0]
+
 
 @schema
 class DataConfig(ConfigBase, dj.Lookup, Messager):
@@ -392,6 +445,9 @@ class DataConfig(ConfigBase, dj.Lookup, Messager):
     def data_key(self, key):
         return dict(key, **self.parameters(key))
 
+    def session(self, key, key_order=None):
+        return DataSession(key, key_order=key_order)
+
     def load_data(self, key, oracle=False, **kwargs):
         data_key = self.data_key(key)
         Data = getattr(self, data_key.pop('data_type'))
@@ -401,13 +457,12 @@ class DataConfig(ConfigBase, dj.Lookup, Messager):
             self.msg('Placing oracle data samplers')
             for readout_key, loader in loaders.items():
                 ix = loader.sampler.indices
-                condition_hashes = datasets[readout_key].condition_hashes
                 self.msg('Replacing', loader.sampler.__class__.__name__, 'with RepeatsBatchSampler', depth=1)
                 loader.sampler = None
 
                 datasets[readout_key].transforms = \
                     [tr for tr in datasets[readout_key].transforms if isinstance(tr, (Subsample, ToTensor))]
-                loader.batch_sampler = RepeatsBatchSampler(condition_hashes, subset_index=ix)
+                loader.batch_sampler = RepeatsBatchSampler(datasets[readout_key].trial_index, subset_index=ix)
         return datasets, loaders
 
     class AreaLayerClip(dj.Part, StimulusTypeMixin):
@@ -529,7 +584,7 @@ class DataConfig(ConfigBase, dj.Lookup, Messager):
                              ['L2/3'], ['V1'], [1]):
                 yield dict(zip(self.heading.dependent_attributes, p))
 
-        def load_data(self, key, tier=None, batch_size=1, key_order=None):
+        def load_data(self, key, tier=None, batch_size=1, key_order=None, session=None):
             t = [s.strip() for s in key['stimulus_types'].split(',')]
             T = len(t)
             n = len(MovieMultiDataset.Member() & key)
@@ -541,7 +596,7 @@ class DataConfig(ConfigBase, dj.Lookup, Messager):
             self.msg('Using stimulus types "{}"'.format('", "'.join(stimulus_types)))
 
             return super().load_data(key, tier, batch_size, key_order, stimulus_types=stimulus_types,
-                                     balanced=bool(key['balanced']))
+                                     balanced=bool(key['balanced']), session=session)
 
     class AreaLayerSplitRawSizeMatched(dj.Part, AreaLayerRawMixin):
         definition = """
@@ -565,7 +620,7 @@ class DataConfig(ConfigBase, dj.Lookup, Messager):
                              ['L2/3'], ['V1'], [1]):
                 yield dict(zip(self.heading.dependent_attributes, p))
 
-        def load_data(self, key, tier=None, batch_size=1, key_order=None):
+        def load_data(self, key, tier=None, batch_size=1, key_order=None, session=None):
             t = [s.strip() for s in key['stimulus_types'].split(',')]
             T = len(t)
             n = len(MovieMultiDataset.Member() & key)
@@ -577,7 +632,151 @@ class DataConfig(ConfigBase, dj.Lookup, Messager):
             self.msg('Using stimulus types "{}"'.format('", "'.join(stimulus_types)))
 
             return super().load_data(key, tier, batch_size, key_order, stimulus_types=stimulus_types,
-                                     balanced=bool(key['balanced']), shrink_to_same_size=True)
+                                     balanced=bool(key['balanced']), shrink_to_same_size=True,
+                                     session=session)
+
+
+class DataSession(Messager):
+    """
+    Opens the datasets of a data configuration once and hands out tier specific datasets and loaders.
+    The datasets of all tiers are views on the same MovieSets, so they share file handles, statistics,
+    and trial indices. Normalizers and neuron subsample indices are computed once per session, and the
+    datasets and loaders of a tier are only created when the tier is first requested.
+
+    Args:
+        key:        key that restricts MovieMultiDataset and DataConfig to one entry each
+        key_order:  order of the readout keys (default: order of MovieMultiDataset.fetch_data)
+    """
+
+    def __init__(self, key, key_order=None):
+        self.key = key
+        self.key_order = key_order
+        self._datasets = None
+        self._cache = {}
+        self._tiers = {}
+
+    @property
+    def datasets(self):
+        if self._datasets is None:
+            self._datasets = MovieMultiDataset().fetch_data(self.key, key_order=self.key_order)
+        return self._datasets
+
+    def views(self, key_order=None):
+        """
+        Returns fresh views on the session's datasets without any transforms.
+        """
+        key_order = key_order if key_order is not None else self.datasets
+        return OrderedDict([(k, self.datasets[k].view()) for k in key_order])
+
+    def cached(self, name, compute):
+        """
+        Returns the value stored under name or computes it with compute() and stores it.
+        """
+        if name not in self._cache:
+            self._cache[name] = compute()
+        return self._cache[name]
+
+    def load_data(self, tier=None, batch_size=1, oracle=False, **kwargs):
+        """
+        Returns the datasets and loaders of a tier. Arguments are the same as for DataConfig.load_data.
+        Repeated calls with the same arguments return the same datasets and loaders.
+        """
+        request = (tier, batch_size, oracle, repr(sorted(kwargs.items())))
+        if request not in self._tiers:
+            self.msg('Setting up', tier, 'tier of data session')
+            self._tiers[request] = DataConfig().load_data(self.key, tier=tier, batch_size=batch_size,
+                                                          oracle=oracle, session=self, **kwargs)
+        return self._tiers[request]
+
+
+class CachedLoader(Messager):
+    """
+    Reads all batches of a loader once and iterates over them as ready-to-use tensors. Only for loaders
+    whose transforms are deterministic (no Subsequence) and whose sampler has a fixed order.
+
+    Inputs (movie, behavior, eye position) are stored in dtype and cast back to float32 on iteration,
+    responses are stored in float32. With the default float32 storage, the cached batches are identical to the
+    batches of the loader. float16 halves the memory of the inputs but changes them slightly, and with them
+    the validation correlations.
+
+    Args:
+        loader:     DataLoader to cache
+        dtype:      storage type of the inputs
+        device:     device to store the cache on (default: CPU)
+        max_bytes:  stop caching once the cache exceeds this size. complete is False then.
+    """
+
+    def __init__(self, loader, dtype=torch.float32, device=None, max_bytes=None):
+        self.dataset = loader.dataset
+        self.batch_size = loader.batch_size
+        self.indices = getattr(loader.sampler, 'indices', None)
+        self.dtype = dtype
+        self.batches, self.nbytes, self.complete = [], 0, True
+        for *inputs, responses in loader:
+            batch = tuple(x.to(device=device, dtype=dtype) for x in inputs) + (responses.float().to(device),)
+            self.nbytes += sum(b.numel() * b.element_size() for b in batch)
+            if max_bytes is not None and self.nbytes > max_bytes:
+                self.batches, self.complete = [], False
+                return
+            self.batches.append(batch)
+
+    @staticmethod
+    def deterministic(loader):
+        return not any(isinstance(tr, Subsequence) for tr in getattr(loader.dataset, 'transforms', []))
+
+    def subset(self, positions):
+        """
+        Returns: cached loader over the batches at positions (trials for batch size 1)
+        """
+        ret = copy(self)
+        ret.batches = [self.batches[i] for i in positions]
+        ret.indices = None if self.indices is None else np.asarray(self.indices)[positions]
+        return ret
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __iter__(self):
+        for *inputs, responses in self.batches:
+            yield tuple(x.float() for x in inputs) + (responses,)
+
+
+def cache_loaders(loaders, max_memory=None, dtype=None, device=None):
+    """
+    Replaces the loaders by CachedLoaders as long as they fit into max_memory together. Loaders with random
+    transforms and loaders that do not fit anymore are kept.
+
+    Args:
+        loaders:    dictionary of loaders
+        max_memory: memory cap in MB (default: NIPS2018_CACHE_MEMORY or 4096). 0 disables caching.
+        dtype:      storage type of the inputs (default: NIPS2018_CACHE_DTYPE or float32, see CachedLoader)
+        device:     device to store the cache on (default: CPU)
+
+    Returns: dictionary of (cached) loaders
+    """
+    if max_memory is None:
+        max_memory = float(os.environ.get(CACHE_MEMORY_ENV, DEFAULT_CACHE_MEMORY))
+    if dtype is None:
+        dtype = getattr(torch, os.environ.get(CACHE_DTYPE_ENV, 'float32'))
+    budget = max_memory * 2 ** 20
+    ret = OrderedDict()
+    for k, loader in loaders.items():
+        ret[k] = loader
+        if isinstance(loader, CachedLoader):
+            budget -= loader.nbytes
+            continue
+        if budget <= 0 or not CachedLoader.deterministic(loader):
+            CachedLoader.msg('Not caching', k, depth=1)
+            continue
+        cached = CachedLoader(loader, dtype=dtype, device=device, max_bytes=budget)
+        if not cached.complete:
+            CachedLoader.msg('Cache of', k, 'exceeds the remaining', '{:.0f} MB'.format(budget / 2 ** 20), depth=1)
+            continue
+        budget -= cached.nbytes
+        CachedLoader.msg('Cached', len(cached), 'batches of', k, 'in {:.0f} MB'.format(cached.nbytes / 2 ** 20),
+                         depth=1)
+        ret[k] = cached
+    return ret
 
 
 def fill():
@@ -631,3 +830,21 @@ class BalancedSubsetSampler(Sampler):
 
     def __len__(self):
         return self.num_samples
+
+
+class RepeatsBatchSampler(Sampler):
+    """Returns batches of all trials that share a condition hash, using the precomputed groups of a TrialIndex.
+
+    Arguments:
+        trial_index (TrialIndex): index of the dataset
+        subset_index (list): a list of indices to restrict the groups to (default: all trials)
+    """
+
+    def __init__(self, trial_index, subset_index=None):
+        self.repeat_groups = trial_index.repeat_groups(subset_index)
+
+    def __iter__(self):
+        return iter(self.repeat_groups)
+
+    def __len__(self):
+        return len(self.repeat_groups)
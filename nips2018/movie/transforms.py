@@ -1,7 +1,6 @@
 from attorch.dataset import H5SequenceSet, Invertible
 import numpy as np
 import torch
-from torch.autograd import Variable
 
 from ..utils.logging import Messager
 
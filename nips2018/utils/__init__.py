@@ -11,7 +11,7 @@ def set_seed(seed, cuda=True):
     np.random.seed(seed)
     random.seed(seed)
     torch.manual_seed(int(seed))
-    if cuda:
+    if cuda and torch.cuda.is_available():
         torch.cuda.manual_seed(int(seed))
 
 def rename(rel, prefix='new_', exclude=[]):
@@ -0,0 +1,568 @@
+"""
+Small timing helpers to compare implementations of the architectures on synthetic data.
+
+Example:
+
+    >>> from nips2018.utils.benchmark import benchmark_feature_gru
+    >>> benchmark_feature_gru(seq_len=150, cuda=True)
+"""
+import time
+from collections import OrderedDict
+from copy import deepcopy
+
+import numpy as np
+import torch
+
+from .logging import Messager
+
+
+class _Log(Messager):
+    pass
+
+
+def synchronize(cuda):
+    if cuda:
+        torch.cuda.synchronize()
+
+
+def reset_peak_memory(cuda):
+    if cuda and hasattr(torch.cuda, 'reset_max_memory_allocated'):
+        torch.cuda.reset_max_memory_allocated()
+
+
+def peak_memory(cuda):
+    """
+    Returns: peak allocated GPU memory in MB since the last reset or None if it cannot be measured
+    """
+    if cuda and hasattr(torch.cuda, 'max_memory_allocated'):
+        return torch.cuda.max_memory_allocated() / 2 ** 20
+    return None
+
+
+def timeit(f, repeats=5, warmup=1, cuda=False):
+    """
+    Times a function.
+
+    Args:
+        f:       function without arguments
+        repeats: number of timed calls
+        warmup:  number of untimed calls before timing
+        cuda:    synchronize the GPU before reading the clock
+
+    Returns: mean time per call in seconds and peak GPU memory in MB (None on CPU)
+
+    """
+    for _ in range(warmup):
+        f()
+    synchronize(cuda)
+    reset_peak_memory(cuda)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        f()
+    synchronize(cuda)
+    return (time.perf_counter() - start) / repeats, peak_memory(cuda)
+
+
+def saved_tensor_memory(f):
+    """
+    Runs f and measures the tensors autograd saves for the backward pass.
+
+    Returns: memory of the saved tensors in MB or None if the torch version cannot hook them
+    """
+    graph = getattr(torch.autograd, 'graph', None)
+    if graph is None or not hasattr(graph, 'saved_tensors_hooks'):
+        return None
+    saved = {}
+
+    def pack(t):
+        saved[(t.data_ptr(), t.numel())] = t.numel() * t.element_size()
+        return t
+
+    with graph.saved_tensors_hooks(pack, lambda t: t):
+        f()
+    return sum(saved.values()) / 2 ** 20
+
+
+def forward_backward(module, x):
+    """
+    Returns: function that runs one forward and backward pass of module on x
+    """
+
+    def f():
+        module.zero_grad()
+        module(x).sum().backward()
+
+    return f
+
+
+def report(name, results):
+    """
+    Prints timings of several implementations relative to the first one.
+
+    Args:
+        name:    name of the benchmark
+        results: ordered list of (implementation name, seconds, peak memory in MB)
+
+    """
+    _Log.msg(name)
+    base = results[0][1]
+    for impl, t, mem in results:
+        _Log.msg('{:<25} {:8.1f} ms   {:5.2f}x'.format(impl, 1000 * t, base / t)
+                 + ('   {:8.1f} MB'.format(mem) if mem is not None else ''), depth=1)
+
+
+def random_movie(batch_size, channels, seq_len, img_shape, cuda=False):
+    x = torch.randn(batch_size, channels, seq_len, *img_shape)
+    if cuda:
+        x = x.cuda()
+    return x
+
+
+def default_feature_gru(input_channels=1, **kwargs):
+    from ..architectures.cores import StackedFeatureGRUCore
+    params = dict(hidden_channels=12, rec_channels=36, input_kern=7, hidden_kern=3, rec_kern=3, layers=3,
+                  gamma_rec=0., gamma_hidden=0.1, gamma_input=50, skip=2, bias=False, pad_input=True,
+                  momentum=.1)
+    params.update(kwargs)
+    return StackedFeatureGRUCore(input_channels=input_channels, **params)
+
+
+class _FramewiseFeatureGRU(torch.nn.Module):
+    """
+    Reference implementation of FeatureGRUCore.forward that runs the feature stack frame by frame.
+    """
+
+    def __init__(self, core):
+        super().__init__()
+        self.core = core
+
+    def forward(self, input):
+        hidden, states = None, []
+        x = input.transpose(1, 2).transpose(0, 1)
+        for t in range(x.size(0)):
+            hidden = self.core.cell(x[t, ...], hidden)
+            states.append(hidden)
+        return torch.stack(states, 2)
+
+
+def benchmark_feature_gru(seq_len=150, batch_size=8, img_shape=(36, 64), repeats=5, cuda=None, **kwargs):
+    """
+    Compares the time folded FeatureGRUCore with running the feature stack frame by frame.
+    Both versions are checked to produce the same output and batch norm statistics first.
+
+    Args:
+        seq_len:    number of frames (train_seq_len)
+        batch_size: batch size
+        img_shape:  (width, height) of the movie
+        repeats:    number of timed forward/backward passes
+        cuda:       run on GPU (default: if available)
+        **kwargs:   passed to the core constructor
+
+    Returns: list of (implementation, seconds per forward/backward pass, peak memory in MB)
+
+    """
+    cuda = torch.cuda.is_available() if cuda is None else cuda
+    core = default_feature_gru(**kwargs)
+    core.output_shape((1, seq_len) + tuple(img_shape))
+    if cuda:
+        core = core.cuda()
+    reference = _FramewiseFeatureGRU(deepcopy(core))
+    x = random_movie(batch_size, 1, seq_len, img_shape, cuda=cuda)
+
+    diff = (core(x) - reference(x)).abs().max().data.cpu().numpy().max()
+    stats_diff = max(float((a.float() - b.float()).abs().max())
+                     for a, b in zip(core.state_dict().values(), reference.core.state_dict().values()))
+    _Log.msg('max. output difference {:.2e}, max. state difference {:.2e}'.format(float(diff), float(stats_diff)))
+
+    results = [
+        ('frame by frame', *timeit(forward_backward(reference, x), repeats=repeats, cuda=cuda)),
+        ('time folded', *timeit(forward_backward(core, x), repeats=repeats, cuda=cuda)),
+    ]
+    report('FeatureGRUCore forward/backward, T={}, batch size {}'.format(seq_len, batch_size), results)
+    return results
+
+
+class _CellSequence(torch.nn.Module):
+    """
+    Runs a ConvGRUCell over all frames of a time-major (time, batch, channels, width, height) input.
+    """
+
+    def __init__(self, cell):
+        super().__init__()
+        self.cell = cell
+
+    def forward(self, x):
+        hidden, states = None, []
+        gates = self.cell.precompute(x.view(-1, *x.size()[2:]))
+        gates = gates.view(x.size(0), x.size(1), *gates.size()[1:])
+        for t in range(x.size(0)):
+            hidden = self.cell.step(gates[t], hidden)
+            states.append(hidden)
+        return torch.stack(states, 0)
+
+
+def benchmark_conv_gru_cell(seq_len=150, batch_size=8, img_shape=(36, 64), input_channels=36, rec_channels=36,
+                            kern=3, repeats=5, cuda=None):
+    """
+    Compares ConvGRUCell with FusedConvGRUCell on a sequence of frames. The fused cell gets the converted
+    weights of the other one and both are checked to produce the same output first.
+
+    Args:
+        seq_len:        number of frames
+        batch_size:     batch size
+        img_shape:      (width, height) of the input
+        input_channels: channels of the input
+        rec_channels:   channels of the hidden state
+        kern:           kernel size of input and hidden convolutions
+        repeats:        number of timed forward/backward passes
+        cuda:           run on GPU (default: if available)
+
+    Returns: list of (implementation, seconds per forward/backward pass, peak memory in MB)
+
+    """
+    from ..architectures.cores import ConvGRUCell, FusedConvGRUCell
+    cuda = torch.cuda.is_available() if cuda is None else cuda
+    cell = ConvGRUCell(input_channels, rec_channels, kern, kern)
+    cell.build_state(1, img_shape)
+    fused = FusedConvGRUCell(input_channels, rec_channels, kern, kern)
+    fused.build_state(1, img_shape)
+    fused.load_state_dict(FusedConvGRUCell.fuse_state_dict(cell.state_dict()))
+    if cuda:
+        cell, fused = cell.cuda(), fused.cuda()
+    cell, fused = _CellSequence(cell), _CellSequence(fused)
+    x = random_movie(seq_len, batch_size, input_channels, img_shape, cuda=cuda)
+
+    diff = (cell(x) - fused(x)).abs().max().data.cpu().numpy().max()
+    _Log.msg('max. output difference {:.2e}'.format(float(diff)))
+
+    results = [
+        ('ConvGRUCell', *timeit(forward_backward(cell, x), repeats=repeats, cuda=cuda)),
+        ('FusedConvGRUCell', *timeit(forward_backward(fused, x), repeats=repeats, cuda=cuda)),
+    ]
+    report('ConvGRUCell forward/backward, T={}, batch size {}'.format(seq_len, batch_size), results)
+    return results
+
+
+def compiled_parity(module, *inputs, **kwargs):
+    """
+    Compares outputs and gradients of a module with and without TorchScript time loops.
+
+    Args:
+        module:   module containing submodules with a `compiled` flag
+        *inputs:  inputs to the module
+        **kwargs: keyword arguments to the module
+
+    Returns: maximal absolute difference of the outputs and of the parameter gradients
+
+    """
+    from ..architectures._scripted import set_compiled
+    results = []
+    for compiled in [False, True]:
+        set_compiled(module, compiled)
+        module.zero_grad()
+        out = module(*inputs, **kwargs)
+        out.sum().backward()
+        results.append((out.data.clone(), [p.grad.data.clone() for p in module.parameters() if p.grad is not None]))
+    set_compiled(module, False)
+    (out_eager, grad_eager), (out_compiled, grad_compiled) = results
+    out_diff = float((out_eager - out_compiled).abs().max())
+    grad_diff = max([float((a - b).abs().max()) for a, b in zip(grad_eager, grad_compiled)] or [0.])
+    return out_diff, grad_diff
+
+
+def benchmark_compiled(seq_len=150, batch_size=1, img_shape=(36, 64), repeats=5, cuda=None, **kwargs):
+    """
+    Compares eager and TorchScript time loops of FeatureGRUCore, the GRU shifter, and the GateGRU modulator.
+    Outputs and gradients of both versions are checked for parity first.
+
+    Args:
+        seq_len:    number of frames
+        batch_size: batch size
+        img_shape:  (width, height) of the movie
+        repeats:    number of timed forward/backward passes
+        cuda:       run on GPU (default: if available)
+        **kwargs:   passed to the core constructor
+
+    Returns: dictionary with a list of (implementation, seconds, peak memory in MB) per module
+
+    """
+    from ..architectures import _scripted
+    from ..architectures._scripted import set_compiled
+    from ..architectures.shifters import GRU
+    from ..architectures.modulators import GateGRU
+    if not _scripted.available():
+        _Log.msg('TorchScript is not available')
+        return None
+    cuda = torch.cuda.is_available() if cuda is None else cuda
+
+    core = default_feature_gru(**kwargs)
+    core.output_shape((1, seq_len) + tuple(img_shape))
+    modules = [('FeatureGRUCore', core, random_movie(batch_size, 1, seq_len, img_shape, cuda=cuda)),
+               ('GRU shifter', GRU(2, 2), torch.randn(batch_size, seq_len, 2)),
+               ('GateGRU modulator', GateGRU(1000, 3, 5), torch.randn(batch_size, seq_len, 3))]
+
+    ret = {}
+    for name, module, x in modules:
+        if cuda:
+            module, x = module.cuda(), x.cuda()
+        out_diff, grad_diff = compiled_parity(module, x)
+        _Log.msg('{}: max. output difference {:.2e}, max. gradient difference {:.2e}'.format(
+            name, out_diff, grad_diff))
+        results = []
+        for compiled in [False, True]:
+            set_compiled(module, compiled)
+            results.append(('scripted' if compiled else 'eager',
+                            *timeit(forward_backward(module, x), repeats=repeats, cuda=cuda)))
+        set_compiled(module, False)
+        report('{} forward/backward, T={}, batch size {}'.format(name, seq_len, batch_size), results)
+        ret[name] = results
+    return ret
+
+
+def default_stacked3d(input_channels=1, **kwargs):
+    from ..architectures.cores import Stacked3dCore
+    params = dict(hidden_channels=16, input_kern=7, hidden_kern=3, layers=4, gamma_input=50, gamma_hidden=0.1,
+                  skip=2, pad_input=True, momentum=.1)
+    params.update(kwargs)
+    return Stacked3dCore(input_channels=input_channels, **params)
+
+
+def compare_checkpointing(name, core, attr, values, x, repeats=3, cuda=False):
+    """
+    Times forward/backward passes of core for every value of its checkpointing attribute attr and checks
+    the gradients against the first value (which should be None, i.e. no checkpointing).
+
+    Returns: list of (implementation, seconds, peak memory in MB, memory autograd keeps for backward in MB)
+             and the maximal gradient difference
+    """
+    results, reference, max_diff = [], None, 0.
+    for value in values:
+        setattr(core, attr, value)
+        forward_backward(core, x)()
+        grads = [p.grad.data.clone() for p in core.parameters() if p.grad is not None]
+        if reference is None:
+            reference = grads
+        else:
+            assert len(grads) == len(reference), 'checkpointing changed which parameters get gradients'
+            diff = max(float((a - b).abs().max()) for a, b in zip(reference, grads))
+            max_diff = max(max_diff, diff)
+            _Log.msg('{}={}: max. gradient difference {:.2e}'.format(attr, value, diff))
+        label = 'no checkpointing' if value is None else '{}={}'.format(attr, value)
+        t, mem = timeit(forward_backward(core, x), repeats=repeats, cuda=cuda)
+        core.zero_grad()
+        results.append((label, t, mem, saved_tensor_memory(lambda: core(x))))
+    setattr(core, attr, None)
+    report(name, [r[:3] for r in results])
+    for label, _, _, saved in results:
+        if saved is not None:
+            _Log.msg('{:<25} {:8.1f} MB kept for backward'.format(label, saved), depth=1)
+    return results, max_diff
+
+
+def benchmark_checkpointing(seq_len=300, batch_size=8, img_shape=(36, 64), checkpoint_frames=(None, 100, 30),
+                            checkpoint_layers=(None, 1, 2), repeats=3, cuda=None, tolerance=1e-4, **kwargs):
+    """
+    Compares time and memory of forward/backward passes of FeatureGRUCore with different checkpoint segment
+    lengths and of Stacked3dCore with different layer groups. The gradients of all versions are checked
+    against the version without checkpointing.
+
+    Memory is reported as the GPU peak memory (GPU only) and as the memory of the tensors autograd keeps for
+    the backward pass, which is measured on the CPU as well.
+
+    Args:
+        seq_len:           number of frames
+        batch_size:        batch size
+        img_shape:         (width, height) of the movie
+        checkpoint_frames: segment lengths of FeatureGRUCore to compare (None is no checkpointing)
+        checkpoint_layers: layer group sizes of Stacked3dCore to compare (None is no checkpointing)
+        repeats:           number of timed forward/backward passes
+        cuda:              run on GPU (default: if available)
+        tolerance:         maximal absolute gradient difference to the version without checkpointing
+        **kwargs:          passed to the FeatureGRUCore constructor
+
+    Returns: dictionary with a list of (implementation, seconds, peak memory in MB, autograd memory in MB)
+             per core
+
+    """
+    cuda = torch.cuda.is_available() if cuda is None else cuda
+    x = random_movie(batch_size, 1, seq_len, img_shape, cuda=cuda)
+
+    gru = default_feature_gru(**kwargs)
+    gru.output_shape((1, seq_len) + tuple(img_shape))
+    stacked = default_stacked3d()
+
+    ret = OrderedDict()
+    for name, core, attr, values in [('FeatureGRUCore', gru, 'checkpoint_frames', checkpoint_frames),
+                                     ('Stacked3dCore', stacked, 'checkpoint_layers', checkpoint_layers)]:
+        core = core.cuda() if cuda else core
+        ret[name], diff = compare_checkpointing(
+            '{} checkpointing, T={}, batch size {}'.format(name, seq_len, batch_size),
+            core, attr, values, x, repeats=repeats, cuda=cuda)
+        assert diff <= tolerance, '{} gradients differ by {:.2e} with checkpointing'.format(name, diff)
+    return ret
+
+
+def benchmark_precision(key, precisions=(None, 'bf16'), epochs=1, device=None):
+    """
+    Trains the model of an Encoder key for a few epochs with every precision from the same seed and compares
+    the time per epoch and the validation correlation with the float32 baseline (the first precision).
+
+    Args:
+        key:        Encoder key (dataset, model configs, Default train config, and seed)
+        precisions: precisions to compare (None is float32, see nips2018.utils.precision)
+        epochs:     number of training epochs with the first learning rate of the schedule
+        device:     device to train on (see nips2018.utils.device.get_device)
+
+    Returns: list of (precision, seconds per epoch, validation correlation)
+
+    """
+    from ..movie.models import Encoder, TrainConfig
+    from ..movie.parameters import DataConfig, Seed
+    from . import set_seed
+    from .device import get_device
+    device = get_device(device)
+
+    train_key = TrainConfig().train_key(key)
+    train_key.pop('train_type')
+    train_key.update(max_epoch=epochs, schedule=np.atleast_1d(train_key['schedule'])[:1])
+    session = DataConfig().session(key)
+
+    results = []
+    for precision in precisions:
+        set_seed((Seed() & key).fetch1('seed'), cuda=device.type == 'cuda')
+        trainsets, trainloaders = session.load_data(tier='train', batch_size=train_key['batch_size'])
+        valsets, valloaders = session.load_data(tier='validation', batch_size=1)
+        n_neurons = OrderedDict([(k, v.n_neurons) for k, v in trainsets.items()])
+
+        start = time.perf_counter()
+        model = TrainConfig.Default().train(train_key, trainloaders, valloaders, n_neurons, device=device,
+                                            precision=precision)
+        synchronize(device.type == 'cuda')
+        seconds = (time.perf_counter() - start) / epochs
+        val_corr = Encoder().get_stop_closure(valloaders, subsamp_size=train_key['n_subsample_test'],
+                                              device=device, precision=precision)(model)
+        results.append((precision or 'fp32', seconds, float(val_corr)))
+
+    _Log.msg('Mixed precision training, {} epochs on {}'.format(epochs, device))
+    base_time, base_corr = results[0][1:]
+    for precision, seconds, val_corr in results:
+        _Log.msg('{:<6} {:8.1f} s/epoch   {:5.2f}x   validation correlation {:.4f} ({:+.4f})'.format(
+            precision, seconds, base_time / seconds, val_corr, val_corr - base_corr), depth=1)
+    return results
+
+
+class _FullWidthSubset(torch.nn.Module):
+    """
+    Reference for the subset readout: computes the readout for all neurons and indexes outputs and targets.
+    """
+
+    def __init__(self, readout):
+        super().__init__()
+        self.readout = readout
+
+    def forward(self, x, targets, subs_idx):
+        from attorch.losses import PoissonLoss3d
+        return PoissonLoss3d()(self.readout(x)[..., subs_idx], targets[..., subs_idx])
+
+
+class _GatheredSubset(torch.nn.Module):
+    def __init__(self, readout):
+        super().__init__()
+        self.readout = readout
+
+    def forward(self, x, targets, subs_idx):
+        from ..architectures.losses import SubsetPoissonLoss3d
+        return SubsetPoissonLoss3d()(self.readout.subset_forward('data', x, subs_idx), targets, subs_idx)
+
+
+def benchmark_subset_readout(neurons=5000, ratios=(.05, .1, .25, .5, 1.), batch_size=8, seq_len=60,
+                             in_shape=(36, 18, 32), pool_steps=4, repeats=5, cuda=None):
+    """
+    Compares the gathered subset readout with Poisson loss (PooledReadout.subset_forward, SubsetPoissonLoss3d)
+    against computing the readout for all neurons and indexing the subset, for several subsample ratios.
+
+    Args:
+        neurons:    number of neurons of the readout
+        ratios:     fractions of neurons in the subset (n_subsample / neurons)
+        batch_size: batch size
+        seq_len:    number of frames
+        in_shape:   (channels, width, height) of the core output
+        pool_steps: pooling steps of the readout
+        repeats:    number of timed forward/backward passes
+        cuda:       run on GPU (default: if available)
+
+    Returns: dictionary with a list of (implementation, seconds, peak memory in MB) per ratio
+
+    """
+    from ..architectures.readouts import SpatialTransformerPooled3dReadout
+    cuda = torch.cuda.is_available() if cuda is None else cuda
+    c, w, h = in_shape
+    readout = SpatialTransformerPooled3dReadout((c, seq_len, w, h), {'data': neurons}, pool_steps=pool_steps)
+    readout.initialize({'data': torch.rand(neurons)})
+    x = torch.randn(batch_size, c, seq_len, w, h, requires_grad=True)
+    targets = torch.rand(batch_size, seq_len, neurons)
+    if cuda:
+        readout, x, targets = readout.cuda(), x.cuda(), targets.cuda()
+    full, gathered = _FullWidthSubset(readout), _GatheredSubset(readout)
+
+    ret = {}
+    for ratio in ratios:
+        subs_idx, _ = torch.randperm(neurons)[:max(1, int(ratio * neurons))].sort()
+        subs_idx = subs_idx.cuda() if cuda else subs_idx
+        diff = float((full(x, targets, subs_idx) - gathered(x, targets, subs_idx)).abs())
+        _Log.msg('ratio {}: loss difference {:.2e}'.format(ratio, diff))
+        results = []
+        for name, module in [('full width', full), ('gathered', gathered)]:
+            def f():
+                module.zero_grad()
+                module(x, targets, subs_idx).backward()
+
+            results.append((name, *timeit(f, repeats=repeats, cuda=cuda)))
+        report('Readout and Poisson loss forward/backward, {} of {} neurons'.format(len(subs_idx), neurons),
+               results)
+        ret[ratio] = results
+    return ret
+
+
+def benchmark_inference(seq_len=150, batch_size=8, img_shape=(36, 64), repeats=5, cuda=None, **kwargs):
+    """
+    Compares the evaluation forward pass of FeatureGRUCore with autograd enabled (what the former
+    Variable(..., volatile=True) code does on current torch), under no_grad, and in inference mode.
+
+    Args:
+        seq_len:    number of frames
+        batch_size: batch size
+        img_shape:  (width, height) of the movie
+        repeats:    number of timed forward passes
+        cuda:       run on GPU (default: if available). Peak memory is only measured on GPU.
+        **kwargs:   passed to the core constructor
+
+    Returns: list of (implementation, seconds per forward pass, peak memory in MB, autograd memory in MB)
+
+    """
+    from .inference import inference_mode, no_grad
+    cuda = torch.cuda.is_available() if cuda is None else cuda
+    core = default_feature_gru(**kwargs)
+    core.output_shape((1, seq_len) + tuple(img_shape))
+    core = (core.cuda() if cuda else core).eval()
+    x = random_movie(batch_size, 1, seq_len, img_shape, cuda=cuda)
+
+    results, reference = [], None
+    for name, context in [('autograd', torch.enable_grad), ('no_grad', no_grad), ('inference mode', inference_mode)]:
+        def f():
+            with context():
+                return core(x)
+
+        out = f()
+        if reference is None:
+            reference = out.detach()
+        else:
+            _Log.msg('{}: max. output difference {:.2e}'.format(name, float((out - reference).abs().max())))
+        del out
+        t, mem = timeit(f, repeats=repeats, cuda=cuda)
+        results.append((name, t, mem, saved_tensor_memory(f)))
+    report('FeatureGRUCore evaluation, T={}, batch size {}'.format(seq_len, batch_size), [r[:3] for r in results])
+    for name, _, _, saved in results:
+        if saved is not None:
+            _Log.msg('{:<25} {:8.1f} MB kept for backward'.format(name, saved), depth=1)
+    return results
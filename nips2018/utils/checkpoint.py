@@ -0,0 +1,81 @@
+"""
+Crash-safe training checkpoints.
+
+Checkpoints are stored per model in the directory given by NIPS2018_CHECKPOINT_DIR
+(default: ~/.cache/nips2018/checkpoints) under the hash of the model key. They are written to a temporary
+file first and then renamed, so a crash while saving keeps the previous checkpoint.
+"""
+import os
+import random
+
+import numpy as np
+import torch
+
+from .data import list_hash
+from .logging import Messager
+
+CHECKPOINT_ENV = 'NIPS2018_CHECKPOINT_DIR'
+DEFAULT_DIRECTORY = os.path.join(os.path.expanduser('~'), '.cache', 'nips2018', 'checkpoints')
+
+
+def rng_state():
+    """
+    Returns: states of the random number generators of python, numpy, and torch (CPU and GPU)
+    """
+    return dict(python=random.getstate(), numpy=np.random.get_state(), torch=torch.get_rng_state(),
+                cuda=torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None)
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if state['cuda'] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+class Checkpointer(Messager):
+    """
+    Saves and loads the training checkpoint of one model.
+
+    Args:
+        key:        key of the model
+        directory:  checkpoint directory (default: NIPS2018_CHECKPOINT_DIR or ~/.cache/nips2018/checkpoints)
+        every:      number of epochs between two checkpoints
+    """
+
+    def __init__(self, key, directory=None, every=1):
+        directory = directory or os.environ.get(CHECKPOINT_ENV) or DEFAULT_DIRECTORY
+        self.path = os.path.join(directory, '{}.pt'.format(list_hash(sorted(dict(key).items()))))
+        self.every = every
+
+    def save(self, epoch, force=False, **state):
+        """
+        Saves state, the epoch, and the random number generator states if epoch is a multiple of every or
+        force is True.
+        """
+        if not force and epoch % self.every != 0:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = '{}.{}.tmp'.format(self.path, os.getpid())
+        torch.save(dict(state, epoch=epoch, rng=rng_state()), tmp)
+        os.replace(tmp, self.path)
+
+    def load(self):
+        """
+        Returns: the saved checkpoint or None if there is none or it cannot be read
+        """
+        if not os.path.exists(self.path):
+            return None
+        try:
+            try:
+                return torch.load(self.path, map_location='cpu', weights_only=False)
+            except TypeError:  # torch versions without weights_only
+                return torch.load(self.path, map_location='cpu')
+        except Exception as e:
+            self.msg('Could not read checkpoint', self.path, ':', e)
+            return None
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
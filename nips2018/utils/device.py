@@ -0,0 +1,71 @@
+"""
+Device selection for training and evaluation.
+
+The device is taken from an explicit argument, from the environment variable NIPS2018_DEVICE
+(e.g. 'cpu', 'cuda' or 'cuda:1'), or is the GPU if one is available and the CPU otherwise. On the CPU, the
+number of threads torch uses can be set with NIPS2018_THREADS.
+"""
+import os
+
+import torch
+
+DEVICE_ENV = 'NIPS2018_DEVICE'
+THREADS_ENV = 'NIPS2018_THREADS'
+
+
+def get_device(device=None):
+    """
+    Args:
+        device: torch.device or device string. If None, NIPS2018_DEVICE or the GPU if available is used.
+
+    Returns: torch.device
+
+    """
+    if device is None:
+        device = os.environ.get(DEVICE_ENV) or ('cuda' if torch.cuda.is_available() else 'cpu')
+    device = torch.device(device)
+    if device.type == 'cpu':
+        set_threads()
+    return device
+
+
+def is_cuda(device):
+    return get_device(device).type == 'cuda'
+
+
+def move_batches(loader, device=None, filter=None):
+    """
+    Iterates over loader and moves the tensors of every batch to device.
+
+    Args:
+        loader: iterable of tuples of tensors
+        device: target device (see get_device)
+        filter: tuple of booleans, one per batch entry, whether to move it (default: all)
+    """
+    device = get_device(device)
+    for batch in loader:
+        yield move_batch(batch, device, filter=filter)
+
+
+def move_batch(batch, device, filter=None):
+    """
+    Returns: batch with its tensors moved to device (see move_batches)
+    """
+    return tuple(b.to(device) if filter is None or f else b for b, f in zip(batch, filter or [True] * len(batch)))
+
+
+def set_threads(threads=None):
+    """
+    Sets the number of threads for intra-op parallelism on the CPU.
+
+    Args:
+        threads: number of threads. If None, NIPS2018_THREADS is used if set and the torch default otherwise.
+
+    Returns: number of threads torch uses
+
+    """
+    if threads is None:
+        threads = os.environ.get(THREADS_ENV)
+    if threads is not None and int(threads) != torch.get_num_threads():
+        torch.set_num_threads(int(threads))
+    return torch.get_num_threads()
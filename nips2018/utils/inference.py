@@ -0,0 +1,195 @@
+"""
+Inference settings for CorePlusReadout3d on multi-core CPUs and a tuner that picks the fastest one.
+
+Example:
+
+    >>> config = tune_inference(model, readout_key, x, behavior=beh, eye_pos=eye)
+    >>> with config.context():
+    ...     y = model(x, readout_key, behavior=beh, eye_pos=eye)
+
+The tuned setting is cached per machine, model architecture and input shape in the json file given by
+NIPS2018_INFERENCE_CACHE (default: ~/.cache/nips2018/inference.json).
+"""
+import json
+import os
+import socket
+from contextlib import suppress
+
+import torch
+from torch import nn
+
+from .benchmark import timeit
+from .data import list_hash
+from .logging import Messager
+
+CACHE_ENV = 'NIPS2018_INFERENCE_CACHE'
+DEFAULT_CACHE = os.path.join(os.path.expanduser('~'), '.cache', 'nips2018', 'inference.json')
+
+
+def inference_mode(enabled=True):
+    """
+    Returns: context manager that disables autograd (inference mode if the torch version has it). Tensors
+             created inside cannot be used for training later; use no_grad for code that may create parameters.
+    """
+    if not enabled:
+        return suppress()
+    if hasattr(torch, 'inference_mode'):
+        return torch.inference_mode()
+    return no_grad()
+
+
+def no_grad():
+    """
+    Returns: context manager that disables gradient tracking
+    """
+    return torch.no_grad() if hasattr(torch, 'no_grad') else suppress()
+
+
+def set_memory_format(module, channels_last=True):
+    """
+    Stores the weights of all 2d and 3d convolutions in module in channels-last (or the default) layout.
+    """
+    if not hasattr(torch, 'channels_last'):
+        return module
+    for m in module.modules():
+        if isinstance(m, nn.Conv2d):
+            fmt = torch.channels_last if channels_last else torch.contiguous_format
+        elif isinstance(m, nn.Conv3d):
+            fmt = torch.channels_last_3d if channels_last else torch.contiguous_format
+        else:
+            continue
+        m.weight.data = m.weight.data.contiguous(memory_format=fmt)
+    return module
+
+
+class InferenceConfig(Messager):
+    """
+    Settings for running a model on the CPU without gradients.
+
+    Args:
+        threads:         number of intra-op threads (default: leave the torch setting)
+        interop_threads: number of inter-op threads. torch only allows to set them once per process before any
+                         parallel work; later changes are ignored with a message.
+        channels_last:   store the weights of the convolutions in channels-last layout
+        no_grad:         disable autograd in context()
+    """
+
+    def __init__(self, threads=None, interop_threads=None, channels_last=False, no_grad=True):
+        self.threads = threads
+        self.interop_threads = interop_threads
+        self.channels_last = channels_last
+        self.no_grad = no_grad
+
+    def apply(self, model):
+        """
+        Sets the thread counts and converts the convolution weights of model in place.
+
+        Returns: model in eval mode
+        """
+        if self.threads is not None:
+            torch.set_num_threads(int(self.threads))
+        if self.interop_threads is not None and hasattr(torch, 'set_num_interop_threads') \
+                and torch.get_num_interop_threads() != self.interop_threads:
+            try:
+                torch.set_num_interop_threads(int(self.interop_threads))
+            except RuntimeError:
+                self.msg('Inter-op threads can no longer be changed. Keeping',
+                         torch.get_num_interop_threads(), depth=1)
+        set_memory_format(model, self.channels_last)
+        return model.eval()
+
+    def context(self):
+        return inference_mode() if self.no_grad else suppress()
+
+    def to_dict(self):
+        return dict(threads=self.threads, interop_threads=self.interop_threads,
+                    channels_last=self.channels_last, no_grad=self.no_grad)
+
+    def __repr__(self):
+        return '{}({})'.format(self.__class__.__name__,
+                               ', '.join('{}={}'.format(k, v) for k, v in self.to_dict().items()))
+
+
+def architecture_hash(model):
+    """
+    Returns: hash of the class and parameter shapes of model
+    """
+    return list_hash([model.__class__.__name__] + [(k, tuple(v.size())) for k, v in model.state_dict().items()])
+
+
+def thread_candidates(max_threads=None):
+    """
+    Returns: max_threads (default: number of CPUs) and its halvings down to one thread
+    """
+    n = max_threads or os.cpu_count() or 1
+    ret = []
+    while n >= 1:
+        ret.append(n)
+        n //= 2
+    return ret
+
+
+def _read_cache(path):
+    try:
+        with open(path) as fid:
+            return json.load(fid)
+    except (IOError, ValueError):
+        return {}
+
+
+def _write_cache(path, cache):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'w') as fid:
+        json.dump(cache, fid, indent=2, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def tune_inference(model, readout_key, x, behavior=None, eye_pos=None, threads=None, interop_threads=None,
+                   repeats=3, cache=None, retune=False):
+    """
+    Times the forward pass of model on the given input for every combination of thread count and memory
+    layout, applies the fastest setting to model, and caches it for this machine.
+
+    Args:
+        model:           CorePlusReadout3d on the CPU
+        readout_key:     readout to run
+        x:               input movie of a typical batch
+        behavior:        behavior of the batch
+        eye_pos:         eye position of the batch
+        threads:         list of thread counts to try (default: thread_candidates())
+        interop_threads: inter-op threads for all settings
+        repeats:         timed forward passes per setting
+        cache:           path of the json cache (default: NIPS2018_INFERENCE_CACHE or ~/.cache/nips2018/inference.json)
+        retune:          ignore a cached setting
+
+    Returns: fastest InferenceConfig
+
+    """
+    cache = cache or os.environ.get(CACHE_ENV) or DEFAULT_CACHE
+    entry = list_hash([socket.gethostname(), architecture_hash(model), tuple(x.size())])
+    cached = _read_cache(cache)
+    if entry in cached and not retune:
+        config = InferenceConfig(**cached[entry]['config'])
+        InferenceConfig.msg('Using cached', config)
+        config.apply(model)
+        return config
+
+    layouts = [False, True] if hasattr(torch, 'channels_last') else [False]
+    results = []
+    for n in (threads or thread_candidates()):
+        for channels_last in layouts:
+            config = InferenceConfig(threads=n, interop_threads=interop_threads, channels_last=channels_last)
+            config.apply(model)
+            with config.context():
+                t, _ = timeit(lambda: model(x, readout_key, behavior=behavior, eye_pos=eye_pos), repeats=repeats)
+            InferenceConfig.msg(config, '{:.1f} ms'.format(1000 * t), depth=1)
+            results.append((t, config))
+    t, best = min(results, key=lambda r: r[0])
+    best.apply(model)
+    InferenceConfig.msg('Fastest', best, '{:.1f} ms'.format(1000 * t))
+
+    cached = _read_cache(cache)  # another process might have written in the meantime
+    cached[entry] = dict(config=best.to_dict(), seconds=t, host=socket.gethostname(), input_shape=list(x.size()))
+    _write_cache(cache, cached)
+    return best
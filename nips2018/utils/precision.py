@@ -0,0 +1,65 @@
+"""
+Mixed-precision helpers for training and inference.
+
+Forward passes run under autocast in bfloat16 ('bf16', on CPU and GPU) or float16 ('fp16', GPU only) while
+the parameters stay in float32. float16 gradients are scaled with a GradScaler to avoid underflow; bfloat16
+has the range of float32 and needs no loss scaling.
+
+Unsupported precisions raise an error instead of falling back to another precision, so that a model stored
+under a precision was actually computed in it.
+"""
+from contextlib import suppress
+
+import torch
+
+from .device import get_device
+
+PRECISIONS = {'bf16': 'bfloat16', 'fp16': 'float16'}
+
+
+def check_precision(precision, device=None):
+    """
+    Returns: precision
+
+    Raises: ValueError if precision is not supported on device
+    """
+    if precision is None:
+        return None
+    assert precision in PRECISIONS, 'precision must be None or one of {}'.format(list(PRECISIONS))
+    if not hasattr(torch, 'autocast') or not hasattr(torch, PRECISIONS[precision]):
+        raise ValueError('{} autocast is not available in this torch version'.format(PRECISIONS[precision]))
+    if precision == 'fp16' and get_device(device).type != 'cuda':
+        raise ValueError('float16 autocast needs a GPU. Use bf16 on the CPU.')
+    return precision
+
+
+def autocast(precision, device=None):
+    """
+    Returns: context manager that runs the forward pass in precision (None: float32)
+    """
+    precision = check_precision(precision, device)
+    if precision is None:
+        return suppress()
+    return torch.autocast(device_type=get_device(device).type, dtype=getattr(torch, PRECISIONS[precision]))
+
+
+class _NoScaler:
+    def scale(self, loss):
+        return loss
+
+    def step(self, optimizer):
+        optimizer.step()
+
+    def update(self):
+        pass
+
+
+def grad_scaler(precision, device=None):
+    """
+    Returns: GradScaler for float16 training on the GPU and a pass-through scaler otherwise
+    """
+    if check_precision(precision, device) == 'fp16':
+        if hasattr(torch, 'amp') and hasattr(torch.amp, 'GradScaler'):
+            return torch.amp.GradScaler('cuda')
+        return torch.cuda.amp.GradScaler()
+    return _NoScaler()
@@ -0,0 +1,190 @@
+"""
+Early stopping that keeps its bookkeeping in a dictionary, so that it can be checkpointed and resumed, and a
+version that runs the validation in a background process while training continues.
+
+The bookkeeping holds the best objective and a copy of the best state, the last objective, the number of
+evaluations without improvement, and the epoch of the last evaluation. Passing a filled dictionary resumes
+early stopping where it was saved.
+
+In the asynchronous version, the model and the stop closure are forked into a worker process once per call.
+After every interval, a copy of the model state is sent to the worker, and the result is collected after the
+next interval. Patience and the best state are therefore updated with a delay of one interval. The worker
+runs on the CPU, so the stop closure must compute on the CPU. It must not read from files opened before the
+fork, because h5py handles cannot be shared between processes; Learner.train therefore requires cached
+validation loaders (see nips2018.movie.parameters.cache_loaders).
+
+GNU OpenMP (libgomp) is not fork-safe: a forked child whose parent already ran parallel regions hangs in its
+first parallel region with more than one thread. If torch uses libgomp, the worker therefore runs with one
+thread. Builds with Intel OpenMP or torch's native thread pool use the requested number of threads.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from copy import deepcopy
+from warnings import warn
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from attorch.train import copy_state
+
+from .logging import Messager
+
+_worker = {}
+
+
+class _Log(Messager):
+    pass
+
+
+def gnu_openmp():
+    """
+    Returns: True if torch parallelizes with GNU OpenMP (libgomp is loaded into the process)
+    """
+    if 'OpenMP' not in torch.__config__.parallel_info():
+        return False
+    try:
+        with open('/proc/self/maps') as fid:
+            return 'libgomp' in fid.read()
+    except IOError:
+        return False
+
+
+def worker_threads(threads):
+    """
+    Returns: number of threads a forked worker can safely use (one with GNU OpenMP)
+    """
+    if gnu_openmp() and threads != 1:
+        warn('torch uses GNU OpenMP, which hangs in forked processes with several threads. '
+             'The validation worker runs with one thread.')
+        return 1
+    return threads
+
+
+def _init_worker(model, objective, threads):
+    if threads is not None:
+        torch.set_num_threads(threads)
+    _worker['model'], _worker['objective'] = model, objective
+
+
+def _evaluate(state_dict):
+    model = _worker['model']
+    model.load_state_dict(state_dict)
+    return _worker['objective'](model)
+
+
+def _initialize(state, objective, state_dict, start):
+    state.update(best_objective=objective, current_objective=objective, best_state_dict=state_dict,
+                 patience_counter=0, checked_at=start)
+
+
+def _update(state, objective, state_dict, epoch, patience, tolerance, maximize):
+    """
+    Updates the bookkeeping with the objective of state_dict at epoch.
+    """
+    sign = -1 if maximize else 1
+    state['current_objective'], state['checked_at'] = objective, epoch
+    if sign * objective < sign * state['best_objective'] - tolerance:
+        _Log.msg('[{:03d}|{:02d}/{:02d}] ---> {}'.format(epoch, state['patience_counter'], patience, objective),
+                 flush=True)
+        state.update(best_objective=objective, best_state_dict=state_dict, patience_counter=0)
+    else:
+        state['patience_counter'] += 1
+        _Log.msg('[{:03d}|{:02d}/{:02d}] -/-> {}'.format(epoch, state['patience_counter'], patience, objective),
+                 flush=True)
+
+
+def _finalize(model, state, restore_best):
+    if restore_best:
+        model.load_state_dict(state['best_state_dict'])
+        _Log.msg('Restoring best model with objective {:.6f}'.format(float(np.mean(state['best_objective']))))
+
+
+def early_stopping(model, objective, interval=5, patience=20, start=0, max_iter=1000, maximize=True,
+                   tolerance=1e-5, restore_best=True, state=None):
+    """
+    Same as attorch.train.early_stopping, but the bookkeeping is kept in state.
+
+    Args:
+        model:          model to train
+        objective:      stop closure
+        interval:       epochs between two evaluations
+        patience:       number of evaluations without improvement before stopping
+        start:          first epoch
+        max_iter:       maximal number of epochs
+        maximize:       whether objective is maximized
+        tolerance:      minimal improvement
+        restore_best:   load the best state into model at the end
+        state:          dictionary for the bookkeeping. If it is filled, early stopping resumes from it.
+
+    Yields: epoch and the last value of objective
+
+    """
+    state = {} if state is None else state
+    training = model.training
+
+    def evaluate():
+        model.eval()
+        ret = objective(model)
+        model.train(training)
+        return ret
+
+    if 'best_objective' not in state:
+        _initialize(state, evaluate(), copy_state(model), start)
+    epoch = start
+    try:
+        while state['patience_counter'] < patience and epoch < max_iter:
+            while epoch < state['checked_at'] + interval:
+                epoch += 1
+                if not np.all(np.isfinite(state['current_objective'])):
+                    _Log.msg('Objective is not finite. Stopping training')
+                    return
+                yield epoch, state['current_objective']
+            _update(state, evaluate(), copy_state(model), epoch, patience, tolerance, maximize)
+    finally:
+        _finalize(model, state, restore_best)
+
+
+def async_early_stopping(model, objective, interval=5, patience=20, start=0, max_iter=1000, maximize=True,
+                         tolerance=1e-5, restore_best=True, state=None, threads=None):
+    """
+    Same as early_stopping, but objective is evaluated on snapshots of model in a background process while the
+    next interval trains. An evaluation that is still running when the bookkeeping is saved is lost on resume.
+
+    Args:
+        threads:        number of CPU threads of the worker (default: torch default, one with GNU OpenMP)
+        other:          see early_stopping
+
+    Yields: epoch and the last known value of objective
+
+    """
+    state = {} if state is None else state
+    pool = ProcessPoolExecutor(max_workers=1, mp_context=mp.get_context('fork'),
+                               initializer=_init_worker,
+                               initargs=(deepcopy(model).cpu(), objective, worker_threads(threads)))
+    if 'best_objective' not in state:
+        state_dict = copy_state(model)
+        _initialize(state, pool.submit(_evaluate, state_dict).result(), state_dict, start)
+
+    epoch, pending = start, None
+    try:
+        while state['patience_counter'] < patience and epoch < max_iter:
+            while epoch < state['checked_at'] + interval:
+                epoch += 1
+                if not np.all(np.isfinite(state['current_objective'])):
+                    _Log.msg('Objective is not finite. Stopping training')
+                    return
+                yield epoch, state['current_objective']
+            state_dict = copy_state(model)
+            # the interval ends here, even if the evaluation of its snapshot is collected later
+            state['checked_at'] = epoch
+            if pending is not None:
+                future, pending_state_dict, at_epoch = pending
+                _update(state, future.result(), pending_state_dict, at_epoch, patience, tolerance, maximize)
+                state['checked_at'], pending = epoch, None
+            if state['patience_counter'] < patience:
+                pending = (pool.submit(_evaluate, state_dict), state_dict, epoch)
+        if pending is not None:
+            future, pending_state_dict, at_epoch = pending
+            _update(state, future.result(), pending_state_dict, at_epoch, patience, tolerance, maximize)
+    finally:
+        pool.shutdown(wait=False)
+        _finalize(model, state, restore_best)
@@ -0,0 +1,123 @@
+"""
+Factories for the tests: random movies, small cores and models, and the comparison of eager and TorchScript
+time loops.
+
+torch and the architectures are imported inside the fixtures, so that test modules can skip with
+pytest.importorskip if they are not installed.
+"""
+import importlib
+from collections import OrderedDict
+
+import pytest
+
+N_NEURONS = OrderedDict([('group1', 20), ('group2', 13)])
+IMG_SHAPE = (16, 18)
+
+
+@pytest.fixture
+def movie_module():
+    """
+    Returns: function that imports nips2018.movie.<name>. The movie modules declare their datajoint schemas
+             on import, so the test is skipped if that fails (e.g. without a database connection).
+    """
+
+    def load(name):
+        try:
+            return importlib.import_module('nips2018.movie.' + name)
+        except Exception as e:
+            pytest.skip('could not import nips2018.movie.{}: {}'.format(name, e))
+
+    return load
+
+
+@pytest.fixture
+def random_movie():
+    import torch
+
+    def movie(batch_size, channels, seq_len, img_shape=IMG_SHAPE):
+        return torch.randn(batch_size, channels, seq_len, *img_shape)
+
+    return movie
+
+
+@pytest.fixture
+def feature_gru():
+    """
+    Returns: function that builds a StackedFeatureGRUCore. Keyword arguments replace the defaults.
+    """
+    from nips2018.architectures.cores import StackedFeatureGRUCore
+
+    def core(input_channels=1, **kwargs):
+        params = dict(hidden_channels=4, rec_channels=6, input_kern=7, hidden_kern=3, rec_kern=3, layers=2,
+                      gamma_rec=0., gamma_hidden=0.1, gamma_input=50, skip=2, bias=False, pad_input=True,
+                      momentum=.1)
+        params.update(kwargs)
+        return StackedFeatureGRUCore(input_channels=input_channels, **params)
+
+    return core
+
+
+@pytest.fixture
+def model(feature_gru):
+    """
+    CorePlusReadout3d with a recurrent core, a spatial transformer readout, a GRU shifter, and a GateGRU
+    modulator for two readouts (see N_NEURONS). Readout positions and features are random, so that all neurons
+    differ.
+    """
+    import torch
+    from attorch.layers import Elu1
+    from nips2018.architectures.base import CorePlusReadout3d
+    from nips2018.architectures.modulators import GateGRUModulator
+    from nips2018.architectures.readouts import SpatialTransformerPooled3dReadout
+    from nips2018.architectures.shifters import GRUShifter
+
+    core = feature_gru()
+    in_shape = CorePlusReadout3d.get_readout_in_shape(core, (1, 1, 12) + IMG_SHAPE)
+    readout = SpatialTransformerPooled3dReadout(in_shape, N_NEURONS, pool_steps=1)
+    readout.initialize(OrderedDict([(k, torch.rand(n) + 1) for k, n in N_NEURONS.items()]))
+    for k in N_NEURONS:
+        readout[k].grid.data.uniform_(-.8, .8)
+        readout[k].features.data.normal_(0, .1)
+    shifter = GRUShifter(N_NEURONS.keys(), input_channels=2, hidden_channels=2)
+    modulator = GateGRUModulator(N_NEURONS, input_channels=3, hidden_channels=5)
+    return CorePlusReadout3d(core, readout, nonlinearity=Elu1(), shifter=shifter, modulator=modulator, burn_in=3)
+
+
+@pytest.fixture
+def inputs(random_movie):
+    """
+    Returns: function that draws a movie with behavior and eye positions of seq_len frames
+    """
+    import torch
+
+    def draw(batch_size=2, seq_len=12):
+        return (random_movie(batch_size, 1, seq_len), torch.randn(batch_size, seq_len, 3),
+                torch.randn(batch_size, seq_len, 2))
+
+    return draw
+
+
+@pytest.fixture
+def compiled_parity():
+    """
+    Returns: function that compares outputs and gradients of a module with and without TorchScript time
+             loops and returns the maximal absolute difference of the outputs and of the parameter gradients
+    """
+    from nips2018.architectures._scripted import set_compiled
+
+    def parity(module, *inputs, **kwargs):
+        results = []
+        for compiled in [False, True]:
+            set_compiled(module, compiled)
+            module.zero_grad()
+            out = module(*inputs, **kwargs)
+            out.sum().backward()
+            results.append((out.data.clone(),
+                            [p.grad.data.clone() for p in module.parameters() if p.grad is not None]))
+        set_compiled(module, False)
+        (out_eager, grad_eager), (out_compiled, grad_compiled) = results
+        out_diff = float((out_eager - out_compiled).abs().max())
+        grad_diff = max([float((a - b).abs().max()) for a, b in zip(grad_eager, grad_compiled)] or [0.])
+        return out_diff, grad_diff
+
+    return parity
@@ -0,0 +1,63 @@
+"""
+Equivalence of the forward pass of CorePlusReadout3d, which only runs shifter, modulator, and readout on the
+frames after the burn in, with running all stages on all frames and dropping the burn in at the end.
+Outputs have to agree within TOLERANCE (maximal absolute difference in float32).
+"""
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('attorch')
+
+TOLERANCE = 1e-5
+
+
+@pytest.fixture(autouse=True)
+def seed():
+    torch.manual_seed(2018)
+
+
+def max_diff(a, b):
+    return float((a - b).abs().max())
+
+
+def all_frames_forward(model, x, readout_key, behavior=None, eye_pos=None, subs_idx=None):
+    """
+    Reference forward pass that drops the burn in frames only from the output.
+    """
+    timesteps = x.size(2)
+    x, _ = model.core_stage(x)
+    shift, _ = model.shift_stage(x, readout_key, eye_pos)
+    modulation, _ = model.modulation_stage(readout_key, behavior, subs_idx=subs_idx)
+    x = model.readout_stage(x, readout_key, shift=shift, subs_idx=subs_idx)
+    return model.output_stage(x, readout_key, timesteps, modulation=modulation, subs_idx=None, burn_in=True)
+
+
+@pytest.mark.parametrize('burn_in', [0, 3, 11])
+@pytest.mark.parametrize('shift, modulate', [(False, False), (True, True)])
+def test_burn_in(model, inputs, burn_in, shift, modulate):
+    x, behavior, eye_pos = inputs(seq_len=12)
+    model.burn_in = burn_in
+    model.shift, model.modulate = shift, modulate
+    expected = all_frames_forward(model, x, 'group1', behavior=behavior, eye_pos=eye_pos)
+    out = model(x, 'group1', behavior=behavior, eye_pos=eye_pos)
+    assert out.size() == expected.size() == (2, 12 - burn_in, 20)
+    assert max_diff(expected, out) <= TOLERANCE
+
+
+def test_burn_in_subset(model, inputs):
+    x, behavior, eye_pos = inputs(seq_len=12)
+    subs_idx = torch.LongTensor([4, 19, 0])
+    expected = all_frames_forward(model, x, 'group1', behavior=behavior, eye_pos=eye_pos, subs_idx=subs_idx)
+    out = model(x, 'group1', behavior=behavior, eye_pos=eye_pos, subs_idx=subs_idx)
+    assert max_diff(expected, out) <= TOLERANCE
+
+
+def test_burn_in_gradient(model, inputs):
+    x, behavior, eye_pos = inputs(seq_len=12)
+    grads = []
+    for forward in [all_frames_forward, type(model).forward]:
+        model.zero_grad()
+        forward(model, x, 'group1', behavior=behavior, eye_pos=eye_pos).pow(2).sum().backward()
+        grads.append([p.grad.data.clone() for p in model.parameters() if p.grad is not None])
+    assert len(grads[0]) == len(grads[1]) > 0
+    assert max(max_diff(a, b) for a, b in zip(*grads)) <= 10 * TOLERANCE
@@ -0,0 +1,111 @@
+"""
+Checkpointing and resuming of training: a run that is interrupted and resumed from its last checkpoint has
+to end with the same parameters, epoch, and early stopping bookkeeping as an uninterrupted run.
+"""
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('attorch')
+
+import numpy as np
+from torch import nn
+
+from nips2018.utils.checkpoint import Checkpointer, set_rng_state
+from nips2018.utils.validation import early_stopping
+
+KEY = dict(animal_id=1, session=2, data_hash='abc')
+
+
+@pytest.fixture
+def checkpointer(tmp_path):
+    return Checkpointer(KEY, directory=str(tmp_path))
+
+
+def train(checkpointer, crash_after=None):
+    """
+    Trains a linear model on random batches with early stopping and saves a checkpoint after every epoch.
+    Training resumes from the checkpoint if there is one.
+
+    Args:
+        checkpointer:   Checkpointer of the run
+        crash_after:    epoch after which training is interrupted (default: train until early stopping ends)
+
+    Returns: model, last epoch, and early stopping bookkeeping, or None if training was interrupted
+    """
+    torch.manual_seed(2018)
+    model = nn.Linear(3, 1)
+    optimizer = torch.optim.Adam(model.parameters(), lr=0.05)
+    x_val, y_val = torch.randn(50, 3), torch.randn(50, 1)
+
+    def objective(model):
+        with torch.no_grad():
+            return float((model(x_val) - y_val).pow(2).mean())
+
+    epoch, stopping = 0, {}
+    resume = checkpointer.load()
+    if resume is not None:
+        model.load_state_dict(resume['model'])
+        optimizer.load_state_dict(resume['optimizer'])
+        set_rng_state(resume['rng'])
+        epoch, stopping = resume['epoch'], resume['stopping']
+
+    for epoch, _ in early_stopping(model, objective, interval=2, patience=3, start=epoch, max_iter=15,
+                                   maximize=False, state=stopping):
+        x = torch.randn(8, 3)
+        y = x.sum(1, keepdim=True) + torch.randn(8, 1)
+        optimizer.zero_grad()
+        (model(x) - y).pow(2).mean().backward()
+        optimizer.step()
+        checkpointer.save(epoch, model=model.state_dict(), optimizer=optimizer.state_dict(), stopping=stopping)
+        if epoch == crash_after:
+            return None
+    return model, epoch, stopping
+
+
+def test_save_load(checkpointer):
+    checkpointer.save(3, model={'weight': torch.ones(2)}, stage=1)
+    checkpoint = checkpointer.load()
+    assert checkpoint['epoch'] == 3 and checkpoint['stage'] == 1
+    assert torch.equal(checkpoint['model']['weight'], torch.ones(2))
+    assert set(checkpoint['rng']) == {'python', 'numpy', 'torch', 'cuda'}
+
+
+def test_every(tmp_path):
+    checkpointer = Checkpointer(KEY, directory=str(tmp_path), every=2)
+    checkpointer.save(1, stage=0)
+    assert checkpointer.load() is None
+    checkpointer.save(2, stage=0)
+    checkpointer.save(3, stage=1)
+    assert checkpointer.load()['epoch'] == 2
+    checkpointer.save(3, force=True, stage=1)
+    assert checkpointer.load()['epoch'] == 3
+
+
+def test_clear_and_unreadable(checkpointer):
+    checkpointer.save(1)
+    checkpointer.clear()
+    assert checkpointer.load() is None
+    with open(checkpointer.path, 'w') as fid:
+        fid.write('not a checkpoint')
+    assert checkpointer.load() is None
+
+
+def test_key_order(tmp_path):
+    reordered = dict(reversed(list(KEY.items())))
+    assert Checkpointer(KEY, directory=str(tmp_path)).path == Checkpointer(reordered, directory=str(tmp_path)).path
+
+
+@pytest.mark.parametrize('crash_after', [1, 2, 5])
+def test_resume(tmp_path, crash_after):
+    model, epoch, stopping = train(Checkpointer(KEY, directory=str(tmp_path / 'full')))
+
+    checkpointer = Checkpointer(KEY, directory=str(tmp_path / 'resumed'))
+    assert train(checkpointer, crash_after=crash_after) is None
+    resumed_model, resumed_epoch, resumed_stopping = train(checkpointer)
+
+    assert epoch == resumed_epoch > crash_after
+    for p, q in zip(model.parameters(), resumed_model.parameters()):
+        assert torch.equal(p.data, q.data)
+    assert stopping['best_objective'] == resumed_stopping['best_objective']
+    assert stopping['patience_counter'] == resumed_stopping['patience_counter']
+    assert np.isfinite(stopping['best_objective'])
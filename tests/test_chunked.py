@@ -0,0 +1,84 @@
+"""
+Equivalence of stateful chunked prediction (truncated backpropagation through time) with the prediction of
+the whole movie. Outputs have to agree within TOLERANCE (maximal absolute difference in float32).
+"""
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('attorch')
+
+from nips2018.architectures.base import detach_state
+
+TOLERANCE = 1e-5
+
+
+@pytest.fixture(autouse=True)
+def seed():
+    torch.manual_seed(2018)
+
+
+def max_diff(a, b):
+    return float((a - b).abs().max())
+
+
+def chunked_forward(model, readout_key, x, behavior, eye_pos, chunk_size, detach=True):
+    """
+    Predicts x in chunks of chunk_size frames, passing the hidden states from chunk to chunk.
+    """
+    hidden, outputs = None, []
+    for start in range(0, x.size(2), chunk_size):
+        stop = start + chunk_size
+        out, hidden = model(x[:, :, start:stop], readout_key, behavior=behavior[:, start:stop],
+                            eye_pos=eye_pos[:, start:stop], hidden=hidden, return_hidden=True)
+        outputs.append(out)
+        if detach:
+            hidden = detach_state(hidden)
+    return torch.cat(outputs, 1)
+
+
+@pytest.mark.parametrize('chunk_size', [4, 5, 7, 12, 20])
+def test_chunked_output(model, inputs, chunk_size):
+    x, behavior, eye_pos = inputs(seq_len=12)
+    model.eval()
+    with torch.no_grad():
+        full = model(x, 'group1', behavior=behavior, eye_pos=eye_pos)
+        chunked = chunked_forward(model, 'group1', x, behavior, eye_pos, chunk_size)
+    assert full.size() == chunked.size() == (2, 12 - model.burn_in, 20)
+    assert max_diff(full, chunked) <= TOLERANCE
+
+
+def test_chunked_gradient(model, inputs):
+    # without detaching the hidden states, the gradients of the chunks add up to the ones of the whole movie
+    x, behavior, eye_pos = inputs(seq_len=12)
+    model.eval()
+    grads = []
+    for chunk_size in [None, 5]:
+        model.zero_grad()
+        if chunk_size is None:
+            out = model(x, 'group1', behavior=behavior, eye_pos=eye_pos)
+        else:
+            out = chunked_forward(model, 'group1', x, behavior, eye_pos, chunk_size, detach=False)
+        out.pow(2).sum().backward()
+        grads.append([p.grad.data.clone() for p in model.parameters() if p.grad is not None])
+    assert len(grads[0]) == len(grads[1]) > 0
+    assert max(max_diff(a, b) for a, b in zip(*grads)) <= 10 * TOLERANCE
+
+
+def test_detach_state(model, inputs):
+    x, behavior, eye_pos = inputs(seq_len=12)
+    _, hidden = model(x, 'group1', behavior=behavior, eye_pos=eye_pos, return_hidden=True)
+    detached = detach_state(hidden)
+    assert set(detached) == set(hidden)
+    for k, v in detached.items():
+        if v is not None:
+            assert not v.requires_grad and torch.equal(v, hidden[k])
+
+
+def test_time_chunks(movie_module, inputs):
+    time_chunks = movie_module('_utils').time_chunks
+    x, behavior, eye_pos = inputs(seq_len=12)
+    responses = torch.randn(2, 12, 20)
+    chunks = list(time_chunks([x, behavior, eye_pos, responses], 5))
+    assert [c[0].size(2) for c in chunks] == [5, 5, 2]
+    for full, parts in zip([x, behavior, eye_pos, responses], zip(*chunks)):
+        assert torch.equal(torch.cat(parts, 2 if full.dim() == 5 else 1), full)
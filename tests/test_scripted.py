@@ -0,0 +1,78 @@
+"""
+Parity of the TorchScript time loops (nips2018.architectures._scripted) with eager mode.
+
+Outputs have to agree within OUTPUT_TOLERANCE and parameter gradients within GRADIENT_TOLERANCE (maximal
+absolute difference in float32). The tests are skipped if TorchScript is not available.
+"""
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('attorch')
+
+from torch import nn
+
+from nips2018.architectures import _scripted
+from nips2018.architectures.cores import ConvGRUCell
+from nips2018.architectures.modulators import GateGRU
+from nips2018.architectures.shifters import GRU
+
+OUTPUT_TOLERANCE = 1e-5
+GRADIENT_TOLERANCE = 1e-4
+
+pytestmark = pytest.mark.skipif(not _scripted.available(), reason='TorchScript is not available')
+
+
+@pytest.fixture(autouse=True)
+def seed():
+    torch.manual_seed(2018)
+
+
+def max_diff(a, b):
+    return float((a - b).abs().max())
+
+
+def test_gru_sequence():
+    cell = nn.GRUCell(3, 5)
+    x, hidden = torch.randn(7, 2, 3), torch.randn(2, 5)
+
+    states, h = [], hidden
+    for t in range(x.size(0)):
+        h = cell(x[t], h)
+        states.append(h)
+
+    assert max_diff(_scripted.gru_sequence(cell, x, hidden), torch.stack(states)) <= OUTPUT_TOLERANCE
+
+
+def test_conv_gru_sequence():
+    cell = ConvGRUCell(4, 6, input_kern=5, rec_kern=3)
+    x = torch.randn(7, 2, 4, 9, 11)
+    hidden = cell.init_state(x[0])
+
+    states, h = [], hidden
+    for t in range(x.size(0)):
+        h = cell(x[t], h)
+        states.append(h)
+
+    assert max_diff(_scripted.conv_gru_sequence(cell, x, hidden), torch.stack(states)) <= OUTPUT_TOLERANCE
+
+
+@pytest.mark.parametrize('name', ['FeatureGRUCore', 'GRU shifter', 'GateGRU modulator'])
+def test_compiled_parity(name, feature_gru, random_movie, compiled_parity):
+    if name == 'FeatureGRUCore':
+        module = feature_gru()
+        x = random_movie(2, 1, 7, (16, 18))
+        module.output_shape((1, 7, 16, 18))
+    elif name == 'GRU shifter':
+        module, x = GRU(2, 2), torch.randn(2, 7, 2)
+    else:
+        module, x = GateGRU(20, 3, 5), torch.randn(2, 7, 3)
+
+    out_diff, grad_diff = compiled_parity(module, x)
+    assert out_diff <= OUTPUT_TOLERANCE
+    assert grad_diff <= GRADIENT_TOLERANCE
+
+
+def test_set_compiled():
+    module = GateGRU(20, 3, 5)
+    assert _scripted.set_compiled(module, True) and module.compiled
+    assert not _scripted.set_compiled(module, False) and not module.compiled
@@ -0,0 +1,70 @@
+"""
+Equivalence of the predictions, modulations, and losses for a subset of neurons with the ones for all neurons
+indexed afterwards. Outputs have to agree within TOLERANCE (maximal absolute difference in float32).
+"""
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('attorch')
+
+from attorch.losses import PoissonLoss3d
+
+from nips2018.architectures.losses import SubsetPoissonLoss3d
+from nips2018.architectures.modulators import GateGRU
+
+TOLERANCE = 1e-5
+
+
+@pytest.fixture(autouse=True)
+def seed():
+    torch.manual_seed(2018)
+
+
+@pytest.fixture
+def subs_idx():
+    # unsorted and with a repeated neuron, as subsampled neurons in training can be
+    return torch.LongTensor([7, 0, 12, 3, 7])
+
+
+def max_diff(a, b):
+    return float((a - b).abs().max())
+
+
+@pytest.mark.parametrize('shift, modulate', [(False, False), (True, False), (True, True)])
+def test_model_subset(model, inputs, subs_idx, shift, modulate):
+    x, behavior, eye_pos = inputs()
+    model.shift, model.modulate = shift, modulate
+    full = model(x, 'group2', behavior=behavior, eye_pos=eye_pos)
+    subset = model(x, 'group2', behavior=behavior, eye_pos=eye_pos, subs_idx=subs_idx)
+    assert subset.size() == (2, 12 - model.burn_in, len(subs_idx))
+    assert max_diff(full[..., subs_idx], subset) <= TOLERANCE
+
+
+def test_readout_subset_forward(model, inputs, subs_idx):
+    x, _, eye_pos = inputs()
+    core_out = model.core(x)
+    shift = model.shifter['group2'](eye_pos)
+    full = model.readout['group2'](core_out, shift=shift)
+    subset = model.readout.subset_forward('group2', core_out, subs_idx, shift=shift)
+    assert max_diff(full[..., subs_idx], subset) <= TOLERANCE
+
+
+@pytest.mark.parametrize('subs_idx', [torch.LongTensor([7, 0, 12, 3, 7]), slice(2, 9)])
+def test_modulation_subset(subs_idx):
+    modulator = GateGRU(13, 3, 5)
+    behavior = torch.randn(2, 12, 3)
+    full = modulator.modulation(behavior)
+    assert max_diff(full[..., subs_idx], modulator.modulation(behavior, subs_idx=subs_idx)) <= TOLERANCE
+    assert max_diff(full[:, -4:, subs_idx],
+                    modulator.modulation(behavior, subs_idx=subs_idx, frames=4)) <= TOLERANCE
+
+
+@pytest.mark.parametrize('per_neuron', [False, True])
+def test_subset_poisson_loss(subs_idx, per_neuron):
+    output = torch.rand(2, 9, 13)
+    target = torch.rand(2, 12, 13)
+    expected = PoissonLoss3d(per_neuron=per_neuron)(output[..., subs_idx], target[..., subs_idx])
+    loss = SubsetPoissonLoss3d(per_neuron=per_neuron)(output[..., subs_idx], target, subs_idx=subs_idx)
+    assert max_diff(expected, loss) <= TOLERANCE
+    assert max_diff(PoissonLoss3d(per_neuron=per_neuron)(output, target),
+                    SubsetPoissonLoss3d(per_neuron=per_neuron)(output, target)) <= TOLERANCE
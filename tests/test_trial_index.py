@@ -0,0 +1,70 @@
+"""
+Equivalence of nips2018.movie.data.TrialIndex with the string comparisons it replaced and with the batches
+of attorch's RepeatsBatchSampler.
+"""
+import pytest
+
+np = pytest.importorskip('numpy')
+dataloaders = pytest.importorskip('attorch.dataloaders')
+
+TYPES = ['stimulus.Clip', 'stimulus.Monet', 'stimulus.Trippy']
+TIERS = ['train', 'validation', 'test']
+
+
+@pytest.fixture
+def trials():
+    rng = np.random.RandomState(2018)
+    return dict(types=rng.choice(TYPES, 200), tiers=rng.choice(TIERS, 200),
+                condition_hashes=rng.choice(['hash{:02d}'.format(i) for i in range(30)], 200))
+
+
+@pytest.fixture
+def trial_index(movie_module, trials):
+    return movie_module('data').TrialIndex(**trials)
+
+
+def string_constraint(types, tiers, stimulus_type, tier=None):
+    """
+    Constraint as computed before the trial index, by comparing the string arrays.
+    """
+    constraint = np.zeros(len(types), dtype=bool)
+    for const in map(lambda s: s.strip(), stimulus_type.split('|')):
+        if const.startswith('~'):
+            constraint |= types != const[1:]
+        else:
+            constraint |= types == const
+    if tier is not None:
+        constraint &= tiers == tier
+    return constraint
+
+
+@pytest.mark.parametrize('stimulus_type', ['stimulus.Clip', '~stimulus.Clip', 'stimulus.Clip|stimulus.Monet',
+                                           'stimulus.Clip | ~stimulus.Monet', 'stimulus.Missing',
+                                           '~stimulus.Missing'])
+@pytest.mark.parametrize('tier', [None, 'train', 'missing'])
+def test_query(trial_index, trials, stimulus_type, tier):
+    expected = string_constraint(trials['types'], trials['tiers'], stimulus_type, tier=tier)
+    assert np.array_equal(trial_index.query(stimulus_type, tier=tier), expected)
+
+
+def test_query_returns_copy(trial_index):
+    constraint = trial_index.query('stimulus.Clip')
+    constraint[:] = False
+    assert trial_index.query('stimulus.Clip').any()
+
+
+@pytest.mark.parametrize('subset', ['all', 'sorted', 'shuffled', 'empty'])
+def test_repeat_groups(trial_index, trials, subset):
+    rng = np.random.RandomState(0)
+    if subset == 'all':
+        subset_index = None
+    elif subset == 'sorted':
+        subset_index = np.sort(rng.choice(200, 120, replace=False))
+    elif subset == 'shuffled':
+        subset_index = rng.permutation(200)[:120]
+    else:
+        subset_index = np.array([], dtype=np.int64)
+
+    sampler = dataloaders.RepeatsBatchSampler(trials['condition_hashes'], subset_index=subset_index)
+    expected = [[int(i) for i in batch] for batch in sampler]
+    assert trial_index.repeat_groups(subset_index) == expected